@@ -1,18 +1,181 @@
+import contextlib
+
 import utils.visa_subs as visa_subs
 
+from . import ramp
+
 
 class Instrument:
     """Implement a generic instrument which does the following:
 
     description
+    ramp
+    start_ramp
+    trigger
+    fetch
+    batch
+    write_setting
+    query_setting
+    invalidate
     """
 
     def __init__(self, address):
         self.name = "Instrument Name"
         self.address = address
-        self.visa = visa_subs.initialize_gpib(address, 0)
+        self.bus_lock = visa_subs.bus_lock(0)
+
+        # Shadow state of the settings, shared by all the objects using this session.
+        # Instruments without an address, e.g. the Timer, have no VISA session
+        if address is None:
+            self.visa = None
+            self.resource_name = None
+            self.state = {}
+        else:
+            self.visa = visa_subs.initialize_gpib(address, 0)
+            self.resource_name = f"GPIB0::{address}::INSTR"
+            self.state = visa_subs.session_state(self.resource_name)
+
+        self.data = [0.0]
+        self.source_column = 0
+        self.ramp_step = None  # largest output step, None for instruments without an output
+        self.ramp_rate = None  # units per second, None for one ramp_step every 20 ms
+        self.bus_trigger = False  # wait for a GPIB group execute trigger after trigger()
+        self.buffer_count = 1  # readings taken on the instrument by one trigger()
+        self.buffer_data = None  # those readings after fetch(), one row per reading
+
+        # Commands held back by batch() and the longest message they are merged into
+        self.batch_commands = None
+        self.max_message_length = 256
 
     def description(self):
         """ Print a description string to data file"""
 
         return f"{self.name}: address={self.address}"
+
+    def write(self, command):
+        """Write a command, inside batch() it is held back and merged with the next ones"""
+
+        if command == "*RST":
+            self.invalidate()
+        if self.batch_commands is None:
+            self.visa.write(command)
+        else:
+            self.batch_commands.append(command)
+
+    def query(self, command):
+        """Send any held back commands and query"""
+
+        self.flush()
+        return self.visa.query(command)
+
+    def flush(self, wait=False):
+        """Send the held back commands as semicolon joined messages, with wait the
+        last message ends with *OPC? so this returns when they are all done
+        """
+
+        commands = self.batch_commands or []
+        if self.batch_commands is not None:
+            self.batch_commands = []
+        if wait:
+            commands = commands + ["*OPC?"]
+
+        messages = []
+        for command in commands:
+            if messages and len(messages[-1]) + len(command) < self.max_message_length:
+                messages[-1] = ";".join((messages[-1], command))
+            else:
+                messages.append(command)
+
+        for message in messages[:-1]:
+            self.visa.write(message)
+        if messages:
+            if wait:
+                self.visa.query(messages[-1])
+            else:
+                self.visa.write(messages[-1])
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Merge the writes made in the block into as few bus transactions as possible
+        and wait for the instrument to finish them with *OPC?
+        """
+
+        self.batch_commands = []
+        try:
+            yield self
+            self.flush(wait=True)
+        finally:
+            self.batch_commands = None
+
+    def write_setting(self, header, value):
+        """Write "header value" unless the shadow state shows it is already set"""
+
+        value = str(value)
+        if self.state.get(header) != value:
+            self.write(f"{header} {value}")
+            self.state[header] = value
+
+    def query_setting(self, header):
+        """Query "header?", answered from the shadow state if the setting is known"""
+
+        if header not in self.state:
+            self.state[header] = self.query(f"{header}?").strip()
+        return self.state[header]
+
+    def invalidate(self):
+        """Forget the shadow state so the settings are read again, e.g. after the
+        front panel has been used
+        """
+
+        self.state.clear()
+
+    def trigger(self):
+        """Start a measurement without waiting for it, fetch collects the result.
+        Instruments that cannot be armed do the whole measurement in fetch
+        """
+
+        pass
+
+    def fetch(self):
+        """Collect the measurement started by trigger into self.data"""
+
+        self.read_data()
+
+    def set_bus_trigger(self, enable=True):
+        """Make trigger() wait for a GPIB group execute trigger, if the instrument
+        can be triggered from the bus
+        """
+
+        pass
+
+    def read_source(self):
+        """Return the present output value, the start of a ramp"""
+
+        return self.data[self.source_column]
+
+    def ramp(self, finish_value, rate=None):
+        """Ramp the output to finish_value and wait until it is reached"""
+
+        return self.start_ramp(finish_value, rate).result()
+
+    def start_ramp(self, finish_value, rate=None):
+        """Start ramping the output to finish_value at rate (units per second)
+        on a background thread and return the ramp.RampTask. Instruments with an
+        output set ramp_step and define set_output(level)
+        """
+
+        if self.ramp_step is None:
+            raise ValueError(f"{self.name} has no output to ramp")
+        start_value = self.read_source()
+        if abs(start_value - finish_value) <= self.ramp_step:
+            return ramp.RampTask(ramp.no_ramp, start_value)
+
+        if rate is None:
+            rate = self.ramp_rate if self.ramp_rate else self.ramp_step / 0.02
+        values = ramp.ramp_values(start_value, finish_value, self.ramp_step)
+        return ramp.RampTask(self.run_ramp, values, rate)
+
+    def run_ramp(self, task, values, rate):
+        """Step the output through values at rate, override to use ramp hardware"""
+
+        return ramp.step_ramp(task, self.set_output, values, rate, lock=self.bus_lock)
@@ -1,9 +1,7 @@
-import time
+from .voltmeter import Voltmeter
 
-from .sourcemeter import Keithley
 
-
-class K2002(Keithley):
+class K2002(Voltmeter):
     def __init__(self, address):
         super().__init__(address)
         self.name = "Keithley 2002"
@@ -16,6 +14,8 @@ class K2002(Keithley):
         self.sense_range = 2.
         self.auto_sense_range = False
         self.relative_value = 0.
+        self.trace_feed = "SENS1"
+        self.nplc_header = ":SENS:VOLT:DC:NPLC"
 
     def description(self):
         """Print a description string to data file"""
@@ -39,6 +39,7 @@ class K2002(Keithley):
         self.data = [0.0]
         self.data_column = 0
         self.sense = "VOLT"
+        self.buffer_count = 1  # *RST leaves a trigger count of one
 
         # Special variables for 2002
         self.relative = relative
@@ -47,40 +48,41 @@ class K2002(Keithley):
         self.sense_range = sense_range
         self.auto_sense_range = auto_sense_range
 
-        # A bunch of commands to configure the 2002
-        self.visa.write("*RST")
-        time.sleep(.1)
-        self.visa.write(":SENS:FUNC \'VOLT:DC\'")
-        self.visa.query(":READ?")
-
-        if self.auto_sense_range:
-            self.auto_sense_range = True
-            self.visa.write("".join((":SENS:", self.sense, ":RANG:AUTO 1")))
-        else:
-            self.sense_range = sense_range
-            self.auto_sense_range = False
-            self.visa.write("".join((":SENS:", self.sense, ":RANG ", "%.2e" % sense_range)))
-
-        if self.filter:
-            self.visa.write(":SENS:VOLT:AVER:STAT 1")
-            self.visa.write(":SENS:VOLT:AVER:COUN %d" % count)
-        else:
-            self.visa.write(":SENS:VOLT:AVER:STAT 0")
-
-        self.visa.query(":READ?")
-
-        self.visa.write(":SENS:VOLT:REF:STAT 0")
-        if relative:
-            self.visa.write(":SENS:VOLT:REF:ACQ")
-            self.visa.write(":SENS:VOLT:REF:STAT 1")
-            reply = self.visa.query(":SENS:VOLT:REF?")
-            print(reply)
-            self.relative_value = float(reply)
-
+        # A bunch of commands to configure the 2002, merged into as few messages
+        # as possible and finished with *OPC?
+        with self.batch():
+            self.write("*RST")
+            self.write(":SENS:FUNC \'VOLT:DC\'")
+            self.query(":READ?")
+
+            if self.auto_sense_range:
+                self.auto_sense_range = True
+                self.write("".join((":SENS:", self.sense, ":RANG:AUTO 1")))
+            else:
+                self.sense_range = sense_range
+                self.auto_sense_range = False
+                self.write("".join((":SENS:", self.sense, ":RANG ", "%.2e" % sense_range)))
+
+            if self.filter:
+                self.write(":SENS:VOLT:AVER:STAT 1")
+                self.write(":SENS:VOLT:AVER:COUN %d" % count)
+            else:
+                self.write(":SENS:VOLT:AVER:STAT 0")
+
+            self.query(":READ?")
+
+            self.write(":SENS:VOLT:REF:STAT 0")
+            if relative:
+                self.write(":SENS:VOLT:REF:ACQ")
+                self.write(":SENS:VOLT:REF:STAT 1")
+                reply = self.query(":SENS:VOLT:REF?")
+                print(reply)
+                self.relative_value = float(reply)
+
+            self.set_data_format(self.binary)
         pass
 
     def read_data(self):
-        self.visa.write(":INIT")
-        reply = self.visa.query(":FETC?")
-        self.data = [float(reply)]
+        self.trigger()
+        self.fetch()
         pass
@@ -1,9 +1,7 @@
-import time
+from .voltmeter import Voltmeter
 
-from .sourcemeter import Keithley
 
-
-class K2182(Keithley):
+class K2182(Voltmeter):
     def __init__(self, address):
         super().__init__(address)
         self.name = "Keithley 2182A"
@@ -17,6 +15,7 @@ class K2182(Keithley):
         self.sense_range = 1.
         self.auto_sense_range = False
         self.relative_value = 0.
+        self.a_cal_timeout = 30.0  # s allowed for each step of the ACAL
 
     def description(self):
         """Print a description string to data file"""
@@ -40,6 +39,7 @@ class K2182(Keithley):
         self.data = [0.0]
         self.data_column = 0
         self.sense = "VOLT"
+        self.buffer_count = 1  # *RST leaves a trigger count of one
         
         # Special variables for 2182
         self.channel = channel
@@ -50,52 +50,64 @@ class K2182(Keithley):
         self.sense_range = sense_range
         self.auto_sense_range = auto_sense_range
 
-        # A bunch of commands to configure the 2182
-        self.visa.write("*RST")
-        time.sleep(.1)
-        self.visa.write(":SENS:FUNC \'VOLT\'")
-        self.visa.write(":SENS:CHAN %d" % channel)
-        
-        if auto_sense_range:
-            self.auto_sense_range = True
-            self.visa.write("".join((":SENS:", self.sense, ":RANG:AUTO 1")))
-        else:
-            self.sense_range = sense_range
-            self.auto_sense_range = False
-            self.visa.write("".join((":SENS:", self.sense, ":RANG ", "%.2e" % sense_range)))
+        # A bunch of commands to configure the 2182, merged into as few messages
+        # as possible and finished with *OPC?
+        with self.batch():
+            self.write("*RST")
+            self.write(":SENS:FUNC \'VOLT\'")
+            self.write(":SENS:CHAN %d" % channel)
+
+            if auto_sense_range:
+                self.auto_sense_range = True
+                self.write("".join((":SENS:", self.sense, ":RANG:AUTO 1")))
+            else:
+                self.sense_range = sense_range
+                self.auto_sense_range = False
+                self.write("".join((":SENS:", self.sense, ":RANG ", "%.2e" % sense_range)))
 
-        if a_cal:
-            self.visa.write(":CAL:UNPR:ACAL:INIT")
-            time.sleep(1.0)
-            reply = self.visa.query(":CAL:UNPR:ACAL:TEMP?")
-            time.sleep(10.)
-            self.visa.write(":CAL:UNPR:ACAL:DONE")
+            if a_cal:
+                # The calibration takes several seconds, longer than the VISA timeout
+                old_timeout = self.visa.timeout
+                self.visa.timeout = max(old_timeout, self.a_cal_timeout * 1000)
+                try:
+                    self.write(":CAL:UNPR:ACAL:INIT")
+                    self.query("*OPC?")
+                    reply = self.query(":CAL:UNPR:ACAL:TEMP?")
+                    self.query("*OPC?")
+                    self.write(":CAL:UNPR:ACAL:DONE")
+                finally:
+                    self.visa.timeout = old_timeout
 
-        # Set some filters
-        if a_filter:
-            self.visa.write(":SENS:VOLT:LPAS 1")
-        else:
-            self.visa.write(":SENS:VOLT:LPAS 0")
+            # Set some filters
+            if a_filter:
+                self.write(":SENS:VOLT:LPAS 1")
+            else:
+                self.write(":SENS:VOLT:LPAS 0")
 
-        if d_filter:
-            self.visa.write(":SENS:VOLT:DFIL 1")
-            self.visa.write(":SENS:VOLT:DFIL:COUN %d" % count)
-        else:
-            self.visa.write(":SENS:VOLT:DFIL 0")
+            if d_filter:
+                self.write(":SENS:VOLT:DFIL 1")
+                self.write(":SENS:VOLT:DFIL:COUN %d" % count)
+            else:
+                self.write(":SENS:VOLT:DFIL 0")
 
-        self.visa.query(":READ?")
+            self.query(":READ?")
 
-        self.visa.write(":SENS:VOLT:REF:STAT 0")
-        if relative:
-            self.visa.write(":SENS:VOLT:REF:ACQ")
-            self.visa.write(":SENS:VOLT:REF:STAT 1")
-            reply = self.visa.query(":SENS:VOLT:REF?")
-            print(reply)
-            self.relative_value = float(reply)
+            self.write(":SENS:VOLT:REF:STAT 0")
+            if relative:
+                self.write(":SENS:VOLT:REF:ACQ")
+                self.write(":SENS:VOLT:REF:STAT 1")
+                reply = self.query(":SENS:VOLT:REF?")
+                print(reply)
+                self.relative_value = float(reply)
 
+            self.set_data_format(self.binary)
         pass
 
     def read_data(self):
-        reply = self.visa.query(":READ?")
-        self.data = [float(reply)]
+        if self.buffer_count > 1:
+            self.trigger()
+            self.fetch()
+            return
+        reply = self.read_values(":READ?")
+        self.data = [float(reply[0])]
         pass
@@ -1,11 +1,23 @@
 import time
 
+import numpy as np
+
+from .. import ramp
 from .sourcemeter import Keithley
 
+# Delta measurement modes of the 6221 with a 2182A on the RS-232/Trigger Link connection
+DELTA_MODES = {
+    "DELT": "Delta",
+    "PDEL": "Pulse Delta",
+    "DCON": "Differential Conductance",
+}
+
 
 class K6221(Keithley):
     # The 6221 operates only as a source, these functions configure it as an AC source (WAVE mode)
-    # and the measurement is made by the Lockin
+    # and the measurement is made by the Lockin.
+    # initialize_delta configures it instead to run Delta, Pulse Delta or Differential
+    # Conductance with a 2182A, the pair then buffer the readings of a whole sweep
 
     def __init__(self, address):
         super().__init__(address)
@@ -39,16 +51,39 @@ class K6221(Keithley):
         self.data_column = 0
         self.data = [self.amplitude]  # Amperes
 
+        self.mode = "WAVE"  # or one of DELTA_MODES
+        self.source_list_size = 1000  # sweep points run and buffered at a time in the delta modes
+        self.nv_range = 0.1  # 2182A range and integration time in the delta modes
+        self.nplc = 1.0
+        self.delay = 2e-3  # delay between a current step and the 2182A reading
+        self.pulse_width = 110e-6  # Pulse Delta
+        self.pulse_interval = 5  # Pulse Delta, power line cycles between pulses
+        self.delta = 1e-6  # Differential Conductance modulation step
+        self.delta_timeout_margin = 10.0  # s allowed beyond the expected run time
+
     def description(self):
         """ Print a description string to data file"""
 
         description_string = (
             f"{super().description()}, "
+            f"mode={self.mode}, "
             f"amplitude={self.amplitude}, "
             f"frequency={self.frequency}, "
             f"compliance={self.compliance}"
             "\n"
         )
+        if self.mode in DELTA_MODES:
+            description_string = (
+                f"{super().description()}, "
+                f"mode={DELTA_MODES[self.mode]}, "
+                f"2182A range={self.nv_range}, "
+                f"nplc={self.nplc}, "
+                f"delay={self.delay}, "
+                f"pulse width={self.pulse_width}, "
+                f"pulse interval={self.pulse_interval}, "
+                f"delta={self.delta}"
+                "\n"
+            )
         return description_string
 
     def initialize(
@@ -59,6 +94,8 @@ class K6221(Keithley):
         self.column_names = "I (A)"
         self.data_column = 0
         self.source = "CURR"
+        self.mode = "WAVE"
+        self.data = [self.amplitude]
 
         # A bunch of commands to configure the 6221
         if not self.output:
@@ -67,34 +104,223 @@ class K6221(Keithley):
             self.frequency = frequency
             self.offset = offset
             self.phase = phase
-            self.visa.write("*RST")
-            time.sleep(.1)
+            # Merged into as few messages as possible and finished with *OPC?
+            with self.batch():
+                self.write("*RST")
 
-            self.visa.write(":SOUR:WAVE:FUNC SIN")
-            if auto_sense_range:
-                self.visa.write(":SOUR:WAVE:RANG BEST")
-            else:
-                self.visa.write(":SOUR:WAVE:RANG FIX")
+                self.write(":SOUR:WAVE:FUNC SIN")
+                if auto_sense_range:
+                    self.write(":SOUR:WAVE:RANG BEST")
+                else:
+                    self.write(":SOUR:WAVE:RANG FIX")
 
-            self.visa.write(":TRIG:OLIN 4")
-            self.visa.write(f":SOUR:WAVE:PMAR:OLIN {self.trigger_pin}")
-            self.visa.write(":SOUR:WAVE:PMAR:STAT ON")
-            self.visa.write(f":SOUR:WAVE:PMAR {self.phase:.1f}")
+                self.write(":TRIG:OLIN 4")
+                self.write(f":SOUR:WAVE:PMAR:OLIN {self.trigger_pin}")
+                self.write(":SOUR:WAVE:PMAR:STAT ON")
+                self.write(f":SOUR:WAVE:PMAR {self.phase:.1f}")
 
-            self.visa.write(f":SOUR:CURR:COMP {self.compliance:.3e}")
-            self.visa.write(f":SOUR:WAVE:FREQ {self.frequency:.3e}")
-            self.visa.write(f":SOUR:WAVE:OFFS {self.offset:.3e}")
-            self.visa.write(f":SOUR:WAVE:AMPL {self.ramp_step:.3e}%")
+                self.write(f":SOUR:CURR:COMP {self.compliance:.3e}")
+                self.write(f":SOUR:WAVE:FREQ {self.frequency:.3e}")
+                self.write(f":SOUR:WAVE:OFFS {self.offset:.3e}")
+                self.write(f":SOUR:WAVE:AMPL {self.ramp_step:.3e}%")
 
         return
 
+    def initialize_delta(
+            self, mode="DELT", compliance=0.1, nv_range=0.1, nplc=1.0, delay=2e-3,
+            pulse_width=110e-6, pulse_interval=5, delta=1e-6, binary=False
+    ):
+        """Configure the 6221 and, over the serial link, the 2182A for Delta (DELT),
+        Pulse Delta (PDEL) or Differential Conductance (DCON). The sweep is then run
+        by source_list_sweep, the data are I and the 2182A reading, V for Delta and
+        Pulse Delta and dV/dI for Differential Conductance
+        """
+
+        if mode not in DELTA_MODES:
+            raise ValueError(f"mode must be one of {', '.join(DELTA_MODES)}, not {mode}")
+
+        self.mode = mode
+        self.compliance = compliance
+        self.nv_range = nv_range
+        self.nplc = nplc
+        self.delay = delay
+        self.pulse_width = pulse_width
+        self.pulse_interval = pulse_interval
+        self.delta = delta
+        self.output = False
+
+        self.source_column = 0
+        self.data_column = 1
+        if mode == "DCON":
+            self.column_names = "I (A),dV/dI (Ohm)"
+        else:
+            self.column_names = "I (A),V (V)"
+        self.data = [0.0, 0.0]
+
+        with self.batch():
+            self.write("*RST")
+            self.write(":SOUR:SWE:ABOR")
+            self.write(f":SOUR:CURR:COMP {compliance:.3e}")
+
+            # The 2182A is set up through the 6221
+            for command in ("*RST", f":SENS:VOLT:RANG {nv_range:.3e}", f":SENS:VOLT:NPLC {nplc:.2f}"):
+                self.write(f':SYST:COMM:SER:SEND "{command}"')
+
+            # Return each reading with its source value
+            self.write(":FORM:ELEM READ,SOUR")
+            if mode == "DCON":
+                self.write(":UNIT OHMS")
+                self.write(f":SOUR:DCON:DELT {delta:.4e}")
+                self.write(f":SOUR:DCON:DEL {delay:.4e}")
+                self.write(":SOUR:DCON:CAB ON")
+            elif mode == "PDEL":
+                self.write(":UNIT V")
+                self.write(":SOUR:PDEL:LOW 0")
+                self.write(f":SOUR:PDEL:WIDT {pulse_width:.4e}")
+                self.write(f":SOUR:PDEL:SDEL {delay:.4e}")
+                self.write(f":SOUR:PDEL:INT {pulse_interval:d}")
+                self.write(":SOUR:PDEL:RANG BEST")
+                self.write(":SOUR:PDEL:LME 2")
+                self.write(":SOUR:PDEL:SWE ON")
+                self.write(":SOUR:SWE:SPAC LIST")
+                self.write(":SOUR:SWE:RANG BEST")
+                self.write(":SOUR:SWE:COUN 1")
+            else:
+                self.write(":UNIT V")
+                self.write(f":SOUR:DELT:DEL {delay:.4e}")
+                self.write(":SOUR:DELT:CAB ON")
+
+            self.set_data_format(binary)
+
+        if not int(self.query(":SOUR:DELT:NVPR?")):
+            raise RuntimeError(f"{self.name}: no 2182A found on the serial link")
+        pass
+
+    @property
+    def supports_source_list(self):
+        """Sweeps run in hardware only in the delta modes"""
+
+        return self.mode in DELTA_MODES
+
+    def source_list_sweep(self, values, sample=1, delay=0.0):
+        """Run a sweep in the delta mode and yield the readings point by point
+
+        Like Keithley.source_list_sweep every value is yielded as (value, readings, times)
+        with one row of I, V per sample. Pulse Delta runs the values as a source list,
+        Differential Conductance as a staircase (the values must be evenly spaced and
+        every step is read once), Delta runs sample readings at every value.
+        The delay between points is set by initialize_delta
+        """
+
+        if self.mode not in DELTA_MODES:
+            raise ValueError(f"{self.name} runs sweeps only in the delta modes, call initialize_delta")
+
+        values = np.asarray(values, dtype=float)
+        if self.mode == "DCON":
+            steps = np.diff(values)
+            if len(values) < 2 or not np.allclose(steps, steps[0]):
+                raise ValueError("Differential Conductance sweeps need evenly spaced values")
+            points_per_chunk = len(values)
+        elif self.mode == "PDEL":
+            points_per_chunk = max(self.source_list_size // sample, 1)
+        else:
+            points_per_chunk = 1
+
+        try:
+            for chunk_start in range(0, len(values), points_per_chunk):
+                chunk = values[chunk_start:chunk_start + points_per_chunk]
+                readings, times = self.run_delta(chunk, sample)
+
+                rows = len(readings) // len(chunk)
+                for k, v in enumerate(chunk):
+                    yield v, readings[k * rows:(k + 1) * rows], times[k * rows:(k + 1) * rows]
+                self.amplitude = chunk[-1]
+                self.data = [float(i) for i in readings[-1]]
+        finally:
+            self.visa.write(":SOUR:SWE:ABOR")
+
+    def run_delta(self, values, sample):
+        """Arm the delta mode for values, run it and return the buffered readings as
+        rows of I, V and their start and end time.perf_counter_ns
+        """
+
+        if self.mode == "DCON":
+            count = len(values)
+        else:
+            count = len(values) * sample
+
+        with self.batch():
+            self.write(":TRAC:CLE")
+            self.write(f":TRAC:POIN {count:d}")
+            if self.mode == "DCON":
+                self.write(f":SOUR:DCON:STAR {values[0]:.4e}")
+                self.write(f":SOUR:DCON:STEP {values[1] - values[0]:.4e}")
+                self.write(f":SOUR:DCON:STOP {values[-1]:.4e}")
+            elif self.mode == "PDEL":
+                source_list = np.repeat(values, sample)
+                for i in range(0, len(source_list), 100):
+                    header = ":SOUR:LIST:CURR:APP" if i else ":SOUR:LIST:CURR"
+                    self.write(f"{header} " + ",".join(f"{v:.4e}" for v in source_list[i:i + 100]))
+            else:
+                self.write(f":SOUR:DELT:HIGH {values[0]:.4e}")
+                self.write(f":SOUR:DELT:COUN {count:d}")
+            self.write(f":SOUR:{self.mode}:ARM")
+        self.visa.write(":INIT:IMM")
+        start_ns = time.perf_counter_ns()
+
+        # Wait for the buffer to fill, one short query at a time. A point takes up
+        # to 3 conversions of nplc power line cycles (50 Hz) and the delay, a pulse
+        # also waits pulse_interval cycles
+        point_time = 3 * self.nplc / 50.0 + self.delay
+        if self.mode == "PDEL":
+            point_time += self.pulse_interval / 50.0
+        deadline = time.monotonic() + count * point_time + self.delta_timeout_margin
+        while int(self.visa.query(":TRAC:POIN:ACT?")) < count:
+            if time.monotonic() > deadline:
+                self.visa.write(":SOUR:SWE:ABOR")
+                raise RuntimeError(f"{self.name}: the delta sweep did not finish, check the trigger link to the 2182A")
+            time.sleep(0.05)
+        end_ns = time.perf_counter_ns()
+
+        readings = self.read_values(":TRAC:DATA?").reshape(-1, 2)
+        self.visa.write(":SOUR:SWE:ABOR")
+        return readings[:, ::-1], self.reading_times(start_ns, end_ns, len(readings), self.delay)
+
     def set_output(self, level):
+        if self.mode in DELTA_MODES:
+            # The current is only applied while a delta sweep runs
+            self.amplitude = level
+            self.data[0] = level
+            return
         self.visa.write(f":SOUR:WAVE:AMPL {level:.4e}")
         pass
 
+    def read_data(self):
+        # Nothing is measured in WAVE mode, the data is the amplitude. In the delta
+        # modes the data are the last readings of the sweep
+        if self.mode in DELTA_MODES:
+            self.data[0] = self.amplitude
+            return
+        self.data = [self.amplitude]
+        pass
+
+    def trigger(self):
+        pass
+
+    def fetch(self):
+        self.read_data()
+        pass
+
+    def set_bus_trigger(self, enable=True):
+        pass
+
     def switch_output(self):
         self.output = not self.output
-        if self.output:
+        if self.mode in DELTA_MODES:
+            # Armed and run by source_list_sweep, switching off aborts the sweep
+            if not self.output:
+                self.visa.write(":SOUR:SWE:ABOR")
+        elif self.output:
             self.visa.write(":SOUR:WAVE:ARM")
             self.visa.write(":SOUR:WAVE:INIT")
         else:
@@ -102,7 +328,14 @@ class K6221(Keithley):
 
         pass
 
-    def ramp(self, v_finish):
+    def start_ramp(self, v_finish, rate=None):
+        """The AC amplitude is stepped straight to v_finish with the wave stopped,
+        so the returned task is already complete
+        """
+        if self.mode in DELTA_MODES:
+            self.set_output(v_finish)
+            return ramp.RampTask(ramp.no_ramp, self.amplitude)
+
         v_start = self.amplitude
         if abs(v_start - v_finish) > self.ramp_step:
 
@@ -115,4 +348,4 @@ class K6221(Keithley):
             self.amplitude = v_finish
             self.data[0] = v_finish
 
-        return
+        return ramp.RampTask(ramp.no_ramp, self.amplitude)
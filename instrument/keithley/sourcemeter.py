@@ -2,6 +2,7 @@ import time
 
 import numpy as np
 
+from .. import ramp
 from ..generic_instrument import Instrument
 
 
@@ -11,6 +12,10 @@ class Keithley(Instrument):
 
     initialize
     ramp
+    source_list_sweep
+    set_data_format
+    trigger
+    fetch
 
     """
     def __init__(self, address):
@@ -23,10 +28,14 @@ class Keithley(Instrument):
         self.source = ""
         self.sense = ""
         self.compliance = 0
-        self.ramp_step = 0
+        self.ramp_step = None  # set by initialize, the meters have no output
         self.source_range = 0
         self.sense_range = 0
         self.output = False
+        self.source_list_size = 100  # points held in the source memory list
+        self.binary = False  # transfer readings as little endian 32 bit floats
+        self.hardware_ramp = True  # ramp from the source list instead of Python steps
+        self.bus_trigger_layer = "ARM"  # trigger model layer that waits for a bus trigger
 
     def description(self):
         """ Print a description string to data file"""
@@ -42,7 +51,7 @@ class Keithley(Instrument):
 
     def initialize(
             self, mode="VOLT", source_range=21, sense_range=105e-9, compliance=105e-9,
-            ramp_step=0.1, auto_sense_range=False, reset=True
+            ramp_step=0.1, ramp_rate=None, auto_sense_range=False, reset=True
     ):
         """Initialize Keithley sourcemeter with specified mode, and other parameters"""
 
@@ -65,34 +74,49 @@ class Keithley(Instrument):
         self.source_range = source_range
         self.sense_range = sense_range
         self.ramp_step = ramp_step
+        self.ramp_rate = ramp_rate
         self.data = [0.0, 0.0]
 
+        # Skip the reset if the instrument is still configured as requested
+        fingerprint = (
+            f"{self.source},{self.source_range:.2e},{self.sense_range:.2e},"
+            f"{compliance:.3e},{auto_sense_range},{self.binary}"
+        )
+        if reset and self.state.get("fingerprint") == fingerprint and self.check_configured():
+            print(f"{self.name} is already configured, skipping reset")
+            reset = False
+
         if reset:
             self.output = False
-            self.visa.write(":OUTP 0")
-            self.visa.write("*RST")
-            self.visa.write(":SYST:BEEP:STAT 0")
-            time.sleep(.1)
-
-            self.visa.write(f":SOUR:FUNC:MODE {self.source}")
-            self.visa.write(f":SOUR:{self.source}:RANG {self.source_range:.2e}")
-            if auto_sense_range:
-                self.visa.write(":SENS:CURR:RANG:AUTO 0")
-            else:
-                self.visa.write(f":SENS:{self.sense}:RANG {self.sense_range:.2e}")
-            
             self.compliance = compliance
-            self.visa.write(f":SENS:{self.sense}:PROT:LEV {self.compliance:.3e}")
 
-            # Configure the auto zero (reference)
-            self.visa.write(":SYST:AZER:STAT ON")
-            self.visa.write(":SYST:AZER:CACH:STAT 1")
-            self.visa.write(":SYST:AZER:CACH:RES")
+            # Send the configuration in as few messages as possible and wait for it with *OPC?
+            with self.batch():
+                self.write(":OUTP 0")
+                self.write("*RST")
+                self.write(":SYST:BEEP:STAT 0")
+
+                self.write(f":SOUR:FUNC:MODE {self.source}")
+                self.write(f":SOUR:{self.source}:RANG {self.source_range:.2e}")
+                if auto_sense_range:
+                    self.write(":SENS:CURR:RANG:AUTO 0")
+                else:
+                    self.write(f":SENS:{self.sense}:RANG {self.sense_range:.2e}")
+
+                self.write(f":SENS:{self.sense}:PROT:LEV {self.compliance:.3e}")
+
+                # Configure the auto zero (reference)
+                self.write(":SYST:AZER:STAT ON")
+                self.write(":SYST:AZER:CACH:STAT 1")
+                self.write(":SYST:AZER:CACH:RES")
+
+                # Disable concurrent mode, measure I and V (not R)
+                self.write(":SENS:FUNC:CONC 1")
+                self.write(":SENS:FUNC:ON \"VOLT\",\"CURR\"")
+                self.write(":FORM:ELEM VOLT,CURR")
+                self.set_data_format(self.binary)
 
-            # Disable concurrent mode, measure I and V (not R)
-            self.visa.write(":SENS:FUNC:CONC 1")
-            self.visa.write(":SENS:FUNC:ON \"VOLT\",\"CURR\"")
-            self.visa.write(":FORM:ELEM VOLT,CURR")
+            self.state["fingerprint"] = fingerprint
 
         else:
             self.output = bool(int(self.visa.query(":OUTP:STAT?")))
@@ -101,18 +125,60 @@ class Keithley(Instrument):
 
         return
 
+    def check_configured(self):
+        """Check with one query that the instrument has not been reset since it was configured"""
+
+        reply = self.query(":SOUR:FUNC:MODE?;:SYST:BEEP:STAT?").strip().split(";")
+        return reply[0].upper().startswith(self.source) and int(reply[1]) == 0
+
     def read_numeric(self, command):
         reply = self.visa.query(command)
         answer = float(reply)
         return answer
 
+    def set_data_format(self, binary=True):
+        """Select the data transfer format, either ASCII or single precision binary"""
+
+        self.binary = binary
+        if self.binary:
+            self.write(":FORM:DATA REAL,32")
+            self.write(":FORM:BORD SWAP")
+        else:
+            self.write(":FORM:DATA ASC")
+        pass
+
+    def read_values(self, command):
+        """Query a list of readings and decode it into a numpy array"""
+
+        if self.binary:
+            return self.visa.query_binary_values(
+                command, datatype="f", is_big_endian=False, container=np.array
+            )
+        reply = self.visa.query(command)
+        return np.array([float(i) for i in reply.split(",")])
+
     def read_data(self):
-        reply = self.visa.query(":READ?")
-        self.data = [float(i) for i in reply.split(",")[0:2]]
+        reply = self.read_values(":READ?")
+        self.data = [float(i) for i in reply[0:2]]
+        pass
+
+    def trigger(self):
+        self.visa.write(":INIT")
+        pass
+
+    def fetch(self):
+        reply = self.read_values(":FETC?")
+        self.data = [float(i) for i in reply[0:len(self.data)]]
+        pass
+
+    def set_bus_trigger(self, enable=True):
+        self.bus_trigger = enable
+        source = "BUS" if enable else "IMM"
+        self.visa.write(f":{self.bus_trigger_layer}:SOUR {source}")
         pass
 
     def set_output(self, level):
-        self.visa.write(f":SOUR:{self.source} {level:.4e}")
+        self.write_setting(f":SOUR:{self.source}", f"{level:.4e}")
         pass
 
     def switch_output(self):
@@ -120,21 +186,125 @@ class Keithley(Instrument):
         self.visa.write(f":OUTP:STAT {self.output:d}")
         pass
 
-    def ramp(self, finish_value):
-        """A method to ramp the instrument"""
+    @property
+    def supports_source_list(self):
+        """True if source_list_sweep can run a sweep in the present configuration"""
+
+        return True
+
+    def source_list_sweep(self, values, sample=1, delay=0.0):
+        """Run a sweep from the source memory list and yield the readings point by point
+
+        The values are loaded into the source list in chunks of up to source_list_size
+        triggers. The instrument steps through each chunk with its own trigger model,
+        buffers the readings and returns them with a single :READ?. Every value is
+        measured sample times and yielded as (value, readings, times) where readings
+        has one row of V, I per sample and times the start and end time.perf_counter_ns
+        of each reading.
+        """
+        values = np.asarray(values, dtype=float)
+        points_per_chunk = max(self.source_list_size // sample, 1)
+
+        if not self.output:
+            self.switch_output()
+
+        old_timeout = self.visa.timeout
+        self.visa.write(f":SOUR:DEL {delay:.4e}")
+        try:
+            for chunk_start in range(0, len(values), points_per_chunk):
+                chunk = values[chunk_start:chunk_start + points_per_chunk]
+                source_list = np.repeat(chunk, sample)
+
+                self.visa.write(f":SOUR:{self.source}:MODE LIST")
+                self.visa.write(f":SOUR:LIST:{self.source} " + ",".join(f"{v:.4e}" for v in source_list))
+                self.visa.write(f":TRIG:COUN {len(source_list):d}")
+
+                # Leave enough time for the instrument to run the whole list
+                self.visa.timeout = max(old_timeout, 1000 * len(source_list) * (delay + 0.1) + 10000)
+                start_ns = time.perf_counter_ns()
+                readings = self.read_values(":READ?").reshape(-1, 2)
+                times = self.reading_times(start_ns, time.perf_counter_ns(), len(readings), delay)
+
+                for k, v in enumerate(chunk):
+                    yield v, readings[k * sample:(k + 1) * sample], times[k * sample:(k + 1) * sample]
+        finally:
+            self.visa.timeout = old_timeout
+            self.fix_source(values[-1])
+
+    def reading_times(self, start_ns, end_ns, count, delay):
+        """The start and end timestamps of count readings taken one after the other
+        between start_ns and end_ns, each after a source delay of delay seconds
+        """
+
+        step = (end_ns - start_ns) / max(count, 1)
+        starts = start_ns + step * np.arange(count)
+        times = np.column_stack((starts + min(delay * 1e9, step), starts + step))
+        return times.astype(np.int64)
+
+    def fix_source(self, level):
+        """Park the source at level and go back to the fixed single point mode"""
+
+        self.visa.write(f":SOUR:{self.source} {level:.4e}")
+        self.state[f":SOUR:{self.source}"] = f"{level:.4e}"
+        self.visa.write(f":SOUR:{self.source}:MODE FIX")
+        self.visa.write(":TRIG:COUN 1")
+        self.visa.write(":SOUR:DEL:AUTO ON")
+        self.read_data()
+        pass
+
+    def read_source(self):
         if self.output:
             self.read_data()
-        start_value = self.data[self.source_column]
-        if abs(start_value - finish_value) > self.ramp_step:
-            step_num = abs((finish_value - start_value) / self.ramp_step)
-            sweep_value = np.linspace(start_value, finish_value, num=np.ceil(int(step_num)), endpoint=True)
+        return self.data[self.source_column]
 
-            if not self.output:
+    def run_ramp(self, task, values, rate):
+        """Ramp through values, stepping the source list in hardware if hardware_ramp"""
+
+        if not self.output:
+            with self.bus_lock:
                 self.switch_output()
 
-            for i in range(len(sweep_value)):
-                self.set_output(sweep_value[i])
-                time.sleep(0.01)
+        if not self.hardware_ramp:
+            try:
+                return super().run_ramp(task, values, rate)
+            finally:
+                with self.bus_lock:
+                    self.read_data()
 
-            self.read_data()
-        return
+        # The instrument steps through each list with a source delay of step_time.
+        # Nothing is measured during the ramp, so a point takes just the delay
+        step_time = abs(values[1] - values[0]) / rate
+        old_timeout = self.visa.timeout
+        level = values[0]
+        with self.bus_lock:
+            self.visa.write(":SENS:FUNC:OFF:ALL")
+            self.visa.write(f":SOUR:DEL {step_time:.4e}")
+        try:
+            for chunk_start in range(1, len(values), self.source_list_size):
+                chunk = values[chunk_start:chunk_start + self.source_list_size]
+                with self.bus_lock:
+                    self.visa.write(f":SOUR:{self.source}:MODE LIST")
+                    self.visa.write(f":SOUR:LIST:{self.source} " + ",".join(f"{v:.4e}" for v in chunk))
+                    self.visa.write(f":TRIG:COUN {len(chunk):d}")
+                    self.visa.write(":INIT")
+                chunk_time = time.monotonic()
+
+                # Leave the bus to the other ramps while the list runs
+                if task.wait_until(chunk_time + len(chunk) * step_time):
+                    with self.bus_lock:
+                        self.visa.write(":ABOR")
+                    done = int((time.monotonic() - chunk_time) / step_time)
+                    level = chunk[min(done, len(chunk) - 1)]
+                    raise ramp.RampCancelled(f"Ramp cancelled at {level:.4e}")
+
+                with self.bus_lock:
+                    self.visa.timeout = max(old_timeout, 1000 * len(chunk) * step_time + 10000)
+                    self.visa.query("*OPC?")
+                    self.visa.timeout = old_timeout
+                level = chunk[-1]
+        finally:
+            with self.bus_lock:
+                self.visa.timeout = old_timeout
+                self.visa.write(":SENS:FUNC:ON \"VOLT\",\"CURR\"")
+                self.fix_source(level)
+        return level
@@ -0,0 +1,81 @@
+import numpy as np
+
+from .sourcemeter import Keithley
+
+
+class Voltmeter(Keithley):
+    """Buffered readings for the keithley voltmeters k2182 and k2002
+    Based on the Keithley class, add the following methods:
+
+    set_buffer
+    fetch_buffer
+
+    """
+    def __init__(self, address):
+        super().__init__(address)
+        self.bus_trigger_layer = "TRIG"
+        self.trace_feed = "SENS"  # reading stored in the trace buffer
+        self.nplc_header = ":SENS:VOLT:NPLC"
+        self.nplc = None
+        self.buffer_mean = 0.0  # CALC2 statistics of the last buffered fetch
+        self.buffer_std = 0.0
+
+    def set_buffer(self, count, nplc=None):
+        """Take count readings into the trace buffer on every trigger, fetch then
+        returns them all in buffer_data with the on-instrument mean and standard
+        deviation. count=1 goes back to single readings
+        """
+
+        self.buffer_count = count
+        self.buffer_data = None
+        with self.batch():
+            if nplc is not None:
+                self.nplc = nplc
+                self.write(f"{self.nplc_header} {nplc:.2f}")
+            self.write(f":TRIG:COUN {count:d}")
+            self.write(":TRAC:CLE")
+            if count > 1:
+                self.write(f":TRAC:POIN {count:d}")
+                self.write(f":TRAC:FEED {self.trace_feed}")
+                self.write(":CALC2:FORM MEAN")
+                self.write(":CALC2:STAT ON")
+        pass
+
+    def trigger(self):
+        if self.buffer_count > 1:
+            # The buffer stops filling once full, arm it again for every trigger
+            self.visa.write(":TRAC:CLE;:TRAC:FEED:CONT NEXT;:INIT")
+        else:
+            self.visa.write(":INIT")
+        pass
+
+    def fetch(self):
+        if self.buffer_count > 1:
+            self.fetch_buffer()
+            return
+        super().fetch()
+        pass
+
+    def fetch_buffer(self):
+        """Read the trace buffer and its CALC2 mean and standard deviation, *WAI
+        holds the reply until all the readings are taken. In ASCII this is one
+        query, binary blocks cannot share a reply so it takes three
+        """
+
+        if self.binary:
+            readings = self.read_values("*WAI;:TRAC:DATA?")
+            mean = self.read_values(":CALC2:FORM MEAN;:CALC2:IMM?")[0]
+            std = self.read_values(":CALC2:FORM SDEV;:CALC2:IMM?")[0]
+        else:
+            reply = self.visa.query(
+                "*WAI;:TRAC:DATA?;:CALC2:FORM MEAN;:CALC2:IMM?;:CALC2:FORM SDEV;:CALC2:IMM?"
+            ).strip().split(";")
+            readings = np.array([float(i) for i in reply[0].split(",")])
+            mean, std = float(reply[1]), float(reply[2])
+
+        # One row per reading with a value for each data column
+        self.buffer_data = readings.reshape(-1, len(self.data))[0:self.buffer_count]
+        self.buffer_mean = float(mean)
+        self.buffer_std = float(std)
+        self.data = [self.buffer_mean]
+        pass
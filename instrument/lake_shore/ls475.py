@@ -1,11 +1,19 @@
+import queue
+import threading
 import time
 
+import numpy as np
+
+from .. import ramp
 from ..generic_instrument import Instrument
 
 
 class LS475Gaussmeter(Instrument):
     """Lake Shore Model 475 DSP Gaussmeter driver
 
+    The field is set with the gaussmeter's own control loop, a ramp sets the setpoint
+    and returns once the measured field is within tolerance of it. start_stream polls
+    the field on a background thread so that reads during a sweep cost no bus time.
     """
 
     def __init__(self, address):
@@ -22,31 +30,128 @@ class LS475Gaussmeter(Instrument):
 
         self.output = False
 
+        self.tolerance = 1.0  # G, a ramp is finished when the field is this close
+        self.poll_interval = 0.05  # s between field readings while ramping
+        self.settle_timeout = 120.0  # s
+
+        self.stream_rate = 0.0
+        self.stream_queue = None
+        self.stream_thread = None
+        self.stream_stop = threading.Event()
+        self.stream_field = 0.0  # latest streamed reading
+
     def initialize(self):
         self.visa.write("UNIT 1")
         self.visa.write("CMODE 1")
         self.visa.write("CPARAM 15.0, 5.0, 3000.0, 40.0 ")
         pass
 
+    def read_field(self):
+        """The present field, the latest streamed reading while streaming"""
+
+        if self.stream_thread is not None:
+            return self.stream_field
+        with self.bus_lock:
+            return float(self.visa.query("RDGFIELD?"))
+
     def read_data(self):
         """ Read magnetic field """
-        reply = self.visa.ask(":RDGFIELD?")
-        self.data = [reply]
+        self.data = [self.read_field()]
         pass
 
-    def set_output(self, level):
-        self.visa.write(f"CSETP {level:.4e}")
-        time.sleep(4.0)
-        pass
+    def read_source(self):
+        with self.bus_lock:
+            return float(self.visa.query("CSETP?"))
+
+    def set_output(self, level, task=None):
+        """Set the control setpoint and return once the field is within tolerance"""
+
+        with self.bus_lock:
+            self.visa.write(f"CSETP {level:.4e}")
+        return self.wait_for_field(level, task)
 
     def switch_output(self):
         self.output = not self.output
         pass
 
-    def ramp(self, finish_value):
-        time1 = float(self.visa.ask(":RDGFIELD?"))
-        time2 = 4 * abs(finish_value - time1) / 50
-        self.set_output(finish_value)
-        print("Ramping to Field Value")
-        time.sleep(time2)
-        return
+    def start_ramp(self, finish_value, rate=None):
+        """Set the control setpoint and wait on a background thread until the field
+        is within tolerance, the gaussmeter controls its own rate
+        """
+        return ramp.RampTask(self.run_ramp, finish_value)
+
+    def run_ramp(self, task, finish_value):
+        return self.set_output(finish_value, task)
+
+    def wait_for_field(self, level, task=None):
+        """Poll the field until it is within tolerance of level and return it, the
+        ramp task can cancel the wait
+        """
+
+        deadline = time.monotonic() + self.settle_timeout
+        while True:
+            self.read_data()
+            if abs(self.data[0] - level) <= self.tolerance:
+                return self.data[0]
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{self.name}: field {self.data[0]:.2f} G did not reach {level:.2f} G")
+            if task is None:
+                time.sleep(self.poll_interval)
+            elif task.wait_until(time.monotonic() + self.poll_interval):
+                raise ramp.RampCancelled(f"Ramp cancelled at {self.data[0]:.4e}")
+
+    def start_stream(self, rate=20.0):
+        """Poll the field at rate (Hz) on a background thread and queue the readings
+        with columns t (s, time.perf_counter), B
+        """
+
+        self.stream_rate = rate
+        self.stream_field = self.read_field()
+        self.stream_queue = queue.Queue()
+        self.stream_stop.clear()
+        self.stream_thread = threading.Thread(target=self._stream_worker, args=(1.0 / rate,), daemon=True)
+        self.stream_thread.start()
+        pass
+
+    def read_stream(self, timeout=None):
+        """Return all the queued readings as one array, waiting up to timeout
+        seconds for the first one
+        """
+
+        readings = []
+        try:
+            readings.append(self.stream_queue.get(timeout=timeout))
+            while True:
+                readings.append(self.stream_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        if not readings:
+            return np.empty((0, 2))
+        block = np.array(readings)
+        self.data = [block[-1, 1]]
+        return block
+
+    def stop_stream(self):
+        """Stop the background thread"""
+
+        self.stream_stop.set()
+        if self.stream_thread is not None:
+            self.stream_thread.join()
+            self.stream_thread = None
+        pass
+
+    def _stream_worker(self, period):
+        """Read the field every period seconds until stop_stream is called, a late
+        reading does not make the next ones come early
+        """
+
+        next_time = time.perf_counter()
+        while not self.stream_stop.wait(max(next_time - time.perf_counter(), 0.0)):
+            with self.bus_lock:
+                field = float(self.visa.query("RDGFIELD?"))
+            now = time.perf_counter()
+            self.stream_field = field
+            self.stream_queue.put((now, field))
+            next_time = max(next_time + period, now)
+        pass
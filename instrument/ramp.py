@@ -0,0 +1,91 @@
+"""Rate based ramps for sourceable instruments
+
+A ramp takes the output of an instrument from its present value to a target at a
+fixed slew rate (units per second), in steps no larger than the instrument ramp_step.
+The steps are scheduled against time.monotonic so the ramp time is set by the rate
+and not by the loop overhead. Ramps run on a background thread and are returned
+as a RampTask which can be cancelled and waited on.
+"""
+
+import contextlib
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class RampCancelled(Exception):
+    """Raised by RampTask.result when the ramp was cancelled"""
+
+
+class RampTask:
+    """Run target(task, *args) on a background thread
+
+    The future is completed with the value returned by target, the final output of the ramp.
+    """
+
+    def __init__(self, target, *args):
+        self.future = Future()
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(target, args), daemon=True)
+        self.thread.start()
+
+    def _run(self, target, args):
+        try:
+            self.future.set_result(target(self, *args))
+        except Exception as e:
+            self.future.set_exception(e)
+
+    def cancel(self):
+        """Ask the ramp to stop at the next step"""
+
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def wait_until(self, deadline):
+        """Sleep until the monotonic deadline, return True if the ramp was cancelled"""
+
+        return self.cancel_event.wait(max(deadline - time.monotonic(), 0.0))
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        """Wait for the ramp and return the final output value"""
+
+        return self.future.result(timeout)
+
+
+def ramp_values(start, finish, max_step):
+    """The output values of a ramp from start to finish with steps <= max_step"""
+
+    num = int(np.ceil(abs(finish - start) / max_step)) + 1
+    return np.linspace(start, finish, num=max(num, 2), endpoint=True)
+
+
+def no_ramp(task, value):
+    """Target for a ramp that has nothing to do"""
+
+    return value
+
+
+def step_ramp(task, set_output, values, rate, lock=None):
+    """Step through values calling set_output so that the output changes at rate,
+    each call is made holding lock
+    """
+
+    if lock is None:
+        lock = contextlib.nullcontext()
+
+    step_time = abs(values[1] - values[0]) / rate
+    start_time = time.monotonic()
+    for i in range(1, len(values)):
+        if task.wait_until(start_time + i * step_time):
+            raise RampCancelled(f"Ramp cancelled at {values[i - 1]:.4e}")
+        with lock:
+            set_output(values[i])
+    return values[-1]
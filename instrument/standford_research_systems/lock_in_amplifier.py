@@ -1,9 +1,17 @@
+import queue
+import threading
 import time
 
 import numpy as np
 
 from ..generic_instrument import Instrument
 
+# Full scale of the sensitivity codes 0 (2 nV) ... 26 (1 V)
+SENSITIVITIES = np.array([[2e-9, 5e-9, 1e-8][i % 3] * 10**(i // 3) for i in range(27)])
+
+# Time constant of the OFLT codes 0 (10 us) ... 19 (30 ks) in seconds
+TIME_CONSTANTS = np.array([[1e-5, 3e-5][i % 2] * 10**(i // 2) for i in range(20)])
+
 
 class LockInAmplifier(Instrument):
 	"""Implement a generic lock-in amplifier class"""
@@ -32,6 +40,26 @@ class LockInAmplifier(Instrument):
 		self.output = True
 		self.auto_range = False
 
+		# Auto range keeps R between range_low and range_high of full scale, a new range
+		# puts R below range_target. Readings taken before the output settles on the
+		# new range, settle_tau time constants, are discarded
+		self.range_low = 0.01
+		self.range_high = 0.9
+		self.range_target = 0.8
+		self.settle_tau = 5.0
+		self.max_range_changes = 4
+
+		# Buffer transfer format: "TRCB" IEEE floats, "TRCL" compact floats or "TRCA" ASCII
+		self.buffer_format = "TRCB"
+		self.buffer_size = 16383  # points per channel in the storage buffer
+		self.fast_transfer = False  # True if the model supports FAST streaming
+
+		# Streaming acquisition
+		self.stream_rate = 0.0
+		self.stream_queue = None
+		self.stream_thread = None
+		self.stream_stop = threading.Event()
+
 	def description(self):
 		"""Print a description string to data file"""
 
@@ -47,15 +75,17 @@ class LockInAmplifier(Instrument):
 		return description_string
 
 	def initialize(self, auto_range=False):
-		"""Initialization for the LIA consists of reading the measurement parameters"""
-
-		self.excitation = self.read_numeric("SLVL")
-		self.frequency = self.read_numeric("FREQ")
-		self.harmonic = self.read_numeric("HARM")
-		self.sensitivity = int(self.read_numeric("SENS"))
-		self.phase = self.read_numeric("PHAS")
-		self.tau = self.read_numeric("OFLT")
-		self.internal_excitation = self.read_numeric("FMOD")
+		"""Initialization for the LIA consists of reading the measurement parameters,
+		settings already in the shadow state are not queried again
+		"""
+
+		self.excitation = float(self.query_setting("SLVL"))
+		self.frequency = float(self.query_setting("FREQ"))
+		self.harmonic = float(self.query_setting("HARM"))
+		self.sensitivity = int(self.query_setting("SENS"))
+		self.phase = float(self.query_setting("PHAS"))
+		self.tau = float(self.query_setting("OFLT"))
+		self.internal_excitation = float(self.query_setting("FMOD"))
 		self.expand = np.empty(2)
 		self.offset = np.empty(2)
 		self.read_offset()
@@ -73,52 +103,226 @@ class LockInAmplifier(Instrument):
 	def read_data(self):
 		""" Read data (X, Y, R, Phase) and implement auto range function"""
 
-		reply = self.visa.query("SNAP?1,2,3,4")
+		self.trigger()
+		self.fetch()
+		pass
+
+	def trigger(self):
+		"""Sample X, Y, R and phase now, the reply waits in the output queue"""
+
+		self.visa.write("SNAP?1,2,3,4")
+		pass
+
+	def fetch(self):
+		"""Read the reply to the SNAP? sent by trigger and auto range"""
+
+		reply = self.visa.read()
 		self.data = [float(i) for i in reply.split(",")]
 
-		if self.auto_range:
-			old_range = self.sensitivity
-			if self.data[2] > .9 * self.sensitivity_max:
-				self.sensitivity = self.sensitivity + 3
-				if self.sensitivity > 26:  # 26 correspond to 1V, maximum sensitivity range
-					self.sensitivity = 26
-			elif self.data[2] < .01 * self.sensitivity_max:
-				self.sensitivity = self.sensitivity - 3
-				if self.sensitivity < 0:   # 0 correspond to 2nV, minimum sensitivity range
-					self.sensitivity = 0
-
-			if self.sensitivity != old_range:
-				self.visa.write("SENS %d" % self.sensitivity)
-				self.calc_sens_max()
+		for i in range(self.max_range_changes if self.auto_range else 0):
+			if not self.update_sensitivity():
+				break
+			# The reading on the old range is discarded, read again once the output has settled
+			time.sleep(self.settle_tau * TIME_CONSTANTS[int(self.tau)])
+			reply = self.visa.query("SNAP?1,2,3,4")
+			self.data = [float(i) for i in reply.split(",")]
 		pass
 
-	def calc_sens_max(self):
-		""" Calculate the maximum sensitivity
-		TODO: Modify to calculate all sensitivity
+	def best_sensitivity(self, r):
+		"""The most sensitive code with r below range_target of full scale"""
+
+		codes = np.nonzero(r < self.range_target * SENSITIVITIES)[0]
+		return int(codes[0]) if len(codes) else len(SENSITIVITIES) - 1
+
+	def update_sensitivity(self):
+		"""Jump straight to the best range for the last reading, return True if the range changed
+
+		The LIAS? overload bits (input, filter and output) are latched since the last
+		query, an overloaded reading moves up at least three codes since R is clipped
+		"""
+
+		r = self.data[2]
+		overload = int(self.visa.query("LIAS?")) & 0b111
+		if not overload and self.range_low * self.sensitivity_max <= r <= self.range_high * self.sensitivity_max:
+			return False
+
+		sensitivity = self.best_sensitivity(r)
+		if overload:
+			sensitivity = max(sensitivity, min(self.sensitivity + 3, len(SENSITIVITIES) - 1))
+		if sensitivity == self.sensitivity:
+			return False
+
+		self.sensitivity = sensitivity
+		self.write_setting("SENS", "%d" % self.sensitivity)
+		self.calc_sens_max()
+		return True
+
+	def read_buffer(self, channel, start=0, count=None):
+		"""Read count points of a display channel (1 or 2) from the storage buffer
+		starting at point start and return them as a numpy array
 		"""
 
-		range_vec = [2., 5., 10.]
-		lev = self.sensitivity/3 - 9
-		self.sensitivity_max = range_vec[self.sensitivity % 3] * 10**lev
+		if count is None:
+			count = int(self.read_numeric("SPTS")) - start
+		if count <= 0:
+			return np.empty(0)
+
+		command = f"{self.buffer_format}? {channel:d},{start:d},{count:d}"
+		if self.buffer_format == "TRCB":
+			# 4 byte little endian IEEE floats with no header or terminator
+			return self.visa.query_binary_values(
+				command, datatype="f", is_big_endian=False, header_fmt="empty",
+				data_points=count, expect_termination=False, container=np.array
+			)
+		elif self.buffer_format == "TRCL":
+			# Each point is a 16 bit mantissa and a 16 bit exponent, value = m * 2^(exp - 124)
+			reply = self.visa.query_binary_values(
+				command, datatype="h", is_big_endian=False, header_fmt="empty",
+				data_points=2 * count, expect_termination=False, container=np.array
+			).reshape(-1, 2)
+			return np.ldexp(reply[:, 0].astype(float), reply[:, 1].astype(int) - 124)
+		else:
+			reply = self.visa.query(command)
+			return np.array([float(i) for i in reply.strip(",\n").split(",")])
+
+	def configure_buffer_channels(self):
+		"""Store X in display channel 1 and Y in display channel 2"""
+
+		self.visa.write("DDEF 1,0,0")
+		self.visa.write("DDEF 2,0,0")
 		pass
 
-	def set_output(self, level):
-		self.visa.write(f"SLVL {level:.3f}")
+	def start_stream(self, rate=512.0, chunk_interval=0.2, trigger_start=False, fast=False):
+		"""Start a streaming acquisition into the storage buffer
+
+		The sample rate is rounded to the nearest 62.5 mHz * 2^n (n = 0 ... 13).
+		A background thread drains the buffer every chunk_interval seconds, or reads
+		the FAST stream when fast is True, and queues blocks with columns
+		t (s, time.perf_counter), X, Y, R, phase. No other commands may be sent to
+		the lock-in until stop_stream is called.
+		"""
+
+		rate_code = int(np.clip(np.round(np.log2(rate / 0.0625)), 0, 13))
+		self.stream_rate = 0.0625 * 2**rate_code
+		fast = fast and self.fast_transfer
+
+		self.configure_buffer_channels()
+		self.visa.write(f"SRAT {rate_code:d}")
+		self.visa.write("SEND 0")  # 1 shot, the thread restarts the buffer before it fills
+		self.visa.write(f"TSTR {int(trigger_start):d}")
+		if self.fast_transfer:
+			self.visa.write(f"FAST {2 if fast else 0:d}")
+		self.visa.write("REST")
+
+		self.stream_queue = queue.Queue()
+		self.stream_stop.clear()
+		target = self._fast_stream_worker if fast else self._stream_worker
+		self.stream_thread = threading.Thread(target=target, args=(chunk_interval,), daemon=True)
+		self.stream_thread.start()
 		pass
 
-	def ramp(self, finish_value):
-		"""A method to ramp the instrument"""
-		start_value = self.read_numeric("SLVL")
-		if abs(start_value - finish_value) > self.ramp_step:
-			step_num = abs((finish_value - start_value) / self.ramp_step)
-			sweep_value = np.linspace(start_value, finish_value, num=np.ceil(int(step_num)), endpoint=True)
+	def read_stream(self, timeout=None):
+		"""Return all the queued stream blocks as one array, waiting up to timeout
+		seconds for the first block
+		"""
+
+		blocks = []
+		try:
+			blocks.append(self.stream_queue.get(timeout=timeout))
+			while True:
+				blocks.append(self.stream_queue.get_nowait())
+		except queue.Empty:
+			pass
+
+		if not blocks:
+			return np.empty((0, 5))
+		block = np.vstack(blocks)
+		self.data = list(block[-1, 1:])
+		return block
+
+	def stop_stream(self):
+		"""Stop the background thread and the acquisition"""
+
+		self.stream_stop.set()
+		if self.stream_thread is not None:
+			self.stream_thread.join()
+			self.stream_thread = None
+		if self.fast_transfer:
+			self.visa.write("FAST 0")
+		self.visa.write("PAUS")
+		pass
+
+	def _queue_block(self, t_start, first_point, x, y):
+		"""Put a block of X, Y points taken at stream_rate on the queue"""
+
+		t = t_start + (first_point + np.arange(len(x))) / self.stream_rate
+		r = np.hypot(x, y)
+		phase = np.degrees(np.arctan2(y, x))
+		self.stream_queue.put(np.column_stack((t, x, y, r, phase)))
+		pass
+
+	def _stream_worker(self, chunk_interval):
+		"""Drain the storage buffer in chunks until stop_stream is called"""
+
+		self.visa.write("STRT")
+		t_start = time.perf_counter()
+		read_point = 0
+
+		while not self.stream_stop.wait(chunk_interval):
+			stored = int(self.read_numeric("SPTS"))
+			if stored > read_point:
+				count = stored - read_point
+				x = self.read_buffer(1, read_point, count)
+				y = self.read_buffer(2, read_point, count)
+				self._queue_block(t_start, read_point, x, y)
+				read_point = stored
+
+			# Restart before the 1 shot buffer fills, this leaves a short gap in the stream
+			if read_point > self.buffer_size - 2 * chunk_interval * self.stream_rate:
+				self.visa.write("REST")
+				self.visa.write("STRT")
+				t_start = time.perf_counter()
+				read_point = 0
+		pass
+
+	def _fast_stream_worker(self, chunk_interval):
+		"""Read the FAST stream, X and Y arrive as 16 bit integers scaled so that
+		+-30000 is full scale
+		"""
+
+		points_per_read = max(int(chunk_interval * self.stream_rate), 1)
+		scale = self.sensitivity_max / 30000.0
+
+		self.visa.write("STRD")
+		time.sleep(0.5)  # STRD starts the scan after a 0.5 s delay
+		t_start = time.perf_counter()
+		read_point = 0
+
+		while not self.stream_stop.is_set():
+			reply = self.visa.read_bytes(4 * points_per_read)
+			points = np.frombuffer(reply, dtype="<i2").reshape(-1, 2) * scale
+			self._queue_block(t_start, read_point, points[:, 0], points[:, 1])
+			read_point += len(points)
+		pass
+
+	def calc_sens_max(self):
+		""" Look up the full scale of the present sensitivity"""
+
+		self.sensitivity_max = SENSITIVITIES[self.sensitivity]
+		pass
+
+	def set_output(self, level):
+		self.write_setting("SLVL", f"{level:.3f}")
+		pass
 
-			for i in range(len(sweep_value)):
-				self.set_output(sweep_value[i])
-				time.sleep(0.01)
+	def read_source(self):
+		return float(self.query_setting("SLVL"))
 
-			self.excitation = finish_value
-		return
+	def run_ramp(self, task, values, rate):
+		try:
+			return super().run_ramp(task, values, rate)
+		finally:
+			self.excitation = float(self.query_setting("SLVL"))
 
 	def read_offset(self, **kwargs):
 		
@@ -6,4 +6,12 @@ class SR850(LockInAmplifier):
     def __init__(self, address):
         super().__init__(address)
         self.name = "SR850"
+        self.buffer_size = 32000
+
+    def configure_buffer_channels(self):
+        """Store X in trace 1 and Y in trace 2"""
+
+        self.visa.write("TRCD 1,1,0,0,1")
+        self.visa.write("TRCD 2,2,0,0,1")
+        pass
 
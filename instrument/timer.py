@@ -1,92 +1,53 @@
-#!/usr/bin/python
-# -*- coding: utf-8 -*-
+import time
 
-"""
+from . import ramp
+from .generic_instrument import Instrument
 
-Sub programs for time sweep
 
-author : Alexander Mayorov
-email : mayorov@gmail.com
-last edited : Feb 2016
+class Timer(Instrument):
+    """A read instrument giving the time since initialize, in seconds
 
+    It has no VISA session, a read is only a time.perf_counter_ns call so it can be
+    added to any sweep without slowing it down.
+    """
 
-"""
+    def __init__(self, address=None):
+        super().__init__(None)
+        self.name = "Timer"
+        self.address = address  # an arbitrary number, nothing is opened
 
-import rpyc
-import string as string
-import re as re
-from collections import namedtuple
-import time
-import math
-import numpy as np
-import threading
-import queue
+        self.source = "SECONDS"
+        self.sense = "SECONDS"
+        self.column_names = "Time (s)"
+        self.data = [0.0]
+        self.data_column = 0
+        self.source_column = 0
+        self.ramp_step = 1
+        self.output = False
+
+        self.start_ns = time.perf_counter_ns()
 
-######################################################
-# Timer class
-#####################################################
+    def description(self):
+        """ Print a description string to data file"""
 
-class Timer:
-	def __init__(self, address):
-		self.Name = "Timer"
-		self.Address = address		#It is an arbitrary number
-		self.Data = [0.0]
-		self.InitTime = time.time()
-		self.RampStep = 1
-		self.Output = False
-		self.Source = "SECONDS"
-		self.ColumnNames = "Time (s)"
-		self.SourceColumn = 0
-	
-	##################################################
-	# Read data
-	################################################
+        return f"{self.name}: start={self.start_ns} ns (time.perf_counter_ns)\n"
 
-	#def Time(self):
-	#	Reply = time.time();
-	#	pass
-	
-	def ReadData(self):
-		Reply = time.time()-self.InitTime
-		self.Data = [Reply]
-		pass
-	
-	def Initialize(self):
-		self.InitTime = time.time()
-		pass
-		
-	def SetOutput(self,Level):
-		#self.Visa.write("".join((":SOUR:",self.Source," %.4e" % Level)))
-		pass
-		
-	def SwitchOutput(self):
-		#self.Visa.write("".join((":OUTP:STAT ","%d" % self.Output)))
-		pass
-		
-	def Ramp(self,VFinish):
-		if self.Output:
-			self.ReadData()
-		VStart = self.Data[self.SourceColumn]
-		if abs(VStart-VFinish) > self.RampStep:	
-			N = abs((VFinish-VStart)/self.RampStep)
-			VSweep = np.linspace(VStart,VFinish,num=np.ceil(N),endpoint=True)
+    def initialize(self):
+        self.start_ns = time.perf_counter_ns()
+        pass
 
-			if not self.Output:
-				self.SwitchOutput()
+    def read_data(self):
+        self.data = [(time.perf_counter_ns() - self.start_ns) * 1e-9]
+        pass
 
-			for i in range(len(VSweep)):
-				self.SetOutput(VSweep[i])
-				time.sleep(0.01)
+    def set_output(self, level):
+        # Time cannot be set
+        pass
 
-			self.ReadData()
-		return
-		
-	###################################################
-	# Print a description string 
-	################################################
-	
-	def Description(self):
-		DescriptionString = "Timer"		
-		DescriptionString = "".join((DescriptionString,"\n"))
-		return DescriptionString
+    def switch_output(self):
+        self.output = not self.output
+        pass
 
+    def start_ramp(self, finish_value, rate=None):
+        self.read_data()
+        return ramp.RampTask(ramp.no_ramp, self.data[0])
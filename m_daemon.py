@@ -1,18 +1,53 @@
-import asyncore
+"""Daemon controlling the Oxford Mercury iPS magnet power supply
+
+	The daemon listens for commands to change the target field and switch heater
+	The daemon broadcasts the current field, with the time.perf_counter_ns timestamp
+	of the reading and its rate of change (T/s) while the magnet is not ready
+
+	One daemon runs every group (axis) of the Mercury, e.g. "python m_daemon.py XYZ",
+	over the single serial link. Each axis has its own I/O worker thread, which
+	reads its field and runs its state machine, the workers take turns on the link
+	one query at a time so the axes ramp at the same time. The main thread keeps
+	broadcasting the last known fields at a steady rate and acts on the socket
+	commands, so neither waits for the Mercury replies or a switch heater. The field
+	of an axis is read every busy_interval while it is not ready and every
+	idle_interval when it is, the slowly changing values are polled at the rates in
+	slow_polls.
+
+	The broadcast "value" has the field of every axis in the order of the axes
+	argument, all at the one "timestamp", "main" is the index of the main axis in it
+	and "status" is 1 only when every axis is ready. Vector commands move the axes
+	together along a path and a queued program runs segments of the main axis back
+	to back, see interpret_msg.
+
+"""
+
 import re as re
+import sys
+import threading
 import time
+from collections import deque
 from datetime import datetime
 
 import numpy as np
 
+import utils.history as history
+import utils.scheduler as scheduler
 import utils.socket_subs as socket_subs
+import utils.state_board as state_board
 import utils.visa_subs as visa_subs
 
-class MControl:
+# Magnet actions as numbers for the history
+actions = {"HOLD": 0, "RTOS": 1, "RTOZ": 2, "CLMP": 3}
+
+# Highest current ramp rate (A/min) of the coil of each group, from the single axis
+# daemons. A group missing here ramps no faster than the slowest coil
+max_rates = {"Y": 5.5625, "Z": 2.19}
+
+
+class MagnetAxis:
 	"""
-	Initialization call, initialize visas for the Mercury IPS and perform some startup
-	queries on the instrument
-	server, server always runs at 18861
+	One group of the Mercury IPS, GRPX, GRPY or GRPZ
 	Important parameters
 	field
 	heater
@@ -21,110 +56,171 @@ class MControl:
 	switched
 	The target current either as part of a sweep or going to a fixed value
 	Mode: Sweep or Set (including set to zero)
-	TODO: modify codes to allow X, Y Z axes
 	"""
-	
-	def __init__(self):
-		# Connect visa to the magnet
-		self.visa = visa_subs.initialize_serial("ASRL11::INSTR")
-		# Add Timeout to 200s
-		self.visa.timeout = 200000
-		# Open the socket
-		address = ('localhost', 18861)
-		self.server = socket_subs.SockServer(address)
-		
+
+	def __init__(self, control, axis):
+		self.control = control
+		self.axis = axis
+		self.group = "GRP" + axis
+
 		# Define some important parameters for the magnet
 		self.field = 0.0
+		self.field_time = time.perf_counter_ns()  # middle of the query of the last reading
+		self.field_rate = 0.0  # T/s, fitted to the readings of the last rate_window
+		self.rate_window = 2.0  # s
+		self.field_readings = deque(maxlen=50)  # (timestamp, field)
+		# The latest (timestamp, field, rate), replaced as a whole for the broadcast thread
+		self.field_reading = (self.field_time, self.field, self.field_rate)
 		self.source_current = 0.0
 		self.heater = False
 		self.magnet_current = 0.0
 		self.a_to_b = 0.0
-		self.rate = 2.19
-		self.max_rate = 2.19
+		self.max_rate = max_rates.get(axis, min(max_rates.values()))
+		self.rate = self.max_rate
 		self.current_limit = 0.0
-		
+		# A, the set current is sent again when it differs more from the target, small
+		# enough for the steps of a vector path and for the at target window
+		self.cset_tolerance = 0.0005
+
 		# Set up the lock for the switch heater
 		self.lock = False
 		self.lock_time = 0.0
-		
+
 		# The magnet actions are defined by the following parameters.
 		# The daemon tries to reach the target field and then put the heater into the target state
 		self.target_field = 0.0
 		self.target_heater = False
-		
-		self.sweep_now = False
-		self.ready = 1  # ready message which is also broadcast to the listener
-		
+
+		self.ready = 1
+		self.action = ""  # the last magnet action read or set
+		self.source_flag = False  # ramp the source to zero once unlocked
+		self.quiet = False  # do not print every ramp, e.g. while following a path
+
+		# The I/O worker
+		self.wake = threading.Event()  # set by a command to act on it at once
+		self.worker = None
+		self.busy_interval = 0.2  # s between field readings while not ready
+		self.idle_interval = 2.0  # s between field readings while ready
+		# name -> (read function, interval when ready, interval when not ready) in s
+		self.slow_polls = {
+			"ATOB": (self.magnet_read_a_to_b, 600.0, 600.0),
+			"CLIM": (self.magnet_read_current_limit, 600.0, 600.0),
+			"SWHT": (self.magnet_read_heater, 30.0, 2.0),
+			"ACTN": (self.magnet_read_action, 30.0, 2.0),
+		}
+		self.last_polls = {name: time.monotonic() for name in self.slow_polls}
 		return
-	
+
+	def query(self, command):
+		"""One transaction on the link shared by all the axes"""
+
+		with self.control.visa_lock:
+			return self.control.visa.query(command)
+
 	def magnet_read_numeric(self, command):
 		"""Function to read one of the numeric signals"""
-		
-		# Form the query string (Now only for GRPZ)
-		query = "".join(("READ:DEV:GRPZ:PSU:SIG:", command))
-		reply = self.visa.query(query)
-		
+
+		# Form the query string
+		query = "".join(("READ:DEV:", self.group, ":PSU:SIG:", command))
+		reply = self.query(query)
+
 		# Find the useful part of the response
 		answer = str.rsplit(reply, ":", 1)[1]
-		
+
 		# Some regex to get rid of the appended units
 		answer = re.split("[a-zA-Z]", answer, 1)[0]
 		answer = float(answer)
-		
+
 		return answer
-	
+
 	def magnet_read_field(self):
 		"""Function to read the field in Tesla specifically"""
-		
-		# Form the query string (Now only for GRPZ)
+
+		# Form the query string
 		if self.heater:
-			query = "READ:DEV:GRPZ:PSU:SIG:FLD"
+			query = "READ:DEV:%s:PSU:SIG:FLD" % self.group
 		else:
 			# For some reason the command PFLD doesn't work
-			query = "READ:DEV:GRPZ:PSU:SIG:PCUR"
-		
-		reply = self.visa.query(query)
-		
+			query = "READ:DEV:%s:PSU:SIG:PCUR" % self.group
+
+		start = time.perf_counter_ns()
+		reply = self.query(query)
+		reading_time = (start + time.perf_counter_ns()) // 2
+
 		# Find the useful part of the response
 		answer = str.rsplit(reply, ":", 1)[1]
 		# Some regex to get rid of the appended units
 		answer = re.split("[a-zA-Z]", answer, 1)[0]
 		answer = float(answer)
-		
+
 		if self.heater:
 			self.source_current = answer * self.a_to_b
 			self.magnet_current = self.source_current
 		else:
 			self.magnet_current = answer
 			answer = answer / self.a_to_b
-					
+
 		self.field = answer
-		
+		self.field_time = reading_time
+		self.update_field_rate()
+
+		return
+
+	def update_field_rate(self):
+		"""Fit the rate of change of the field to the readings of the last
+		rate_window seconds, zero while the magnet is ready
+		"""
+
+		self.field_readings.append((self.field_time, self.field))
+		window = [r for r in self.field_readings if self.field_time - r[0] <= self.rate_window * 1e9]
+		if self.ready or len(window) < 2:
+			self.field_rate = 0.0
+		else:
+			t, b = np.array(window).T
+			self.field_rate = np.polyfit((t - t[-1]) * 1e-9, b, 1)[0]
+		self.field_reading = (self.field_time, self.field, self.field_rate)
 		return
-	
+
+	def field_at(self, timestamp):
+		"""The field at the time.perf_counter_ns timestamp, extrapolated from the last
+		reading but not past the target
+		"""
+
+		field_time, field, field_rate = self.field_reading
+		low, high = sorted((field, self.target_field))
+		return min(max(field + field_rate * (timestamp - field_time) * 1e-9, low), high)
+
 	def magnet_read_conf_numeric(self, command):
 		"""Read one of the numeric configs"""
-		
-		# Form the query string (Now only for GRPZ)
-		query = "".join(("READ:DEV:GRPZ:PSU:", command))
-		reply = self.visa.query(query)
-		
+
+		# Form the query string
+		query = "".join(("READ:DEV:", self.group, ":PSU:", command))
+		reply = self.query(query)
+
 		# Find the useful part of the response
 		answer = str.rsplit(reply, ":", 1)[1]
-		
+
 		# Some regex to get rid of the appended units
 		answer = re.split("[a-zA-Z]", answer, 1)[0]
 		answer = float(answer)
-		
+
 		return answer
-	
+
+	def magnet_read_a_to_b(self):
+		self.a_to_b = self.magnet_read_conf_numeric("ATOB")
+		return
+
+	def magnet_read_current_limit(self):
+		self.current_limit = self.magnet_read_conf_numeric("CLIM")
+		return
+
 	def magnet_set_numeric(self, command, value):
 		"""Function to set one of the numeric signals"""
-		
-		# Form the query string (Now only for GRPZ)
-		write_command = "SET:DEV:GRPZ:PSU:SIG:%s:%.4f" % (command, value)
-		reply = self.visa.query(write_command)
-		
+
+		# Form the query string
+		write_command = "SET:DEV:%s:PSU:SIG:%s:%.4f" % (self.group, command, value)
+		reply = self.query(write_command)
+
 		answer = str.rsplit(reply, ":", 1)[1]
 		if answer == "VALID":
 			valid = 1
@@ -132,15 +228,15 @@ class MControl:
 			valid = 0
 		else:
 			valid = -1
-		
+
 		return valid
-	
+
 	def magnet_read_heater(self):
 		"""Function to read the switch heater state returns boolean"""
-		
-		reply = self.visa.query("READ:DEV:GRPZ:PSU:SIG:SWHT")
+
+		reply = self.query("READ:DEV:%s:PSU:SIG:SWHT" % self.group)
 		answer = str.rsplit(reply, ":", 1)[1]
-		
+
 		if answer == "ON":
 			valid = 1
 			self.heater = True
@@ -149,19 +245,19 @@ class MControl:
 			self.heater = False
 		else:
 			valid = -1
-		
+
 		return valid
-	
+
 	def magnet_set_heater(self, state):
 		"""Turn the switch heater ON (1) or OFF (0)"""
-		
+
 		self.magnet_set_action("HOLD")
 		heater_before = self.heater
 		if state:
-			reply = self.visa.query("SET:DEV:GRPZ:PSU:SIG:SWHT:ON")
+			reply = self.query("SET:DEV:%s:PSU:SIG:SWHT:ON" % self.group)
 		else:
-			reply = self.visa.query("SET:DEV:GRPZ:PSU:SIG:SWHT:OFF")
-			
+			reply = self.query("SET:DEV:%s:PSU:SIG:SWHT:OFF" % self.group)
+
 		answer = str.rsplit(reply, ":", 1)[1]
 
 		valid = 0
@@ -169,41 +265,44 @@ class MControl:
 			valid = 1
 		elif answer == "INVALID":
 			valid = 0
-		time.sleep(5.)
+		# Only this worker waits, the field is still broadcast and the other axes run
+		self.control.stop_event.wait(5.)
 		self.magnet_read_heater()
 		heater_after = self.heater
 		if heater_after != heater_before:
-			print("heater switched ... locking for 2 minutes...")
+			print(f"{self.axis} heater switched ... locking for 2 minutes...")
 			self.lock = True
 			self.lock_time = datetime.now()
-			
+
 		return valid
-	
+
 	def magnet_read_action(self):
 		""" Read the current magnet action e.g. HOLD, RTOZ etc."""
-		
-		reply = self.visa.query("READ:DEV:GRPZ:PSU:ACTN")
+
+		reply = self.query("READ:DEV:%s:PSU:ACTN" % self.group)
 		answer = str.rsplit(reply, ":", 1)[1]
+		self.action = answer
 		return answer
-	
+
 	def magnet_set_action(self, command):
 		"""Set the action for the magnet"""
-		
-		reply = self.visa.query("".join(("SET:DEV:GRPZ:PSU:ACTN:", command)))	
-		
+
+		reply = self.query("".join(("SET:DEV:", self.group, ":PSU:ACTN:", command)))
+
 		answer = str.rsplit(reply, ":", 1)[1]
 		if answer == "VALID":
 			valid = 1
+			self.action = command
 		elif answer == "INVALID":
 			valid = 0
 		else:
 			valid = -1
-			
+
 		return valid
-	
+
 	def magnet_check_switchable(self):
 		"""Check if it is safe to switch the switch heater"""
-		
+
 		self.magnet_read_heater()
 		self.source_current = self.magnet_read_numeric("CURR")
 		self.magnet_current = self.magnet_read_numeric("PCUR")
@@ -215,61 +314,62 @@ class MControl:
 			switchable = True
 		elif self.heater == 0 and abs(self.source_current - self.magnet_current) >= 0.1:
 			switchable = False
-			
+
 		action = self.magnet_read_action()
 		if action == "RTOZ" or action == "RTOS":
 			switchable = False
-		
+
 		return switchable
-	
+
 	def magnet_on_start_up(self):
 		"""On start get parameters"""
-		
+
 		# Check the heater
 		self.magnet_read_heater()
-		self.a_to_b = self.magnet_read_conf_numeric("ATOB")
-		
+		self.magnet_read_a_to_b()
+
 		# Take care of the field sourcecurrent and magnetcurrent
 		self.magnet_read_field()
-		self.current_limit = self.magnet_read_conf_numeric("CLIM")
+		self.magnet_read_current_limit()
 		self.target_field = self.field
 		self.target_heater = self.heater
-		
+
 		if self.heater:
 			heater_string = "ON"
 		else:
 			heater_string = "OFF"
-		
+
 		print(
-			f"Connected to magnet... heater is {heater_string}, field is {self.field:.4f}, "
+			f"Connected to magnet {self.axis}... heater is {heater_string}, field is {self.field:.4f}, "
 			f"Magnet conversion = {self.a_to_b:.4f} A/T, Maximum current = {self.current_limit:.3f}"
 		)
-		
+
 		return
-	
+
 	def set_source(self, new_set):
 		"""Set the leads current, ignore the switch heater state, busy etc"""
-		
+
 		if abs(new_set) <= self.current_limit:
 			c_set = new_set
 		else:
 			c_set = np.copysign(self.current_limit, new_set)
-			
+
 		self.magnet_set_numeric("CSET", c_set)
-		
+
 		# If the heater is on set the rate
 		if self.heater:
 			if self.rate >= self.max_rate:
 				self.rate = self.max_rate
 			self.magnet_set_numeric("RCST", self.rate)
-			
+
 		set_rate = self.magnet_read_numeric("RCST")
 		self.magnet_set_action("RTOS")
-		print(f"Ramping source to {c_set:.4f} A at {set_rate:.4f} A/m\n")
+		if not self.quiet:
+			print(f"Ramping {self.axis} source to {c_set:.4f} A at {set_rate:.4f} A/m\n")
 		return
-	
+
 	def query_at_target(self):
-		
+
 		if abs(self.target_field) < 1.0:
 			if abs(self.field-self.target_field) < 0.0003:
 				at_target = True
@@ -283,158 +383,608 @@ class MControl:
 		return at_target
 
 	def update_ready(self):
-		
-		if self.query_at_target() and (self.heater == self.target_heater):
-			# The system is at target and ready
-			self.ready = 1
-		else:
-			# Idle
-			self.ready = 0
+
+		with self.control.state_lock:
+			if self.query_at_target() and (self.heater == self.target_heater):
+				# The system is at target and ready
+				self.ready = 1
+			else:
+				# Idle
+				self.ready = 0
+			self.control.update_ready()
 		return
 
-	def read_msg(self, msg):
-		"""Interpret a message from the socket
-		There are two possible actionable calls to the daemon
-		1. "SET" go to set point
-		2. "SWP" sweep from the current field to a target
+	def set_target(self, field, heater, rate=None):
+		"""Go to field and leave the switch heater in state heater, at rate (A/min)
+		or the maximum rate. Returns True if the target changed
 		"""
-		msg = msg.decode()  # change in python 3
-		msg = msg.split(" ")
-		if msg[0] == "SET":
-			# Set message has form "SET target_field target_heater"
-			try:
-				new_field = float(msg[1])
-				new_heater = int(msg[2])
-				new_heater = bool(new_heater)
-				if (new_field != self.target_field) or (new_heater != self.target_heater):
-					self.target_field = new_field
-					self.target_heater = new_heater
-					self.rate = self.max_rate
-					self.update_ready()
-					if not self.ready:
-						print(f"Got new set point from socket {self.target_field:.4f} T")
-			except:
-				pass
 
-		if msg[0] == "SWP":
-			# Message has form "SWP target_field rate target_heater"
-			# print msg
-			try:
-				new_field = float(msg[1])
-				new_heater = int(msg[3])
-				new_heater = bool(new_heater)
-				self.rate = float(msg[2]) * self.a_to_b
-				if (new_field != self.target_field) or (new_heater != self.target_heater):
-					self.target_field = new_field
-					self.target_heater = new_heater
-					self.update_ready()
-					if not self.ready:
-						print(
-							f"Got new sweep point from socket to {self.target_field:.4f} T"
-							f" at {self.rate/self.a_to_b:.4f} T/min"
-						)
-			except:
-				pass
-			
-			return
-		
+		with self.control.state_lock:
+			changed = (field != self.target_field) or (heater != self.target_heater)
+			self.rate = self.max_rate if rate is None else rate
+			if changed:
+				self.target_field = field
+				self.target_heater = heater
+				self.update_ready()
+		# Let the worker act on it without waiting for its next reading
+		self.wake.set()
+		return changed
 
-if __name__ == '__main__':
-	
-	# Initialize a daemon instance and runs startup codes
-	control = MControl()
-	control.magnet_on_start_up()
-	# A flag to control the source behavior
-	source_flag = False
-	
-	while 1:
-		
-		# Read the field and update the ready message
-		control.magnet_read_field()
-
-		# Push the reading to clients
-		for j in control.server.handlers:
-			j.to_send = f",{control.field:.5f} {control.ready:d}".encode()
-			socket_msg = j.received_data
-			if socket_msg and socket_msg != "-":
-				control.read_msg(socket_msg)
-		asyncore.loop(count=1, timeout=0.001)
-				
-		""" Now we should do stuff depending on the socket and what we 
+	def history_values(self):
+		return {
+			"field_" + self.axis: self.field, "target_field_" + self.axis: self.target_field,
+			"source_current_" + self.axis: self.source_current, "magnet_current_" + self.axis: self.magnet_current,
+			"heater_" + self.axis: self.heater, "target_heater_" + self.axis: self.target_heater,
+			"ready_" + self.axis: self.ready, "lock_" + self.axis: self.lock,
+			"action_" + self.axis: actions.get(self.action, np.nan)
+		}
+
+	def control_step(self):
+		""" One step of the magnet state machine, called by the worker
+		Now we should do stuff depending on the socket and what we
 		were doing before reading the socket
 		In order of precedence
 		1. We are locked, waiting for the switch heater -> delay any actions
 		2. Go to the target field
 		3. Go to the target heater
-		4. ... just chill out! 
+		4. ... just chill out!
 		"""
-		
-		if control.lock:
+
+		if self.lock:
 			# Check if we can release the lock
-			wait = datetime.now() - control.lock_time
+			wait = datetime.now() - self.lock_time
 			if wait.seconds >= 120.0:
 				# Unlock
-				control.lock = False
-				print("Unlocking...")
+				self.lock = False
+				print(f"Unlocking {self.axis}...")
 
-		if not control.lock and not control.ready:
+		if not self.lock and not self.ready:
 			""" The magnet is not locked and not ready
 			We now try to go to the target_field and
-			set the target_heater 
+			set the target_heater
 			"""
-			
-			if not control.query_at_target():
+
+			if not self.query_at_target():
 				# System is not at the target field
-				if not control.heater:
+				if not self.heater:
 					# The heater is not on
-					if control.magnet_check_switchable():
+					if self.magnet_check_switchable():
 						# The switch heater can be switched ON --> so switch it ON
-						control.magnet_set_heater(True) 
+						self.magnet_set_heater(True)
 						# this will set the lock so we need to get out of the loop without doing anything else
 					else:
 						# The switch heater is not on
-						action = control.magnet_read_action()
+						action = self.magnet_read_action()
 						if action != "RTOS":
 							# The source is not ramping --> Ramp it to the magnet current so it can be switched
-							control.set_source(control.magnet_current)
+							self.set_source(self.magnet_current)
 				else:
 					# The heater is on --> so go to the target
-					action = control.magnet_read_action()
-					set_current = control.magnet_read_numeric("CSET")
-					if action != "RTOS" or abs(set_current - control.target_field * control.a_to_b) > 0.005:
+					action = self.magnet_read_action()
+					set_current = self.magnet_read_numeric("CSET")
+					if action != "RTOS" or abs(set_current - self.target_field * self.a_to_b) > self.cset_tolerance:
 						# The source is not ramping --> Ramp it to the magnet current so it can be switched
-						target_current = control.target_field * control.a_to_b
-						control.set_source(target_current)
-			
-			elif control.heater != control.target_heater:
+						target_current = self.target_field * self.a_to_b
+						self.set_source(target_current)
+
+			elif self.heater != self.target_heater:
 				""" The magnet is at the target field but the heater is not in the target state
 				There are two possibilities
 				1. The heater is now ON --> turn it off and ramp the source down
-				2. The heater is OFF --> Set the source to magnet current and turn it on 
+				2. The heater is OFF --> Set the source to magnet current and turn it on
 				"""
-				if control.heater:
+				if self.heater:
 					# The heater is on
-					if control.magnet_check_switchable():
-						control.magnet_set_heater(False)
+					if self.magnet_check_switchable():
+						self.magnet_set_heater(False)
 						# Set the source flag to tell the source to ramp to zero
-						source_flag = True
+						self.source_flag = True
 
 				else:
 					# The heater is not on
-					if control.magnet_check_switchable():
+					if self.magnet_check_switchable():
 						# The switch heater can be switched ON --> so switch it ON
-						control.magnet_set_heater(True)
+						self.magnet_set_heater(True)
 						# this will set the lock so we need to get out of the loop without doing anything else
 					else:
 						# The switch heater is not on
-						action = control.magnet_read_action()
+						action = self.magnet_read_action()
 						if action != "RTOS":
 							# The source is not ramping --> Ramp it to the magnet current so it can be switched
-							control.set_source(control.magnet_current)
-
-		if not control.lock and source_flag:
-			# The source_flag has been set ramp the source to zero and unset the flag
-			control.magnet_set_action("RTOZ")
-			source_flag = False
-			
-		time.sleep(0.4)
+							self.set_source(self.magnet_current)
+
+		if not self.lock and self.source_flag:
+			# The self.source_flag has been set ramp the source to zero and unset the flag
+			self.magnet_set_action("RTOZ")
+			self.source_flag = False
+		return
+
+	def poll_slow(self):
+		"""Read the slowly changing values which are due, more often while the
+		magnet is not ready
+		"""
+
+		now = time.monotonic()
+		for name, (read, idle_interval, busy_interval) in self.slow_polls.items():
+			interval = idle_interval if self.ready and not self.lock else busy_interval
+			if now - self.last_polls[name] >= interval:
+				read()
+				self.last_polls[name] = now
+		return
+
+	def io_worker(self):
+		"""Read the field and act on it until the daemon stops"""
+
+		stop_event = self.control.stop_event
+		while not stop_event.is_set():
+			start = time.monotonic()
+			self.magnet_read_field()
+			self.poll_slow()
+			self.update_ready()
+			self.control_step()
+
+			interval = self.idle_interval if self.ready and not self.lock else self.busy_interval
+			self.wake.wait(max(start + interval - time.monotonic(), 0.0))
+			self.wake.clear()
+		return
+
+
+class MControl:
+	"""
+	Initialization call, initialize visas for the Mercury IPS and perform some startup
+	queries on the instrument
+	server, server always runs at 18861
+	axes are the groups of the Mercury to run e.g. "Z" or "XYZ", the plain SET and
+	SWP commands go to the main axis, Z if it is one of them
+	"""
+
+	def __init__(self, axes="Z"):
+		# Connect visa to the magnet
+		self.visa = visa_subs.initialize_serial("ASRL11::INSTR")
+		# Add Timeout to 200s, the Y group can take 20 s to reply
+		self.visa.timeout = 200000
+		# One query at a time from the axis workers
+		self.visa_lock = threading.Lock()
+		# Open the socket
+		address = ('localhost', 18861)
+		self.server = socket_subs.SockServer(address)
+		# The latest state of the main axis for local readers, see utils.state_board
+		self.board = state_board.StateBoard("m_daemon", writer=True)
+
+		self.axes = {axis: MagnetAxis(self, axis) for axis in axes.upper()}
+		self.main_axis = self.axes["Z"] if "Z" in self.axes else next(iter(self.axes.values()))
+
+		self.ready = 1  # ready message which is also broadcast to the listener
+
+		# Vector paths
+		self.path_period = 1.0  # s between the points of a rotation
+		self.path_thread = None
+		self.path_cancel = threading.Event()
+		self.path_running = False
+
+		# Queued field program of the main axis
+		self.program = deque()  # (number, (target_field, rate, target_heater, dwell)) to run
+		self.program_thread = None
+		self.program_cancel = threading.Event()
+		self.program_run = threading.Event()  # cleared while paused
+		self.program_running = False
+		self.segment = None  # the segment being run
+		self.segment_number = 0  # its number
+		self.segments_added = 0  # segments added since the daemon started, numbers them
+
+		# The axis workers and the broadcast loop
+		self.state_lock = threading.RLock()  # guards the targets and the ready state
+		self.stop_event = threading.Event()
+		self.broadcast_period = 0.2  # s between field broadcasts
+		self.socket_period = 0.05  # s between reads of the socket commands
+		self.history_period = 0.4  # s between history records
+		self.scheduler = scheduler.Scheduler()
+
+		# Days of readings and magnet actions, answered over the socket with the
+		# "history" query or saved with the DUMP message
+		fields = ["ready"]
+		for axis in self.axes.values():
+			fields += list(axis.history_values())
+		self.history = history.History(fields, length=2**20)
+		self.server.add_query("history", self.history.socket_query)
+		self.server.add_query("scheduler", self.scheduler.stats)
+		self.server.add_query("program", self.program_state)
+
+		return
+
+	def magnet_on_start_up(self):
+		for axis in self.axes.values():
+			axis.magnet_on_start_up()
+		return
+
+	def update_ready(self):
+		"""The daemon is ready when every axis is and no path or program is running"""
+
+		with self.state_lock:
+			busy = self.path_running or self.program_running
+			if all(axis.ready for axis in self.axes.values()) and not busy:
+				ready = 1
+			else:
+				ready = 0
+
+			if ready != self.ready:
+				self.server.publish_event("status", self.state_message(ready))
+			self.ready = ready
+		return
+
+	def record_history(self):
+		values = {"ready": self.ready}
+		for axis in self.axes.values():
+			values.update(axis.history_values())
+		self.history.append(**values)
+		return
+
+	def read_msg(self, msg):
+		"""Interpret a message from the socket, called by the main thread. The targets
+		are changed under state_lock by MagnetAxis.set_target
+		"""
+
+		self.interpret_msg(msg)
+		return
+
+	def interpret_msg(self, msg):
+		"""Interpret a message from the socket
+		The actionable calls to the daemon are
+		1. "SET" go to set point
+		2. "SWP" sweep from the current field to a target
+		both for the main axis, "ASET" and "ASWP" take the axis first e.g. "ASET X 0.5 1",
+		and for all the axes together, with one field per axis in the daemon order
+		3. "VSET" go straight to a field vector, each axis at the rate which brings them
+		there together, "VSET bx by bz target_heater"
+		4. "VSWP" sweep straight to a field vector at rate (T/min) along the line
+		"VSWP bx by bz rate target_heater"
+		5. "ROT" rotate a field of constant magnitude in the plane of two axes, the
+		angle from the first towards the second, in degrees, at rate (deg/min), the
+		other axes stay at their targets
+		"ROT magnitude axis_1 axis_2 start_angle stop_angle rate target_heater"
+		6. "PROG" a queued program of segments of the main axis, run back to back
+		"PROG ADD target_field rate target_heater dwell" appends a segment, the rate in
+		T/min and the dwell in s at the target, it can be added while running
+		"PROG START", "PROG PAUSE", "PROG RESUME", "PROG ABORT" and "PROG CLEAR"
+		A "segment" event is sent when each segment starts and ends and a "program"
+		event when the program is done or aborted, the other commands abort it.
+		Segments are numbered in the order they are added since the daemon started,
+		the "program" query gives the number of the next one
+		and "DUMP name" saves the history with numpy.save in history.dump_dir
+		"""
+		msg = msg.split(" ")
+		if msg[0] == "DUMP":
+			try:
+				print("Saved the history to %s" % self.history.dump(" ".join(msg[1:])))
+			except Exception as e:
+				print("Could not save the history: %s" % e)
+
+		if msg[0] in ("SET", "ASET"):
+			# Set message has form "SET target_field target_heater"
+			try:
+				axis = self.axes[msg.pop(1).upper()] if msg[0] == "ASET" else self.main_axis
+				new_field = float(msg[1])
+				new_heater = bool(int(msg[2]))
+				self.stop_path()
+				self.stop_program()
+				if axis.set_target(new_field, new_heater) and not self.ready:
+					print(f"Got new {axis.axis} set point from socket {axis.target_field:.4f} T")
+			except:
+				pass
+
+		if msg[0] in ("SWP", "ASWP"):
+			# Message has form "SWP target_field rate target_heater"
+			try:
+				axis = self.axes[msg.pop(1).upper()] if msg[0] == "ASWP" else self.main_axis
+				new_field = float(msg[1])
+				new_heater = bool(int(msg[3]))
+				rate = float(msg[2]) * axis.a_to_b
+				self.stop_path()
+				self.stop_program()
+				if axis.set_target(new_field, new_heater, rate) and not self.ready:
+					print(
+						f"Got new {axis.axis} sweep point from socket to {axis.target_field:.4f} T"
+						f" at {rate/axis.a_to_b:.4f} T/min"
+					)
+			except:
+				pass
+
+		if msg[0] in ("VSET", "VSWP"):
+			try:
+				n = len(self.axes)
+				finish = np.array([float(i) for i in msg[1:n + 1]])
+				new_heater = bool(int(msg[-1]))
+				start = self.target_vector()
+				distance = finish - start
+				if msg[0] == "VSET":
+					# The slowest axis at its maximum rate sets the time
+					minutes = max(
+						abs(d) * axis.a_to_b / axis.max_rate for d, axis in zip(distance, self.axes.values())
+					)
+				else:
+					minutes = np.linalg.norm(distance) / abs(float(msg[n + 1]))
+				self.start_path([start, finish], [minutes * 60.0], new_heater)
+				print(f"Got field vector {finish} T from socket, the path takes {minutes:.2f} minutes")
+			except:
+				pass
+
+		if msg[0] == "ROT":
+			try:
+				magnitude = float(msg[1])
+				axis_1, axis_2 = (list(self.axes).index(a.upper()) for a in msg[2:4])
+				start_angle, stop_angle, rate = (float(i) for i in msg[4:7])
+				new_heater = bool(int(msg[7]))
+
+				minutes = abs(stop_angle - start_angle) / abs(rate)
+				steps = max(int(np.ceil(minutes * 60.0 / self.path_period)), 1)
+				angles = np.radians(np.linspace(start_angle, stop_angle, steps + 1))
+				points = np.tile(self.target_vector(), (steps + 1, 1))
+				points[:, axis_1] = magnitude * np.cos(angles)
+				points[:, axis_2] = magnitude * np.sin(angles)
+				# Go to the start of the rotation first
+				self.start_path(points, [minutes * 60.0 / steps] * steps, new_heater)
+				print(f"Got rotation of {magnitude:.4f} T from {start_angle:.1f} to {stop_angle:.1f} deg from socket")
+			except:
+				pass
+
+		if msg[0] == "PROG":
+			try:
+				self.program_msg(msg[1].upper(), msg[2:])
+			except:
+				pass
+
+		return
+
+	def program_msg(self, command, arguments):
+		if command == "ADD":
+			field, rate, heater, dwell = (float(i) for i in arguments[:4])
+			with self.state_lock:
+				self.segments_added += 1
+				self.program.append((self.segments_added, (field, abs(rate), bool(int(heater)), dwell)))
+			print(f"Added program segment to {field:.4f} T at {abs(rate):.4f} T/min, {len(self.program)} queued")
+		elif command == "START":
+			if not self.program_running:
+				self.stop_path()
+				self.program_cancel.clear()
+				self.program_run.set()
+				self.program_running = True
+				self.update_ready()
+				self.program_thread = threading.Thread(target=self.run_program, name="m_daemon_program", daemon=True)
+				self.program_thread.start()
+		elif command == "PAUSE":
+			if self.program_running and self.program_run.is_set() and self.segment is not None:
+				# Hold the field where it is
+				self.program_run.clear()
+				axis = self.main_axis
+				axis.set_target(axis.field, axis.heater)
+				self.server.publish_event("segment", self.segment_event("paused"))
+		elif command == "RESUME":
+			if self.program_running and not self.program_run.is_set():
+				field, rate, heater, _ = self.segment
+				self.main_axis.set_target(field, heater, rate * self.main_axis.a_to_b)
+				self.program_run.set()
+				self.server.publish_event("segment", self.segment_event("resumed"))
+		elif command == "ABORT":
+			if self.program_running:
+				self.stop_program()
+				axis = self.main_axis
+				axis.set_target(axis.field, axis.heater)
+			self.program.clear()
+		elif command == "CLEAR":
+			self.program.clear()
+		return
+
+	def segment_event(self, state):
+		field, rate, heater, dwell = self.segment
+		return {
+			"state": state, "segment": self.segment_number, "target": field, "rate": rate,
+			"heater": int(heater), "dwell": dwell, "queued": len(self.program)
+		}
+
+	def wait_program(self, done, dwell=0.0):
+		"""Wait until done() is true and then for dwell seconds, the time paused does
+		not count. Returns False if the program was aborted
+		"""
+
+		while not self.program_cancel.is_set():
+			if not self.program_run.is_set():
+				self.program_run.wait(0.1)
+			elif not done():
+				self.program_cancel.wait(0.1)
+			elif dwell <= 0.0:
+				return True
+			else:
+				start = time.monotonic()
+				self.program_cancel.wait(min(dwell, 0.1))
+				dwell -= time.monotonic() - start
+		return False
+
+	def run_program(self):
+		"""Run the queued segments of the main axis until the queue is empty"""
+
+		axis = self.main_axis
+		state = "done"
+		segments = 0
+		try:
+			while True:
+				with self.state_lock:
+					if not self.program:
+						break
+					self.segment_number, self.segment = self.program.popleft()
+				segments += 1
+				field, rate, heater, dwell = self.segment
+				self.server.publish_event("segment", self.segment_event("start"))
+				axis.set_target(field, heater, rate * axis.a_to_b)
+				if not self.wait_program(lambda: axis.ready, dwell):
+					state = "aborted"
+					self.server.publish_event("segment", self.segment_event("aborted"))
+					return
+				self.server.publish_event("segment", self.segment_event("end"))
+		finally:
+			self.program_running = False
+			self.update_ready()
+			self.server.publish_event("program", {"state": state, "segments": segments})
+		return
+
+	def program_state(self):
+		"""Answer the "program" query"""
+
+		with self.state_lock:
+			return {
+				"running": self.program_running,
+				"paused": self.program_running and not self.program_run.is_set(),
+				"segment": self.segment_number, "queued": len(self.program),
+				"next_segment": self.segments_added + 1
+			}
+
+	def stop_program(self):
+		"""Abort the running program, the queued segments are kept"""
+
+		if self.program_thread is not None:
+			self.program_cancel.set()
+			self.program_thread.join()
+			self.program_thread = None
+		return
+
+	def target_vector(self):
+		return np.array([axis.target_field for axis in self.axes.values()])
+
+	def start_path(self, points, durations, heater):
+		"""Follow the field vectors points on a background thread, durations are the
+		times (s) between them, then leave the heaters in state heater
+		"""
+
+		self.stop_path()
+		self.stop_program()
+		self.path_cancel.clear()
+		self.path_running = True
+		self.update_ready()
+		self.path_thread = threading.Thread(
+			target=self.follow_path, args=(np.array(points), durations, heater), name="m_daemon_path", daemon=True
+		)
+		self.path_thread.start()
+		return
+
+	def stop_path(self):
+		"""Cancel the path being followed, the axes stop at their present targets"""
+
+		if self.path_thread is not None:
+			self.path_cancel.set()
+			self.path_thread.join()
+			self.path_thread = None
+		return
+
+	def wait_axes_ready(self):
+		"""Wait until every axis is ready, return False if the path was cancelled"""
+
+		while not all(axis.ready for axis in self.axes.values()):
+			if self.path_cancel.wait(0.1):
+				return False
+		return True
+
+	def follow_path(self, points, durations, heater):
+		"""Step the axis targets through points, every axis ramping at the rate which
+		takes it to the next point in its duration, so the field moves along straight
+		segments between the points
+		"""
+
+		axes = list(self.axes.values())
+		try:
+			# The heaters must be on to move the field, go to the first point
+			for axis, field in zip(axes, points[0]):
+				axis.set_target(field, True)
+			if not self.wait_axes_ready():
+				return
+
+			for axis in axes:
+				axis.quiet = True
+			start = time.monotonic()
+			elapsed = 0.0
+			for point, duration in zip(points[1:], durations):
+				elapsed += duration
+				for axis, field in zip(axes, point):
+					# A.min^-1 from where the axis is, so it catches up if it lags, at
+					# least a trickle so that the Mercury keeps ramping
+					rate = abs(field - axis.field) * axis.a_to_b / max(duration / 60.0, 1e-6)
+					axis.set_target(field, True, min(max(rate, 1e-3 * axis.max_rate), axis.max_rate))
+				if self.path_cancel.wait(max(start + elapsed - time.monotonic(), 0.0)):
+					return
+			for axis, field in zip(axes, points[-1]):
+				axis.quiet = False
+				axis.set_target(field, True)
+
+			# Wait for the last point then set the final heater state
+			if not self.wait_axes_ready():
+				return
+			for axis, field in zip(axes, points[-1]):
+				axis.set_target(field, heater)
+		finally:
+			for axis in axes:
+				axis.quiet = False
+			self.path_running = False
+			self.update_ready()
+		return
+
+	def state_message(self, status):
+		"""The fields of all the axes at the time of the latest reading"""
+
+		timestamp = max(axis.field_reading[0] for axis in self.axes.values())
+		return {
+			"value": [round(axis.field_at(timestamp), 5) for axis in self.axes.values()],
+			"status": status, "timestamp": timestamp,
+			"rate": [axis.field_reading[2] for axis in self.axes.values()],
+			"axes": "".join(self.axes), "main": list(self.axes).index(self.main_axis.axis)
+		}
+
+	def publish_state(self):
+		"""Push the last known state to the clients and the state board"""
+
+		self.server.publish(self.state_message(self.ready))
+		axis = self.main_axis
+		field_time, field, _ = axis.field_reading
+		self.board.publish(field, self.ready, axis.target_field, axis.heater, field_time)
+		return
+
+	def service_socket(self):
+		"""Act on the client commands and let the clients know at once"""
+
+		commands = self.server.read_commands()
+		for client, request_id, socket_msg in commands:
+			self.read_msg(socket_msg)
+			self.server.mark_handled(client, request_id)
+		if commands:
+			self.publish_state()
+		return
+
+	def run(self):
+		"""Start the axis workers and broadcast until stop is called"""
+
+		self.stop_event.clear()
+		for axis in self.axes.values():
+			axis.worker = threading.Thread(target=axis.io_worker, name="m_daemon_" + axis.axis, daemon=True)
+			axis.worker.start()
+		self.scheduler.add("broadcast", self.publish_state, self.broadcast_period, deadline=0.05)
+		self.scheduler.add("socket", self.service_socket, self.socket_period, deadline=0.05)
+		self.scheduler.add("history", self.record_history, self.history_period, deadline=0.05)
+		self.scheduler.run()
+		for axis in self.axes.values():
+			axis.worker.join()
+		return
+
+	def stop(self):
+		self.stop_event.set()
+		self.path_cancel.set()
+		self.program_cancel.set()
+		for axis in self.axes.values():
+			axis.wake.set()
+		self.scheduler.stop()
+		return
+
+
+if __name__ == '__main__':
+
+	# Initialize a daemon instance and runs startup codes, the axes to run are the
+	# first argument e.g. "python m_daemon.py XYZ", Z by default
+	control = MControl(sys.argv[1] if len(sys.argv) > 1 else "Z")
+	control.magnet_on_start_up()
+	control.run()
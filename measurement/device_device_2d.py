@@ -98,10 +98,8 @@ def device_device_2d(
             image_view[j].setImage(z_array[j], pos=(x_vec[0], y_min), scale=(x_scale, y_scale))
 
     m_client = socket_subs.SockClient('localhost', 18861)
-    time.sleep(2)
     measurement_subs.socket_write(m_client, "SET 0.0 0")
-    time.sleep(2)
-    m_client.close()
+    m_client.close(timeout=10.0)
 
     time.sleep(2)
 
@@ -18,9 +18,16 @@ def do_device_sweep(
         timeout=-1, wait=0.5,
         return_data=False, make_plot=True,
         socket_data_number=2,  # 5 for 9T, 2 for Dilution fridge
-        comment="No comment!", network_dir="Z:\\DATA"
+        comment="No comment!", network_dir="Z:\\DATA",
+        group_trigger=False
 ):
-    """Device sweep"""
+    """Device sweep
+
+    The read instruments are armed together and read afterwards, with group_trigger
+    they start together on a GPIB group execute trigger. Read instruments set up with
+    set_buffer(sample) take all sample readings of a point on one trigger. B and T are
+    interpolated from the daemon readings to the time of every row
+    """
 
     # Bind sockets
     m_client, m_socket, t_client, t_socket = measurement_subs.initialize_sockets()
@@ -41,27 +48,18 @@ def do_device_sweep(
         msg = " ".join(("SET", "%.4f" % b_set, "%d" % int(not persist)))
         measurement_subs.socket_write(m_client, msg)
         print("Wrote message to Magnet socket \"%s\"" % msg)
-    time.sleep(5)
 
-    # give precedence to the magnet and wait for the timeout
-    t_socket = measurement_subs.socket_read(t_client, t_socket)
-    m_socket = measurement_subs.socket_read(m_client, m_socket)
+    # give precedence to the magnet and wait for the timeout, the daemons
+    # report as soon as they are ready
     if not ignore_magnet:
-        while m_socket[1] != 1:
-            print("Waiting for magnet!")
-            time.sleep(15)
-            t_socket = measurement_subs.socket_read(t_client, t_socket)
-            m_socket = measurement_subs.socket_read(m_client, m_socket)
+        measurement_subs.wait_until_ready(m_client, name="magnet")
 
-    now_time = datetime.now()
-    remaining = timeout * 60.0 - float((now_time - set_time).seconds)
-    while (t_socket[1] != 1) and (remaining > 0):
-        now_time = datetime.now()
-        remaining = timeout * 60.0 - float((now_time - set_time).seconds)
-        print("Waiting for temperature ... time remaining = %.2f minutes" % (remaining / 60.0))
-        t_socket = measurement_subs.socket_read(t_client, t_socket)
-        m_socket = measurement_subs.socket_read(m_client, m_socket)
-        time.sleep(15)
+    remaining = timeout * 60.0 - (datetime.now() - set_time).total_seconds()
+    if remaining > 0:
+        measurement_subs.wait_until_ready(t_client, remaining, name="temperature")
+
+    t_socket = measurement_subs.socket_read(t_client, t_socket)
+    m_socket = measurement_subs.socket_read(m_client, m_socket)
 
     # Setup L plot windows
     if make_plot:
@@ -87,9 +85,7 @@ def do_device_sweep(
                         set_val = set_val[0:len(set_inst)]
                     else:
                         set_val = set_val + [0] * (len(set_inst) - len(set_val))
-                for i, v in enumerate(set_inst):
-                    print("Ramping %s to %.2e" % (v.name, set_val[i]))
-                    v.ramp(set_val[i])
+                measurement_subs.ramp_instruments(set_inst, set_val)
 
     if sweep_start != 0:
         sweep_inst.ramp(sweep_start)
@@ -107,11 +103,11 @@ def do_device_sweep(
         remaining = wait * 60.0
         while remaining > 0:
             now_time = datetime.now()
-            remaining = wait * 60.0 - float((now_time - wait_time).seconds)
-            print("Waiting ... time remaining = %.2f minutes" % (remaining / 60.0))
+            remaining = wait * 60.0 - (now_time - wait_time).total_seconds()
+            print("Waiting ... time remaining = %.2f minutes" % (max(remaining, 0.0) / 60.0))
             t_socket = measurement_subs.socket_read(t_client, t_socket)
             m_socket = measurement_subs.socket_read(m_client, m_socket)
-            time.sleep(15)
+            time.sleep(min(max(remaining, 0.0), 60.0))
     print("Starting measurement!")
 
     start_time = datetime.now()
@@ -127,29 +123,49 @@ def do_device_sweep(
         sweep_inst=True, set_value=set_value
     )
 
+    # If the sweep instrument is the only read instrument let it run the sweep from
+    # its own source list and buffer the readings, if it can in its present mode
+    hardware_sweep = (
+        len(read_inst) == 1 and read_inst[0] is sweep_inst
+        and getattr(sweep_inst, "supports_source_list", False)
+    )
+    if hardware_sweep:
+        print("Running the sweep from the %s source list" % sweep_inst.name)
+        hardware_points = sweep_inst.source_list_sweep(sweep, sample=sample, delay=max(delay, 0.0))
+    elif group_trigger:
+        for v in read_inst:
+            v.set_bus_trigger(True)
+
     for i, v in enumerate(sweep):
-        sweep_inst.set_output(v)
+        if hardware_sweep:
+            # The instrument times the readings of the whole chunk
+            v, readings, time_vector = next(hardware_points)
+        else:
+            sweep_inst.set_output(v)
 
         t_socket = measurement_subs.socket_read(t_client, t_socket)
         m_socket = measurement_subs.socket_read(m_client, m_socket)
 
-        data_vector[:, 0] = m_socket[0]
-        data_vector[:, 1:socket_data_number] = t_socket[0]
         data_vector[:, socket_data_number] = v
 
-        for j in range(sample):
+        if hardware_sweep:
+            data_vector[:, start_column[0]:start_column[1]] = readings
+            sweep_inst.data = list(readings[-1])
 
-            for i, v in enumerate(read_inst):
-                v.read_data()
-                data_vector[j, start_column[i]:start_column[i + 1]] = v.data
+        if not hardware_sweep:
+            samples, time_vector = measurement_subs.read_samples(
+                read_inst, sample, delay, group_trigger=group_trigger
+            )
+            for i, v in enumerate(samples):
+                data_vector[:, start_column[i]:start_column[i + 1]] = v
 
-            # Sleep
-            if delay >= 0.0:
-                time.sleep(delay)
+        # The field and temperature when each row was read
+        measurement_subs.fill_fridge_columns(
+            data_vector, time_vector, m_client, m_socket, t_client, t_socket, socket_data_number
+        )
 
         # Save the data
-        for j in range(sample):
-            writer.writerow(data_vector[j, :])
+        measurement_subs.write_rows(writer, data_vector, time_vector)
 
         # Package the data and send it for plotting
 
@@ -166,6 +182,13 @@ def do_device_sweep(
                 curve[j].setData(x=plot_data[0::(num_of_inst + 1)], y=plot_data[j + 1::(num_of_inst + 1)],
                                  _callSync="off")
 
+    if hardware_sweep:
+        # Let the generator restore the fixed source mode
+        hardware_points.close()
+    elif group_trigger:
+        for v in read_inst:
+            v.set_bus_trigger(False)
+
     sweep_inst.ramp(sweep_finish)
 
     # if the finish is zero switch it off
@@ -181,9 +204,7 @@ def do_device_sweep(
             else:
                 finish_value = finish_value + set_value[len(finish_value):len(set_inst)]
         # Final ramps
-        for i, v in enumerate(set_inst):
-            print("Ramping %s to %.2e" % (v.name, finish_value[i]))
-            v.ramp(finish_value[i])
+        measurement_subs.ramp_instruments(set_inst, finish_value)
 
     if return_data:
         data_list = [None] * (num_of_inst + 1)
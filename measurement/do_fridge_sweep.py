@@ -18,9 +18,18 @@ def do_fridge_sweep(
         timeout=-1, wait=0.5, max_over_time=5,
         return_data=False, socket_data_number=2,
         comment="No comment!", network_dir="Z:\\DATA",
-        ignore_magnet=False
+        ignore_magnet=False, stream_rate=0.0, group_trigger=False
 ):
-    """sweep T or B"""
+    """sweep T or B
+
+    If stream_rate > 0 the read instruments, which must then all stream (lock-ins, the
+    LS475 gaussmeter), are read at stream_rate (Hz) and every streamed point is saved.
+    Otherwise the read instruments are armed together and read afterwards, with
+    group_trigger they start together on a GPIB group execute trigger. Read instruments
+    set up with set_buffer(sample) take all sample readings of a point on one trigger.
+    Every saved row has the B and T of the moment it was read, interpolated between the
+    timestamped daemon readings
+    """
 
     # Bind sockets
     m_client, m_socket, t_client, t_socket = measurement_subs.initialize_sockets()
@@ -54,27 +63,18 @@ def do_fridge_sweep(
     msg = " ".join(("SET", "%.4f" % b_set[0], "%d" % int(not start_persist)))
     measurement_subs.socket_write(m_client, msg)
     print("Wrote message to Magnet socket \"%s\"" % msg)
-    time.sleep(5)
 
-    # give precedence to the magnet and wait for the timeout
-    t_socket = measurement_subs.socket_read(t_client, t_socket)
-    m_socket = measurement_subs.socket_read(m_client, m_socket)
+    # give precedence to the magnet and wait for the timeout, the daemons
+    # report as soon as they are ready
     if not ignore_magnet:
-        while m_socket[1] != 1:
-            print("Waiting for magnet!")
-            time.sleep(15)
-            t_socket = measurement_subs.socket_read(t_client, t_socket)
-            m_socket = measurement_subs.socket_read(m_client, m_socket)
+        measurement_subs.wait_until_ready(m_client, name="magnet")
 
-    now_time = datetime.now()
-    remaining = timeout * 60.0 - float((now_time - set_time).seconds)
-    while (t_socket[1] != 1) and (remaining > 0):
-        now_time = datetime.now()
-        remaining = timeout * 60.0 - float((now_time - set_time).seconds)
-        print("Waiting for temperature ... time remaining = %.2f minutes" % (remaining / 60.0))
-        t_socket = measurement_subs.socket_read(t_client, t_socket)
-        m_socket = measurement_subs.socket_read(m_client, m_socket)
-        time.sleep(15)
+    remaining = timeout * 60.0 - (datetime.now() - set_time).total_seconds()
+    if remaining > 0:
+        measurement_subs.wait_until_ready(t_client, remaining, name="temperature")
+
+    t_socket = measurement_subs.socket_read(t_client, t_socket)
+    m_socket = measurement_subs.socket_read(m_client, m_socket)
 
     # Setup L plot windows
     graph_window = rpg.GraphicsWindow(title="Fridge sweep...")
@@ -95,9 +95,7 @@ def do_fridge_sweep(
                         set_val = set_val[0:len(set_inst)]
                     else:
                         set_val = set_val + [0] * (len(set_inst) - len(set_val))
-                for i, v in enumerate(set_inst):
-                    print("Ramping %s to %.2e" % (v.name, set_val[i]))
-                    v.ramp(set_val[i])
+                measurement_subs.ramp_instruments(set_inst, set_val)
 
     if wait >= 0.0:
         print("Waiting %.2f minute!" % wait)
@@ -105,11 +103,11 @@ def do_fridge_sweep(
         remaining = wait * 60.0
         while remaining > 0:
             now_time = datetime.now()
-            remaining = wait * 60.0 - float((now_time - wait_time).seconds)
-            print("Waiting ... time remaining = %.2f minutes" % (remaining / 60.0))
+            remaining = wait * 60.0 - (now_time - wait_time).total_seconds()
+            print("Waiting ... time remaining = %.2f minutes" % (max(remaining, 0.0) / 60.0))
             t_socket = measurement_subs.socket_read(t_client, t_socket)
             m_socket = measurement_subs.socket_read(m_client, m_socket)
-            time.sleep(15)
+            time.sleep(min(max(remaining, 0.0), 60.0))
     print("Starting measurement!")
 
     start_time = datetime.now()
@@ -134,6 +132,12 @@ def do_fridge_sweep(
         measurement_subs.socket_write(t_client, msg)
         print("Wrote message to temperature socket \"%s\"" % msg)
 
+    # Wait for the daemon to act on the sweep and report it is sweeping (not ready)
+    if b_sweep:
+        m_client.wait_for_status(0)
+    else:
+        t_client.wait_for_status(0)
+
     t_socket = measurement_subs.socket_read(t_client, t_socket)
     m_socket = measurement_subs.socket_read(m_client, m_socket)
     if b_sweep:
@@ -141,15 +145,16 @@ def do_fridge_sweep(
     else:
         fridge_status = t_socket[-1]
 
-    while fridge_status != 0:
-        time.sleep(1)
-        # print fridge_status
-        t_socket = measurement_subs.socket_read(t_client, t_socket)
-        m_socket = measurement_subs.socket_read(m_client, m_socket)
-        if b_sweep:
-            fridge_status = m_socket[-1]
-        else:
-            fridge_status = t_socket[-1]
+    if stream_rate > 0:
+        for v in read_inst:
+            v.start_stream(rate=stream_rate)
+        stream_data = [np.empty((0, len(v.data) + 1)) for v in read_inst]
+        # The instruments stream at their own rates, rows are taken on a common time grid
+        stream_step = 1.0 / stream_rate
+        stream_next = None
+    elif group_trigger:
+        for v in read_inst:
+            v.set_bus_trigger(True)
 
     sweep_time_length = abs(sweep_start - sweep_stop) / sweep_rate  # In minutes
     sweep_time_length = sweep_time_length + max_over_time
@@ -167,21 +172,53 @@ def do_fridge_sweep(
         else:
             fridge_status = t_socket[-1]
 
-        data_vector[:, 0] = m_socket[0]
-        data_vector[:, 1:socket_data_number] = t_socket[0]
-
-        for j in range(sample):
-
+        if stream_rate > 0:
+            # Collect the streamed blocks and resample them onto the grid times covered
+            # by every instrument
             for i, v in enumerate(read_inst):
-                v.read_data()
-                data_vector[j, start_column[i]:start_column[i + 1]] = v.data
-
-            # Sleep
-            time.sleep(delay)
+                stream_data[i] = np.vstack((stream_data[i], v.read_stream(timeout=1.0)))
+            if all(len(block) for block in stream_data):
+                if stream_next is None:
+                    stream_next = max(block[0, 0] for block in stream_data)
+                stream_end = min(block[-1, 0] for block in stream_data)
+                stream_grid = np.arange(stream_next, stream_end, stream_step)
+            else:
+                stream_grid = np.empty(0)
+            stream_length = len(stream_grid)
+
+            stream_vector = np.tile(data_vector[-1, :], (stream_length, 1))
+            if stream_length > 0:
+                stream_next = stream_grid[-1] + stream_step
+                for i, v in enumerate(read_inst):
+                    block = stream_data[i]
+                    for j in range(1, block.shape[1]):
+                        stream_vector[:, start_column[i] + j - 1] = np.interp(stream_grid, block[:, 0], block[:, j])
+                    # Keep the last point before the next grid time for its interpolation
+                    keep = max(np.searchsorted(block[:, 0], stream_next, side="right") - 1, 0)
+                    stream_data[i] = block[keep:]
+            stream_t = (stream_grid * 1e9).astype(np.int64)
+            stream_times = np.column_stack((stream_t, stream_t))
+
+            measurement_subs.fill_fridge_columns(
+                stream_vector, stream_times, m_client, m_socket, t_client, t_socket, socket_data_number
+            )
+            measurement_subs.write_rows(writer, stream_vector, stream_times)
+            if stream_length > 0:
+                data_vector[-1, :] = stream_vector[-1, :]
+
+        if stream_rate <= 0:
+            samples, time_vector = measurement_subs.read_samples(
+                read_inst, sample, delay, group_trigger=group_trigger
+            )
+            for i, v in enumerate(samples):
+                data_vector[:, start_column[i]:start_column[i + 1]] = v
+            measurement_subs.fill_fridge_columns(
+                data_vector, time_vector, m_client, m_socket, t_client, t_socket, socket_data_number
+            )
 
         # Save the data
-        for j in range(sample):
-            writer.writerow(data_vector[j, :])
+        if stream_rate <= 0:
+            measurement_subs.write_rows(writer, data_vector, time_vector)
 
         to_plot = np.empty((num_of_inst + 1))
         if b_sweep:
@@ -204,15 +241,20 @@ def do_fridge_sweep(
             sweep_timeout = False
 
     # Loop is finished
+    if stream_rate > 0:
+        for v in read_inst:
+            v.stop_stream()
+    elif group_trigger:
+        for v in read_inst:
+            v.set_bus_trigger(False)
+
     if set_inst:
         if len(finish_value) != len(set_inst):
             if len(finish_value) > len(set_inst):
                 finish_value = finish_value[0:len(set_inst)]
             else:
                 finish_value = finish_value + set_value[len(finish_value):len(set_inst)]
-        for i, v in enumerate(set_inst):
-            print("Ramping %s to %.2e" % (v.name, finish_value[i]))
-            v.ramp(finish_value[i])
+        measurement_subs.ramp_instruments(set_inst, finish_value)
 
     if return_data:
         data_list = [None] * (num_of_inst + 1)
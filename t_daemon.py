@@ -11,18 +11,28 @@ last edited : Apr 2019
 
 
 	The daemon listens for commands to change the control loop or setpoint
-	The daemon broadcasts the current temperature
+	The daemon broadcasts the current temperature, with the time.perf_counter_ns
+	timestamp of the reading and its rate of change (K/s) while sweeping
+
+	The control loop is a set of periodic tasks, see utils.scheduler:
+	acquire	every 0.5 s, read the finished bridge conversion and start the next
+	pid		every 0.5 s, the sweep setpoint and the PID output
+	heater	every 0.5 s, write the PID output to the TCS
+	socket	every 0.05 s, act on the client commands
+	status	every minute, print the state and the task statistics
 
 """
-import asyncore
 import time
 from collections import deque
 from datetime import datetime
 
 import numpy as np
 
+import utils.history as history
 import utils.pid_control as pid_control
+import utils.scheduler as scheduler
 import utils.socket_subs as socket_subs
+import utils.state_board as state_board
 import utils.visa_subs as visa_subs
 
 
@@ -42,6 +52,8 @@ class TControl:
 
 		address = ('localhost', 18871)
 		self.server = socket_subs.SockServer(address)
+		# The latest state for local readers, see utils.state_board
+		self.board = state_board.StateBoard("t_daemon", writer=True)
 
 		self.resistance = 1.0
 		self.temperature = 0.0
@@ -49,6 +61,9 @@ class TControl:
 
 		self.pico_channel = 0
 		self.pico_range = 0
+		self.conversion_time = 0.45  # s from ADC to a valid RES?
+		self.conversion_ready = None  # time.monotonic when the started conversion is done
+		self.reading_time = time.perf_counter_ns()  # middle of the conversion of the last reading
 
 		self.set_temp = -1.0
 
@@ -78,19 +93,38 @@ class TControl:
 		self.at_set = False
 		self.sweep_mode = False
 		self.status_msg = 0  # not ready
-		self.temp_history = deque(np.zeros((60,)))
 
 		# Status events
-		self.status_interval = 1.0
-		self.last_status_time = datetime.now()
+		self.status_interval = 1.0  # minutes
 		self.sensor = "CERNOX"
 
+		# Task periods in seconds. The PID gains are tuned for a 1 s period, update_pid
+		# does not scale by the period
+		self.acquire_period = 0.5
+		self.pid_period = 1.0
+		self.socket_period = 0.05
+
+		# Temperatures of the last stability_window seconds, for the stability test
+		self.stability_window = 60.0
+		self.temp_history = deque(np.zeros((int(self.stability_window / self.acquire_period),)))
+
 		# Initialize a pid controller
 		self.pid = pid_control.PID(
 			p=20., i=.5, d=0, derivator=0, integrator=0,
 			integrator_max=60000, integrator_min=-2000)
 		self.pid_output = None
 
+		# Days of readings, PID terms and heater currents, answered over the socket
+		# with the "history" query or saved with the DUMP message
+		self.history = history.History([
+			"temperature", "resistance", "set_temp", "status", "pid_output",
+			"p", "i", "d", "heater_0", "heater_1", "heater_2"
+		])
+		self.server.add_query("history", self.history.socket_query)
+
+		self.scheduler = scheduler.Scheduler()
+		self.server.add_query("scheduler", self.scheduler.stats)
+
 		return
 
 	def set_tcs(self, source, current):
@@ -108,10 +142,23 @@ class TControl:
 
 	def read_pico(self):
 		# Get the resistance of the current channel of the picowatt
+		self.start_pico()
+		time.sleep(self.conversion_time)
+		self.finish_pico()
+		return
+
+	def start_pico(self):
+		# Start a conversion, the resistance can be read after conversion_time
 		self.pico_visa.write("ADC")
-		time.sleep(0.45)
+		self.conversion_start = time.perf_counter_ns()
+		self.conversion_ready = time.monotonic() + self.conversion_time
+		return
+
+	def finish_pico(self):
 		answer = self.pico_visa.query("RES?")
 		answer = answer.strip()
+		self.conversion_ready = None
+		self.reading_time = self.conversion_start + int(self.conversion_time * 5e8)
 		try:
 			self.resistance = float(answer)
 		except:
@@ -177,12 +224,21 @@ class TControl:
 		self.at_set = is_set and is_stable
 		return
 
+	def record_history(self):
+		self.history.append(
+			temperature=self.temperature, resistance=self.resistance, set_temp=self.set_temp,
+			status=self.status_msg, pid_output=self.pid_output,
+			p=self.pid.p_value, i=self.pid.i_value, d=self.pid.d_value,
+			heater_0=self.tcs_current[0], heater_1=self.tcs_current[1], heater_2=self.tcs_current[2]
+		)
+		return
+
 	# Interpret a message from the socket, current possible messages are
 	# SET ...  -  set probe the temperature
 	# SWP ...  -  sweep the probe temperature
+	# DUMP name  -  save the history with numpy.save in history.dump_dir
 	def read_msg(self, msg):
 
-		msg = msg.decode()  # change in python 3
 		msg = msg.split(" ")
 
 		if msg[0] == "SET":
@@ -239,6 +295,12 @@ class TControl:
 			except:
 				pass
 
+		if msg[0] == "DUMP":
+			try:
+				print("Saved the history to %s" % self.history.dump(" ".join(msg[1:])))
+			except Exception as e:
+				print("Could not save the history: %s" % e)
+
 		return
 
 	def sweep_control(self):
@@ -279,6 +341,8 @@ class TControl:
 		else:
 			status = 0  # Not ready
 
+		if status != self.status_msg:
+			self.server.publish_event("status", self.state_message(status))
 		self.status_msg = status
 		return
 
@@ -287,7 +351,95 @@ class TControl:
 		status_string += "Status message = %d; " % self.status_msg
 		status_string += "P = %.2f, I = %.2f, D = %.2f\n" % (self.pid.p_value, self.pid.i_value, self.pid.d_value)
 		print(status_string)
-		self.last_status_time = datetime.now()
+		print(self.scheduler.report())
+		return
+
+	def state_message(self, status):
+		# The temperature follows the setpoint while sweeping
+		rate = self.sweep_rate_sec * self.sweep_direction if self.sweep_mode else 0.0
+		return {
+			"value": [round(float(self.temperature), 3)], "status": status,
+			"timestamp": self.reading_time, "rate": rate
+		}
+
+	def publish_state(self):
+		# Push the state to the socket clients and the state board
+		self.server.publish(self.state_message(self.status_msg))
+		self.board.publish(self.temperature, self.status_msg, self.set_temp, self.tcs_current[2], self.reading_time)
+		return
+
+	def acquire(self):
+		# Read the conversion started by the last run and start the next one, the
+		# bridge converts between the runs so no task waits for it
+		if self.conversion_ready is not None:
+			if time.monotonic() < self.conversion_ready:
+				return
+			self.finish_pico()
+			self.calc_temperature(calibrations[self.sensor])
+			self.update_at_set()
+			self.update_status_msg()
+			self.publish_state()
+		self.start_pico()
+		return
+
+	def service_socket(self):
+		# Act on the client commands and let the clients know at once
+		commands = self.server.read_commands()
+		for client, request_id, socket_msg in commands:
+			self.read_msg(socket_msg)
+			self.server.mark_handled(client, request_id)
+		if commands:
+			self.update_status_msg()
+			self.publish_state()
+		return
+
+	def update_pid(self):
+		# Runs every pid_period seconds, the PID gains assume a period of 1 s
+
+		# if we are sweeping we do some things specific to the sweep
+		if self.sweep_mode:
+			self.sweep_control()
+
+		new_pid = self.pid.update(self.temperature)
+		try:
+			self.pid_output = int(new_pid)
+		except:
+			self.pid_output = 0
+			pass
+
+		if self.pid_output < 0:
+			self.pid_output = 0
+		elif self.pid_output > self.max_current:
+			self.pid_output = self.max_current
+
+		self.record_history()
+		return
+
+	def write_heater(self):
+		if self.pid_output is None:
+			return
+		if self.pid_output > 0 and self.tcs_heater[2] == 0:
+			# status is go to set and heater is off --> turn it on
+			self.set_tcs(2, self.pid_output)
+			self.tcs_switch_heater(2)
+			self.read_tcs()
+		elif self.pid_output <= 0 and self.tcs_heater[2] == 1:
+			# status is go to set and heater is off --> turn it on
+			self.tcs_switch_heater(2)
+			self.set_tcs(2, 0)
+			self.read_tcs()
+		elif self.pid_output >= 0 and self.tcs_heater[2] == 1:
+			self.set_tcs(2, self.pid_output)
+			self.tcs_current[2] = self.pid_output
+		return
+
+	def add_tasks(self):
+		# The acquisition comes first in each period, then the PID and the heater
+		self.scheduler.add("acquire", self.acquire, self.acquire_period, deadline=0.2)
+		self.scheduler.add("pid", self.update_pid, self.pid_period, deadline=0.05, offset=0.2)
+		self.scheduler.add("heater", self.write_heater, self.pid_period, deadline=0.2, offset=0.25)
+		self.scheduler.add("socket", self.service_socket, self.socket_period, deadline=0.05)
+		self.scheduler.add("status", self.print_status, self.status_interval * 60.0, deadline=1.0, offset=self.status_interval * 60.0)
 		return
 
 	def tcs_switch_heater(self, heater):
@@ -325,58 +477,7 @@ if __name__ == '__main__':
 
 	# Main loop
 	control.read_tcs()
-
-	while True:
-
-		# Read the picowatt and calculate the temperature
-		control.read_pico()
-		control.calc_temperature(calibrations[control.sensor])
-		control.update_at_set()
-		control.update_status_msg()
-
-		# Push the reading to clients
-		for j in control.server.handlers:
-			j.to_send = f"{control.temperature:.3f} {control.status_msg:d}".encode()
-			socket_msg = j.received_data
-			if socket_msg:
-				control.read_msg(socket_msg)
-		asyncore.loop(count=1, timeout=0.001)
-
-		# if we are sweeping we do some things specific to the sweep
-		if control.sweep_mode:
-			control.sweep_control()
-
-		# check if we should send an update
-		update_time = datetime.now() - control.last_status_time
-		if update_time.seconds/60.0 >= control.status_interval:
-			control.print_status()
-
-		new_pid = control.pid.update(control.temperature)
-		try:
-			control.pid_output = int(new_pid)
-		except:
-			control.pid_output = 0
-			pass
-
-		if control.pid_output < 0:
-			control.pid_output = 0
-		elif control.pid_output > control.max_current:
-			control.pid_output = control.max_current
-
-		if control.pid_output > 0 and control.tcs_heater[2] == 0:
-			# status is go to set and heater is off --> turn it on
-			control.set_tcs(2, control.pid_output)
-			control.tcs_switch_heater(2)
-			control.read_tcs()
-		elif control.pid_output <= 0 and control.tcs_heater[2] == 1:
-			# status is go to set and heater is off --> turn it on
-			control.tcs_switch_heater(2)
-			control.set_tcs(2, 0)
-			control.read_tcs()
-		elif control.pid_output >= 0 and control.tcs_heater[2] == 1:
-			control.set_tcs(2, control.pid_output)
-			control.tcs_current[2] = control.pid_output
-
-		time.sleep(0.5)
+	control.add_tasks()
+	control.scheduler.run()
 
 	control.tcs_visa.close()
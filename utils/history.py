@@ -0,0 +1,100 @@
+"""Fixed memory history of the daemon readings
+
+A History is a ring buffer held in a numpy structured array with an int64
+"timestamp" column (time.perf_counter_ns) and a float64 column for every field. Once
+full the oldest records are overwritten, so the memory use is fixed when the daemon
+starts. The daemon appends from its control loop and the socket thread answers time
+range queries, a lock guards the buffer.
+
+History.dump saves the records into dump_dir only, the file name comes from any
+socket client so it may not contain a directory.
+
+"""
+
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+dump_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Data", "history")
+dump_name = re.compile(r"^\w[\w.-]*$")
+
+
+class History:
+
+	def __init__(self, fields, length=2**19):
+		self.fields = list(fields)
+		self.dtype = np.dtype([("timestamp", "<i8")] + [(name, "<f8") for name in self.fields])
+		self.buffer = np.zeros(length, dtype=self.dtype)
+		self.count = 0  # records appended since the start
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return min(self.count, len(self.buffer))
+
+	def append(self, timestamp=None, **values):
+		""" Add a record, fields not given are stored as NaN """
+
+		if timestamp is None:
+			timestamp = time.perf_counter_ns()
+		with self.lock:
+			record = self.buffer[self.count % len(self.buffer)]
+			record["timestamp"] = timestamp
+			for name in self.fields:
+				record[name] = values.get(name, np.nan)
+			self.count += 1
+
+	def records(self):
+		""" A copy of all the records, oldest first """
+
+		with self.lock:
+			start = self.count % len(self.buffer)
+			if self.count <= len(self.buffer):
+				return self.buffer[:self.count].copy()
+			return np.concatenate((self.buffer[start:], self.buffer[:start]))
+
+	def query(self, start=None, end=None):
+		""" The records with start <= timestamp <= end (ns, time.perf_counter_ns), oldest
+		first. None leaves that end of the range open
+		"""
+
+		records = self.records()
+		first = 0 if start is None else np.searchsorted(records["timestamp"], start, side="left")
+		last = len(records) if end is None else np.searchsorted(records["timestamp"], end, side="right")
+		return records[first:last]
+
+	def dump(self, file_name):
+		""" Save all the records with numpy.save as file_name in dump_dir and return
+		the path, np.load gives the structured array
+		"""
+
+		if not dump_name.match(file_name):
+			raise ValueError("%r is not a plain file name" % file_name)
+		os.makedirs(dump_dir, exist_ok=True)
+		path = os.path.join(dump_dir, file_name)
+		if not path.endswith(".npy"):
+			path += ".npy"
+		np.save(path, self.records())
+		return path
+
+	def to_columns(self, records, max_points=None):
+		""" Records as a dict of lists for sending over the socket, every n-th record is
+		kept so at most max_points are sent
+		"""
+
+		step = 1
+		if max_points and len(records) > max_points:
+			step = int(np.ceil(len(records) / max_points))
+		records = records[::step]
+		columns = {name: records[name].tolist() for name in self.dtype.names}
+		columns["step"] = step
+		# Add this to a timestamp to get time.time_ns
+		columns["clock_offset"] = time.time_ns() - time.perf_counter_ns()
+		return columns
+
+	def socket_query(self, start=None, end=None, max_points=10000):
+		""" Answer a "history" query from a socket client """
+
+		return self.to_columns(self.query(start, end), max_points)
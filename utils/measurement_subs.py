@@ -21,14 +21,15 @@ Explanation:
 	Magnet: 18861
 	Temperature: 18871
 
-	Data from these processes can also be accessed through named pipes
+	The latest state of these processes can also be read by any local process
+	from shared memory, see utils.state_board
 
 	Device parameters are so far controlled in situ in the measurement
 	loop. This should probably also be changed to be consistent
 
 """
 
-import asyncore
+import concurrent.futures
 import csv
 import os
 import time
@@ -36,13 +37,16 @@ import time
 import numpy as np
 
 import utils.socket_subs as socket_subs
+import utils.visa_subs as visa_subs
 
 
 def initialize_sockets():
-	# Bind to the temperature and magnet sockets and try to read them
+	# Connect to the temperature and magnet daemons and wait briefly for their first readings
 	t_client = socket_subs.SockClient('localhost', 18871)
 	m_client = socket_subs.SockClient('localhost', 18861)
-	time.sleep(4)
+	deadline = time.monotonic() + 4.0
+	for client in (t_client, m_client):
+		client.wait_for_data(max(deadline - time.monotonic(), 0.0))
 	m_socket = [0.0, 0]
 	t_socket = [0.0, 0]
 	m_socket = socket_read(m_client, m_socket)
@@ -52,45 +56,235 @@ def initialize_sockets():
 
 
 def socket_read(client, old_socket=[]):
-	# Read the socket and parse the reply, the reply has 2 parts the message and the status
-	asyncore.loop(count=1, timeout=0.001)
-	socket_string = client.received_data
-	if not isinstance(socket_string, str):
-	# when t_daemon or m_daemon is not running, client.received_data = "", which is a string instead of bytes
-	# when daemons are running, client.recieved_data if bytes, which needs to be decoded.
-		socket_string = socket_string.decode()
+	# The latest state broadcast by the daemon, it has 2 parts the values and the status.
+	# When the daemon is not running the old values are kept
 	socket = old_socket
-	if socket_string:
-		socket_string = socket_string.split(",")[-1]
-		socket_string = socket_string.split(" ")
-		if len(socket_string) == 2:
-			value = socket_string[:-1]
-			status = socket_string[-1]
-			try:
-				for i, v in enumerate(value):
-					value[i] = float(v)
-				status = int(status)
-				socket[0] = value
-				socket[1] = status
-			except:
-				pass
+	message = client.latest
+	if message is not None:
+		socket[0] = list(message["value"])
+		socket[1] = int(message["status"])
 
 	return socket
 
 
+def socket_values_at(client, times, old_values):
+	"""The daemon values at the time.perf_counter_ns times, interpolated between its
+	timestamped readings and extrapolated with the rate it reports after the last
+	one. Returns an array of shape (len(times), len(values)), old_values on every
+	row when the daemon has sent no timestamped reading
+	"""
+
+	times = np.asarray(times, dtype=np.float64)
+	readings = list(client.readings)
+	if not readings:
+		return np.tile(np.asarray(old_values, dtype=np.float64), (len(times), 1))
+
+	stamps = np.array([r["timestamp"] for r in readings], dtype=np.float64)
+	values = np.array([r["value"] for r in readings], dtype=np.float64)
+	result = np.column_stack([np.interp(times, stamps, column) for column in values.T])
+
+	after = times > stamps[-1]
+	rate = np.broadcast_to(np.asarray(readings[-1].get("rate", 0.0), dtype=np.float64), values.shape[1:])
+	result[after] = values[-1] + np.outer((times[after] - stamps[-1]) * 1e-9, rate)
+	return result
+
+
+def fill_fridge_columns(data_vector, time_vector, m_client, m_socket, t_client, t_socket, socket_data_number):
+	"""Write the field and temperature at the time of each row, the middle of its
+	start and end timestamps, into the first socket_data_number columns. The field
+	is that of the main axis, the one the SET and SWP commands drive
+	"""
+
+	row_times = time_vector.mean(axis=1)
+	main = (m_client.latest or {}).get("main", 0)
+	data_vector[:, 0] = socket_values_at(m_client, row_times, m_socket[0])[:, main]
+	data_vector[:, 1:socket_data_number] = socket_values_at(t_client, row_times, t_socket[0])
+	return
+
+
 def socket_write(client, msg):
-	client.to_send = msg.encode()
-	asyncore.loop(count=1, timeout=0.001)
-	time.sleep(2)
-	client.to_send = "-".encode()
-	asyncore.loop(count=1, timeout=0.001)
+	"""Send a command to a daemon and return at once, the returned future is completed
+	when the daemon has received the command
+	"""
+
+	return client.send(msg)
+
+
+def wait_until_ready(client, timeout=None, name="daemon", progress_interval=60.0):
+	"""Wait until the daemon has acted on the commands sent through client and reports
+	ready (status 1), returning as soon as the status flips. timeout is in seconds,
+	None waits forever. A progress message is printed every progress_interval seconds.
+	Returns True if the daemon is ready
+	"""
+
+	start = time.monotonic()
+	while True:
+		if timeout is None:
+			remaining = None
+			wait = progress_interval
+		else:
+			remaining = timeout - (time.monotonic() - start)
+			if remaining <= 0:
+				return False
+			wait = min(progress_interval, remaining)
+
+		if client.wait_for_status(1, wait):
+			return True
+
+		if remaining is None:
+			print("Waiting for %s!" % name)
+		elif remaining > wait:
+			print("Waiting for %s ... time remaining = %.2f minutes" % (name, (remaining - wait) / 60.0))
+
+
+def read_history(client, start=None, end=None, max_points=10000, timeout=30.0):
+	"""The history of a daemon between the time.perf_counter_ns timestamps start and end,
+	e.g. the timestamps of some rows of a data file, as a dict of numpy arrays. At
+	most max_points records are returned, every "step"-th one
+	"""
+
+	reply = client.query("history", start=start, end=end, max_points=max_points).result(timeout)
+	return {name: np.asarray(v) if isinstance(v, list) else v for name, v in reply.items()}
+
+
+def queue_field_program(client, segments, start=True, timeout=30.0):
+	"""Queue a program on the magnet daemon, segments are (target_field, rate in T/min,
+	persist, dwell in s) and are run back to back once started. Returns the numbers
+	the daemon gives the segments, it sends a "segment" event as each one starts and
+	ends, e.g. client.wait_for_event("segment", state="end", segment=numbers[-1]),
+	and is ready when the program is done. The numbers assume no other client adds
+	segments at the same time
+	"""
+
+	first = client.query("program").result(timeout)["next_segment"]
+	for field, rate, persist, dwell in segments:
+		socket_write(client, "PROG ADD %.4f %.4f %d %.1f" % (field, rate, int(not persist), dwell))
+	if start:
+		socket_write(client, "PROG START")
+	return list(range(first, first + len(segments)))
+
+
+def ramp_instruments(instruments, values):
+	"""Ramp each instrument to its value concurrently and return when the slowest
+	ramp is finished
+	"""
+
+	tasks = []
+	for inst, value in zip(instruments, values):
+		print("Ramping %s to %.2e" % (inst.name, value))
+		tasks.append(inst.start_ramp(value))
+
+	try:
+		# In the order they finish, so a failure is seen at once
+		for future in concurrent.futures.as_completed([task.future for task in tasks]):
+			future.result()
+	except Exception:
+		# Stop the other ramps if one of them fails and wait until they have stopped,
+		# so no ramp is still writing to its instrument when the error is raised
+		for task in tasks:
+			task.cancel()
+		for task in tasks:
+			try:
+				task.result()
+			except Exception:
+				# Cancelled, or failed too, the first failure is the one raised
+				pass
+		raise
+
+	return
+
+
+def read_instruments(read_inst, group_trigger=False):
+	"""Arm every read instrument, then collect the results into inst.data
+
+	All the instruments integrate at the same time so a reading takes as long as
+	the slowest instrument. With group_trigger the armed instruments that support it
+	start together on a GPIB group execute trigger
+	"""
+
+	for inst in read_inst:
+		inst.trigger()
+
+	if group_trigger:
+		visa_subs.group_execute_trigger(0, [inst.visa for inst in read_inst if inst.bus_trigger])
+
+	for inst in read_inst:
+		inst.fetch()
+
+	return
+
+
+def read_samples(read_inst, sample, delay=0.0, group_trigger=False):
+	"""Take sample readings of every read instrument, return a list with an array
+	of shape (sample, len(inst.data)) for each
+
+	Instruments set up with inst.buffer_count == sample take all their readings on
+	one trigger and return them in one fetch, the others are read sample times with
+	delay in between. With group_trigger every group execute trigger also steps the
+	buffered instruments that wait for the bus, so their readings line up
+
+	Also returns an int64 array of shape (sample, 2) with the time.perf_counter_ns at the
+	start and end of the reads of each sample. Buffered readings are only known to be
+	somewhere in the whole read, so with buffered instruments every sample gets its
+	start and end
+	"""
+
+	buffered = [sample > 1 and inst.buffer_count == sample for inst in read_inst]
+	single = [inst for inst, b in zip(read_inst, buffered) if not b]
+	samples = [np.zeros((sample, len(inst.data))) for inst in read_inst]
+	times = np.zeros((sample, 2), dtype=np.int64)
+
+	start_ns = time.perf_counter_ns()
+	for inst, b in zip(read_inst, buffered):
+		if b:
+			inst.trigger()
+
+	for j in range(sample if single or group_trigger else 0):
+		times[j, 0] = time.perf_counter_ns()
+		for inst in single:
+			inst.trigger()
+		if group_trigger:
+			visa_subs.group_execute_trigger(0, [inst.visa for inst in read_inst if inst.bus_trigger])
+		for inst in single:
+			inst.fetch()
+		times[j, 1] = time.perf_counter_ns()
+
+		for i, inst in enumerate(read_inst):
+			if not buffered[i]:
+				samples[i][j, :] = inst.data
+
+		if delay > 0.0:
+			time.sleep(delay)
+
+	for i, inst in enumerate(read_inst):
+		if buffered[i]:
+			inst.fetch()
+			samples[i][:, :] = inst.buffer_data
+
+	if any(buffered):
+		times[:, 0] = start_ns
+		times[:, 1] = time.perf_counter_ns()
+
+	return samples, times
+
+
+def write_rows(writer, data_vector, time_vector):
+	"""Write the rows of data_vector, each followed by its start and end timestamps
+	(time.perf_counter_ns) as integers
+	"""
+
+	for row, times in zip(data_vector, time_vector):
+		writer.writerow([*row, *(int(t) for t in times)])
 
 
 def open_csv_file(
 		file_name, start_time, read_inst,
 		sweep_inst=[], set_inst=[], comment="No comment!\n",
-		network_dir="Z:\\DATA"
+		network_dir="Z:\\DATA", timestamps=True
 ):
+	"""Open the data file and write the header, with timestamps the columns end
+	with the start and end of the reads of every row in ns (time.perf_counter_ns)
+	"""
 	
 	# Setup the directories
 	# Try to make a directory called Data in the CWD
@@ -143,6 +337,9 @@ def open_csv_file(
 		csv_file.write("".join(("READ: ", inst.description())))
 		column_string = "".join((column_string, ", ", inst.column_names))
 
+	if timestamps:
+		column_string = "".join((column_string, ", t start (perf_counter ns), t end (perf_counter ns)"))
+
 	column_string = "".join((column_string, "\n"))
 	csv_file.write(comment)
 	csv_file.write("\n")
@@ -0,0 +1,127 @@
+"""Periodic tasks of the daemon control loops
+
+A Scheduler runs a set of PeriodicTasks on one thread. Each task has a period, a
+deadline (the time after its due time by which it must have finished) and an offset
+of its first run. The due times are on a fixed grid, start + offset + n * period, so
+a late run does not shift the later ones, and if a task falls behind by more than a
+period the missed runs are skipped rather than run back to back. Tasks due at the
+same time run in the order they were added.
+
+Tasks must not block, a slow instrument conversion is started by one run and read
+by the next. For every task the scheduler records:
+
+	runs		number of runs
+	skipped		periods missed because the task was late
+	overruns	runs which finished after their deadline
+	jitter		start time - due time (s), mean and max
+	duration	run time (s), mean and max
+
+"""
+
+import math
+import threading
+import time
+
+
+class PeriodicTask:
+
+	def __init__(self, name, function, period, deadline=None, offset=0.0):
+		self.name = name
+		self.function = function
+		self.period = period
+		self.deadline = period if deadline is None else deadline
+		self.offset = offset
+		self.due = 0.0  # time.monotonic of the next run
+
+		self.runs = 0
+		self.skipped = 0
+		self.overruns = 0
+		self.jitter_total = 0.0
+		self.jitter_max = 0.0
+		self.duration_total = 0.0
+		self.duration_max = 0.0
+
+	def run(self, now):
+		""" Run the task due at self.due, now is its start time """
+
+		jitter = now - self.due
+		self.function()
+		finish = time.monotonic()
+		duration = finish - now
+
+		self.runs += 1
+		self.jitter_total += jitter
+		self.jitter_max = max(self.jitter_max, jitter)
+		self.duration_total += duration
+		self.duration_max = max(self.duration_max, duration)
+		if finish > self.due + self.deadline:
+			self.overruns += 1
+
+		# Next point of the grid after now, skipping the missed ones
+		missed = max(math.floor((finish - self.due) / self.period), 0)
+		self.skipped += missed
+		self.due += (missed + 1) * self.period
+		return
+
+	def stats(self):
+		runs = max(self.runs, 1)
+		return {
+			"period": self.period, "deadline": self.deadline, "runs": self.runs,
+			"skipped": self.skipped, "overruns": self.overruns,
+			"jitter_mean": self.jitter_total / runs, "jitter_max": self.jitter_max,
+			"duration_mean": self.duration_total / runs, "duration_max": self.duration_max
+		}
+
+
+class Scheduler:
+
+	def __init__(self):
+		self.tasks = []
+		self.stop_event = threading.Event()
+
+	def add(self, name, function, period, deadline=None, offset=0.0):
+		""" Add function to be called every period seconds, return the PeriodicTask """
+
+		task = PeriodicTask(name, function, period, deadline, offset)
+		task.due = time.monotonic() + offset
+		self.tasks.append(task)
+		return task
+
+	def run_pending(self):
+		""" Run the tasks which are due, earliest first, return the next due time """
+
+		while True:
+			now = time.monotonic()
+			task = min(self.tasks, key=lambda t: t.due)
+			if task.due > now:
+				return task.due
+			task.run(now)
+
+	def run(self):
+		""" Run the tasks until stop is called """
+
+		self.stop_event.clear()
+		while not self.stop_event.is_set():
+			next_due = self.run_pending()
+			self.stop_event.wait(max(next_due - time.monotonic(), 0.0))
+		return
+
+	def stop(self):
+		self.stop_event.set()
+
+	def stats(self):
+		""" The statistics of every task by name """
+
+		return {task.name: task.stats() for task in self.tasks}
+
+	def report(self):
+		""" The statistics as a printable table, times in ms """
+
+		lines = ["Task        runs  skipped  overruns  jitter mean/max  duration mean/max"]
+		for name, s in self.stats().items():
+			lines.append("%-10s %5d %8d %9d %8.1f/%-7.1f %9.1f/%.1f" % (
+				name, s["runs"], s["skipped"], s["overruns"],
+				s["jitter_mean"] * 1e3, s["jitter_max"] * 1e3,
+				s["duration_mean"] * 1e3, s["duration_max"] * 1e3
+			))
+		return "\n".join(lines) + "\n"
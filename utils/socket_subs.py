@@ -1,6 +1,3 @@
-
-
-
 """Sub programs for operation of the PicoWatt and Leiden TCS to control temperature
 
 author : Eoin O'Farrell
@@ -9,121 +6,484 @@ last edited : August 2013
 
 This file contains some utilities to create a socket server, handler and client
 
+The server and clients run on an asyncio event loop in a background thread, so the
+daemon and measurement loops never block on the sockets. Messages are JSON objects
+sent as frames with a 4 byte big endian length prefix:
+
+	{"type": "data", "handled": n, ...}		server -> clients, the latest daemon state
+	{"type": "event", "event": name, ...}	server -> clients, e.g. a status change
+	{"type": "hello", "client": uid, "mode": m}	client -> server, sent on every (re)connection
+	{"type": "cmd", "id": n, "msg": str}	client -> server, a command e.g. "SET 1.0 0"
+	{"type": "ack", "id": n}				server -> client, the command is queued
+	{"type": "query", "id": n, "query": name, "params": {...}}
+											client -> server, e.g. a history range
+	{"type": "reply", "id": n, "result": ...}	server -> client, or "error": str
+
+Every command has a request id, increasing for each client. The client keeps a
+command until it is acknowledged and sends it again after a reconnection, the server
+queues a command only the first time its id is seen so none is lost or run twice.
+"handled" is the id of the last command of the receiving client the daemon has acted
+on, so a client knows when the state it gets reflects its commands. Queries have
+their own ids, they are answered on a worker thread by the function the daemon
+registered with add_query.
+
+Each client has its own bounded queue written by its own task, so a slow client
+never holds up the daemon or the other clients. In "latest" mode (the default) only
+the newest data message waits to be sent, older ones are replaced, in "all" mode
+every data message is queued. Events, acks and replies are always queued, in order.
+A client whose queue is full, or which has not taken any data for stall_timeout
+seconds, is disconnected, it will reconnect and get the latest state.
+
 """
 
-import asyncore
-import socket
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import itertools
+import json
 import logging
+import queue
+import struct
+import threading
+import uuid
 # logging.basicConfig(filename='server_debug.log', level=logging.DEBUG)
 
+frame_header = struct.Struct("!I")
+max_frame_size = 1 << 26
 
-class SockServer(asyncore.dispatcher):
+loop = None
+loop_lock = threading.Lock()
 
-	def __init__(self, address):
-		self.logger = logging.getLogger('EchoServer')
-		asyncore.dispatcher.__init__(self)
-		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-		self.bind(address)
-		self.address = self.socket.getsockname()
-		self.logger.debug('binding to %s', self.address)
-		self.listen(1)
+
+def event_loop():
+	""" Return the event loop of the socket thread, starting it on first use """
+
+	global loop
+	with loop_lock:
+		if loop is None:
+			loop = asyncio.new_event_loop()
+			threading.Thread(target=loop.run_forever, name="socket_subs", daemon=True).start()
+	return loop
+
+
+def run(coroutine, timeout=None):
+	""" Run a coroutine on the socket thread and wait for its result """
+
+	return asyncio.run_coroutine_threadsafe(coroutine, event_loop()).result(timeout)
+
+
+def to_json(value):
+	""" numpy scalars and arrays as their python equivalents """
+
+	if hasattr(value, "tolist"):
+		return value.tolist()
+	raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_body(message):
+	return json.dumps(message, separators=(",", ":"), default=to_json).encode()
+
+
+def encode_frame(message):
+	body = encode_body(message)
+	return frame_header.pack(len(body)) + body
+
+
+def add_handled(body, handled):
+	""" The frame of an encoded message with its "handled" field added, so a broadcast
+	is encoded once for all the clients
+	"""
+
+	body = body[:-1] + b',"handled":%d}' % handled
+	return frame_header.pack(len(body)) + body
+
+
+async def read_frame(reader):
+	""" Read one frame, raises asyncio.IncompleteReadError when the peer disconnects """
+
+	size, = frame_header.unpack(await reader.readexactly(frame_header.size))
+	if size > max_frame_size:
+		raise ValueError("Frame of %d bytes is too long" % size)
+	return json.loads(await reader.readexactly(size))
+
+
+class SockServer:
+
+	def __init__(self, address, queue_size=1000, stall_timeout=10.0):
+		self.logger = logging.getLogger('SockServer')
+		self.queue_size = queue_size  # messages waiting for a client before it is dropped
+		self.stall_timeout = stall_timeout  # s a client may block its socket
 		self.handlers = []
+		self.commands = queue.Queue()
+		self.last_ids = {}  # the highest command id queued for each client
+		self.handled_ids = {}  # the highest command id acted on by the daemon for each client
+		self.latest = None  # the last data message, sent to new clients at once
+		self.queries = {}  # query name -> function answering it
+
+		self.server = run(self._start(address))
+		self.address = self.server.sockets[0].getsockname()
+		self.logger.debug('binding to %s', self.address)
 		return
 
-	def handle_accept(self):
+	async def _start(self, address):
+		return await asyncio.start_server(self.handle_accept, address[0], address[1], reuse_address=True)
+
+	async def handle_accept(self, reader, writer):
 		# Called when a client connects to our socket
-		client_info = self.accept()
-		self.logger.debug('handle_accept() -> %s', client_info[1])
-		handler = SockHandler(client_info[0], self)
+		self.logger.debug('handle_accept() -> %s', writer.get_extra_info("peername"))
+		handler = SockHandler(reader, writer, self)
 		print("Got listener!")
-		if len(self.handlers) > 2:
-			self.remove_channel(self.handlers[-1])
 		self.handlers.append(handler)
+		try:
+			await handler.run()
+		finally:
+			self.remove_channel(handler)
 		return
 
-	def remove_channel(self, sock):
-		if sock in self.handlers:
-			self.handlers.remove(sock)
+	def remove_channel(self, handler):
+		if handler in self.handlers:
+			self.handlers.remove(handler)
 			print("Listener disconnect!")
 
-	def handle_close(self):
-		self.logger.debug('handle_close()')
-		self.close()
+	def publish(self, data):
+		""" Send the dict data to every client, can be called from any thread """
+
+		message = dict(data, type="data")
+		self.latest = message
+		# The command ids the daemon had acted on when it made this data
+		event_loop().call_soon_threadsafe(self._broadcast, message, dict(self.handled_ids))
+
+	def publish_event(self, event, data):
+		""" Send an event, e.g. "status" when the status changes, to every client
+		straight away
+		"""
+
+		message = dict(data, type="event", event=event)
+		event_loop().call_soon_threadsafe(self._broadcast, message, dict(self.handled_ids))
+
+	def _broadcast(self, message, handled_ids):
+		body = encode_body(message)
+		is_data = message["type"] == "data"
+		for handler in list(self.handlers):
+			handler.send_frame(add_handled(body, handled_ids.get(handler.client, 0)), is_data)
+
+	def add_query(self, name, function):
+		""" Answer the query name with function(**params), called on a worker thread """
+
+		self.queries[name] = function
+
+	async def answer(self, handler, message):
+		reply = {"type": "reply", "id": message["id"]}
+		try:
+			function = self.queries[message["query"]]
+			call = functools.partial(function, **message.get("params", {}))
+			reply["result"] = await asyncio.get_running_loop().run_in_executor(None, call)
+		except Exception as e:
+			reply["error"] = repr(e)
+		handler.send_message(reply)
+
+	def queue_command(self, client, request_id, msg):
+		""" Queue a command unless it was already received before a reconnection """
+
+		if request_id > self.last_ids.get(client, 0):
+			self.last_ids[client] = request_id
+			self.commands.put((client, request_id, msg))
+
+	def read_commands(self):
+		""" Return the commands received since the last call as (client, request_id,
+		msg), in order. Call mark_handled once the daemon has acted on each
+		"""
+
+		commands = []
+		while True:
+			try:
+				commands.append(self.commands.get_nowait())
+			except queue.Empty:
+				return commands
+
+	def mark_handled(self, client, request_id):
+		""" The daemon has acted on the command, the data and events published from
+		now on reflect it
+		"""
+
+		self.handled_ids[client] = request_id
+
+	def close(self):
+		self.logger.debug('close()')
+		run(self._close())
 		return
 
+	async def _close(self):
+		self.server.close()
+		for handler in list(self.handlers):
+			handler.writer.close()
+		await self.server.wait_closed()
+
 
-class SockHandler(asyncore.dispatcher):
+class SockHandler:
+	""" A client connected to a SockServer, messages to it are queued and written by
+	its own task
+	"""
 
-	def __init__(self, sock, server, chunk_size=256):
-		self.chunk_size = chunk_size
-		self.logger = logging.getLogger('EchoHandler%s' % str(sock.getsockname()))
-		asyncore.dispatcher.__init__(self, sock=sock)
-		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-		self.to_send = ""
-		self.received_data = ""
+	def __init__(self, reader, writer, server):
+		self.logger = logging.getLogger('SockHandler%s' % str(writer.get_extra_info("peername")))
+		self.reader = reader
+		self.writer = writer
 		self.server = server
+		self.client = id(self)  # replaced by the client uid from its hello
+		self.mode = "latest"  # or "all", from the hello
+		self.outbox = collections.deque()  # frames to send in order
+		self.data = None  # the frame of the newest data message in latest mode
+		self.ready = asyncio.Event()
 		return
 
-	def writable(self):
-		self.logger.debug('writable() -> %s', bool(self.to_send))
-		return bool(self.to_send)
+	async def run(self):
+		if self.server.latest is not None:
+			self.send_message(dict(self.server.latest, handled=0))
+		write_task = asyncio.ensure_future(self.write_loop())
+		try:
+			while True:
+				self.handle_read(await read_frame(self.reader))
+		except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+			self.logger.debug('run() -> %r', e)
+		finally:
+			write_task.cancel()
+			self.writer.close()
+
+	def handle_read(self, message):
+		self.logger.debug('handle_read() -> %s', message)
+		kind = message.get("type")
+		if kind == "hello":
+			self.client = message["client"]
+			self.mode = message.get("mode", "latest")
+		elif kind == "cmd":
+			self.server.queue_command(self.client, message["id"], message["msg"])
+			self.send_message({"type": "ack", "id": message["id"]})
+		elif kind == "query":
+			asyncio.ensure_future(self.server.answer(self, message))
+
+	def send_message(self, message):
+		self.send_frame(encode_frame(message), message["type"] == "data")
+
+	def send_frame(self, frame, is_data=False):
+		""" Queue a frame, a data frame replaces the unsent one in latest mode """
 
-	def handle_write(self):
-		if len(self.to_send) > self.chunk_size:
-			# if the buffer is too long bin some
-			sent = self.send(self.to_send[-self.chunk_size:])	
-			self.to_send = ""
+		if self.writer.is_closing():
+			return
+		if is_data and self.mode == "latest":
+			self.data = frame
 		else:
-			sent = self.send(self.to_send[:self.chunk_size])
-			self.to_send = self.to_send[sent:]
-
-	def handle_read(self):
-		data = self.recv(self.chunk_size)
-		self.logger.debug('handle_read() -> (%d) "%s"', len(data), data)
-		self.received_data = data
-
-	def handle_close(self):
-		self.logger.debug('handle_close()')
-		self.server.remove_channel(self)
-		self.close()
-
-
-class SockClient(asyncore.dispatcher):
-
-	def __init__(self, host, port, chunk_size=256):
-		# self.message = message
-		self.to_send = ""
-		self.received_data = ""
-		self.chunk_size = chunk_size
-		self.logger = logging.getLogger('EchoClient')
-		asyncore.dispatcher.__init__(self)
-		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-		self.logger.debug('connecting to %s', (host, port))
-		self.connect((host, port))
+			if self.data is not None:
+				# Keep the order of the data and the events
+				self.outbox.append(self.data)
+				self.data = None
+			if len(self.outbox) >= self.server.queue_size:
+				self.disconnect("%d messages queued" % len(self.outbox))
+				return
+			self.outbox.append(frame)
+		self.ready.set()
+
+	async def write_loop(self):
+		while True:
+			await self.ready.wait()
+			self.ready.clear()
+			while self.outbox or self.data is not None:
+				frames = list(self.outbox)
+				self.outbox.clear()
+				if self.data is not None:
+					frames.append(self.data)
+					self.data = None
+				self.writer.writelines(frames)
+				try:
+					await asyncio.wait_for(self.writer.drain(), self.server.stall_timeout)
+				except asyncio.TimeoutError:
+					self.disconnect("no data taken for %.0f s" % self.server.stall_timeout)
+					return
+				except ConnectionError:
+					return
+
+	def disconnect(self, reason):
+		""" Drop a stalled client, the reader then stops and removes the handler """
+
+		print("Listener stalled (%s), disconnecting" % reason)
+		self.outbox.clear()
+		self.data = None
+		self.writer.transport.abort()
+
+
+class SockClient:
+
+	def __init__(self, host, port, retry_interval=1.0, mode="latest", buffer_size=100000):
+		""" mode is "latest" to get only the newest state, or "all" to get every data
+		message, the last buffer_size of them are kept for read_samples
+		"""
+
+		self.logger = logging.getLogger('SockClient')
+		self.address = (host, port)
+		self.retry_interval = retry_interval
+		self.mode = mode
+		self.samples = collections.deque(maxlen=buffer_size)
+		# The last data messages with distinct "timestamp"s, for interpolation
+		self.readings = collections.deque(maxlen=100)
+		self.events = collections.deque(maxlen=1000)  # events not taken by wait_for_event
+		self.client = uuid.uuid4().hex
+		self.request_ids = itertools.count(1)
+		self.last_request_id = 0
+		self.send_lock = threading.Lock()
+		self.pending = {}  # request id -> (message, future) until acknowledged
+		self.query_ids = itertools.count(1)
+		self.queries = {}  # query id -> (message, future) until answered
+		self.latest = None  # the last data message from the server
+		self.received = threading.Event()
+		self.changed = threading.Condition()  # notified on every data message and event
+		self.writer = None
+
+		self.logger.debug('connecting to %s', self.address)
+		self.task = asyncio.run_coroutine_threadsafe(self._run(), event_loop())
 		return
 
-	def handle_close(self):
-		self.logger.debug('handle_close()')
-		self.close()
-		pass
+	async def _run(self):
+		# Stay connected, reconnecting whenever the daemon restarts
+		while True:
+			try:
+				reader, writer = await asyncio.open_connection(*self.address)
+			except OSError:
+				await asyncio.sleep(self.retry_interval)
+				continue
 
-	def writable(self):
-		self.logger.debug('writable() -> %s', bool(self.to_send))
-		return bool(self.to_send)
+			writer.write(encode_frame({"type": "hello", "client": self.client, "mode": self.mode}))
+			for request_id in sorted(self.pending):
+				writer.write(encode_frame(self.pending[request_id][0]))
+			for message, _ in self.queries.values():
+				writer.write(encode_frame(message))
+			self.writer = writer
+			try:
+				while True:
+					self.handle_read(await read_frame(reader))
+			except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+				self.logger.debug('_run() -> %r', e)
+			finally:
+				self.writer = None
+				writer.close()
+			await asyncio.sleep(self.retry_interval)
 
-	def handle_write(self):
-		if len(self.to_send) > self.chunk_size:
-			# if the buffer is too long bin some
-			sent = self.send(self.to_send[-self.chunk_size:])	
-			self.to_send = ""
-		else:
-			sent = self.send(self.to_send[:self.chunk_size])
-			self.to_send = self.to_send[sent:]
-		self.logger.debug('handle_write() -> (%d) "%s"', sent, self.to_send[:sent])
-
-	def handle_read(self):
-		data = self.recv(self.chunk_size)
-		self.logger.debug('handle_read() -> (%d) "%s"', len(data), data)
-		self.received_data = data
+	def handle_read(self, message):
+		kind = message.get("type")
+		if kind == "data":
+			if self.mode == "all":
+				self.samples.append(message)
+			if "timestamp" in message and (not self.readings or message["timestamp"] != self.readings[-1]["timestamp"]):
+				self.readings.append(message)
+			with self.changed:
+				self.latest = message
+				self.changed.notify_all()
+			self.received.set()
+		elif kind == "event":
+			self.logger.debug('event -> %s', message)
+			with self.changed:
+				self.events.append(message)
+				if message["event"] == "status" and self.latest is not None:
+					self.latest = dict(self.latest, **{k: v for k, v in message.items() if k not in ("type", "event")})
+				self.changed.notify_all()
+		elif kind == "ack":
+			_, future = self.pending.pop(message["id"], (None, None))
+			if future is not None:
+				future.set_result(message["id"])
+		elif kind == "reply":
+			_, future = self.queries.pop(message["id"], (None, None))
+			if future is None:
+				pass
+			elif "error" in message:
+				future.set_exception(RuntimeError(message["error"]))
+			else:
+				future.set_result(message["result"])
+
+	def send(self, msg):
+		""" Send the command string msg, return a concurrent.futures.Future which is
+		completed with the request id when the server acknowledges it
+		"""
+
+		future = concurrent.futures.Future()
+		with self.send_lock:
+			self.last_request_id = next(self.request_ids)
+			message = {"type": "cmd", "id": self.last_request_id, "msg": msg}
+			event_loop().call_soon_threadsafe(self._send, message, future)
+		return future
+
+	def _send(self, message, future):
+		self.pending[message["id"]] = (message, future)
+		self.logger.debug('send() -> %s', message)
+		if self.writer is not None:
+			self.writer.write(encode_frame(message))
+
+	def query(self, name, **params):
+		""" Ask the daemon the query name, return a concurrent.futures.Future which
+		is completed with the result
+		"""
+
+		future = concurrent.futures.Future()
+		message = {"type": "query", "id": next(self.query_ids), "query": name, "params": params}
+		event_loop().call_soon_threadsafe(self._query, message, future)
+		return future
+
+	def _query(self, message, future):
+		self.queries[message["id"]] = (message, future)
+		if self.writer is not None:
+			self.writer.write(encode_frame(message))
+
+	def read_samples(self):
+		""" Return the data messages received since the last call, in "all" mode """
+
+		samples = []
+		while self.samples:
+			samples.append(self.samples.popleft())
+		return samples
+
+	def wait_for_data(self, timeout=None):
+		""" Wait for the first data message, return False on timeout """
+
+		return self.received.wait(timeout)
+
+	def wait_for_event(self, event, timeout=None, **fields):
+		""" Wait for an event with the given fields, e.g.
+		wait_for_event("segment", state="end", segment=3). Events received before the
+		call count, the matching event is removed and returned, None on timeout
+		"""
+
+		def find():
+			for message in self.events:
+				if message["event"] == event and all(message.get(k) == v for k, v in fields.items()):
+					return message
+			return None
+
+		with self.changed:
+			message = self.changed.wait_for(find, timeout)
+			if message is not None:
+				self.events.remove(message)
+		return message
+
+	def wait_for_status(self, status, timeout=None):
+		""" Wait until the daemon has acted on all the commands sent by this client
+		and reports status, return False on timeout
+		"""
+
+		def reached():
+			return (
+				self.latest is not None and self.latest["status"] == status
+				and self.latest.get("handled", 0) >= self.last_request_id
+			)
+
+		with self.changed:
+			return self.changed.wait_for(reached, timeout)
+
+	def close(self, timeout=2.0):
+		""" Wait up to timeout for the outstanding acknowledgements and disconnect """
+
+		async def pending_futures():
+			return [future for _, future in self.pending.values()]
+
+		concurrent.futures.wait(run(pending_futures()), timeout)
+		self.logger.debug('close()')
+		self.task.cancel()
+		pass
@@ -0,0 +1,91 @@
+"""Shared memory state of the temperature and magnet daemons
+
+Each daemon publishes its latest state into a small memory mapped record:
+
+	value		temperature (K) or field (T)
+	status		1 = ready, 0 = not ready
+	setpoint	temperature or field the daemon is going to
+	heater		TCS heater current (uA) or magnet switch heater state (0/1)
+	timestamp	time.perf_counter_ns of the reading
+
+Any number of local processes can read it without sockets or locks. The record is
+protected by a seqlock: the writer makes the sequence number odd, writes the fields
+and makes it even again, a reader retries until it sees the same even sequence
+number before and after copying the fields. The sequence number is an aligned 8 byte
+word so it is never read torn.
+
+The record is a file in /dev/shm (or the temp directory), on Windows a named mapping.
+
+"""
+
+import collections
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+# seq, value, status, setpoint, heater, timestamp
+record = struct.Struct("<Qdqddq")
+sequence = struct.Struct("<Q")
+
+State = collections.namedtuple("State", ["value", "status", "setpoint", "heater", "timestamp"])
+
+
+def board_path(name):
+	""" The file holding the record of a daemon on POSIX systems """
+
+	directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+	return os.path.join(directory, f"gcodes_{name}.state")
+
+
+class StateBoard:
+	""" The state record of the daemon name, only the daemon opens it with writer=True """
+
+	def __init__(self, name, writer=False):
+		self.name = name
+		self.writer = writer
+		self.sequence = 0
+
+		if os.name == "nt":
+			self.map = mmap.mmap(-1, record.size, tagname=f"gcodes_{name}")
+		elif writer:
+			with open(board_path(name), "w+b") as f:
+				f.truncate(record.size)
+				self.map = mmap.mmap(f.fileno(), record.size)
+		else:
+			with open(board_path(name), "rb") as f:
+				self.map = mmap.mmap(f.fileno(), record.size, access=mmap.ACCESS_READ)
+
+		if writer:
+			self.map[:] = record.pack(0, 0.0, 0, 0.0, 0.0, 0)
+
+	def publish(self, value, status, setpoint=0.0, heater=0.0, timestamp=None):
+		""" Write the latest state, timestamp defaults to now """
+
+		if timestamp is None:
+			timestamp = time.perf_counter_ns()
+		self.sequence += 1
+		self.map[:sequence.size] = sequence.pack(self.sequence)
+		self.map[:] = record.pack(
+			self.sequence, float(value), int(status), float(setpoint), float(heater), int(timestamp)
+		)
+		self.sequence += 1
+		self.map[:sequence.size] = sequence.pack(self.sequence)
+
+	def read(self, retries=1000):
+		""" Return the latest State, or None if the daemon has not published yet """
+
+		for _ in range(retries):
+			start, = sequence.unpack_from(self.map)
+			if start % 2 == 0:
+				fields = record.unpack(self.map[:record.size])
+				end, = sequence.unpack_from(self.map)
+				if end == start:
+					return State(*fields[1:]) if start else None
+			# Let the writer finish, it may be a thread of this process
+			time.sleep(0)
+		raise RuntimeError(f"State board {self.name} is being written continuously")
+
+	def close(self):
+		self.map.close()
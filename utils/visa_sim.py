@@ -0,0 +1,603 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+
+A simulated VISA backend for running the drivers and daemons without hardware
+
+Select it with visa_subs.use_simulation(...) or by setting the environment variable
+GCODES_VISA_BACKEND=sim before the first session is opened. Each resource name is
+mapped to a model which answers the commands of that instrument:
+
+	K2400, K6430	sourcemeters driving a resistive load
+	K2182, K2002	voltmeters
+	K6221		current source
+	SR830, SR850	lock-in amplifiers
+	AVS47		Picowatt AVS-47 resistance bridge
+	TCS		Leiden Cryogenics triple current source
+	IPS		Oxford Mercury iPS with X, Y and Z groups
+	LS475		Lake Shore 475 gaussmeter
+	SCPI		stores settings and answers queries with them
+
+The latency of each command (seconds, either a number or a dict from command prefix
+to seconds with "" as the default) and the relative noise on readings are set on the
+SimResourceManager.
+
+"""
+
+import math
+import random
+import re
+import time
+from collections import deque
+
+import numpy as np
+
+# Models of the resources opened by the daemons
+default_models = {
+	"GPIB0::20::INSTR": "AVS47",
+	"ASRL6::INSTR": "TCS",
+	"ASRL11::INSTR": "IPS",
+}
+
+
+class SimTimeout(Exception):
+	"""Raised when a read finds nothing in the output queue"""
+
+
+class SimInstrument:
+	"""Store settings written as "HEADER value" and answer "HEADER?" with them
+
+	Models override reset and add handlers, a list of (regex, method) matched
+	against the upper case header without the leading colon.
+	"""
+
+	idn = "GCODES,SIMULATED INSTRUMENT,0,1.0"
+	defaults = {}
+
+	def __init__(self, noise=0.0):
+		self.noise = noise
+		self.settings = {}
+		self.handlers = [
+			(r"\*IDN\?", lambda argument: self.idn),
+			(r"\*OPC\?", lambda argument: "1"),
+			(r"\*RST", lambda argument: self.reset()),
+		]
+		self.reset()
+
+	def reset(self):
+		self.settings = dict(self.defaults)
+
+	def noisy(self, value, floor=0.0):
+		"""Add gaussian noise relative to value plus an absolute floor"""
+
+		return value + random.gauss(0.0, 1.0) * (abs(value) * self.noise + floor)
+
+	def handle(self, message):
+		"""Handle a message of semicolon separated commands, return the joined replies"""
+
+		replies = []
+		for command in message.split(";"):
+			if command.strip():
+				reply = self.handle_command(command.strip())
+				if reply is not None:
+					replies.append(reply)
+		return ";".join(replies) if replies else None
+
+	def handle_command(self, command):
+		header, _, argument = command.partition(" ")
+		key = header.upper().lstrip(":")
+		argument = argument.strip()
+
+		for pattern, method in self.handlers:
+			if re.fullmatch(pattern, key):
+				return method(argument)
+
+		if key.endswith("?"):
+			return str(self.settings.get(" ".join((key[:-1], argument)).strip(), "0"))
+		self.settings[key] = argument
+		return None
+
+
+class SimSourcemeter(SimInstrument):
+	"""Keithley 2400/6430 sourcing into a resistive load"""
+
+	idn = "KEITHLEY INSTRUMENTS INC.,MODEL 2400,SIM,C30"
+	load = 1e6  # Ohm
+	defaults = {"SENS:CURR:PROT:LEV": "1.05e-7", "SYST:BEEP:STAT": "0"}
+
+	def __init__(self, noise=0.0):
+		super().__init__(noise)
+		self.handlers += [
+			(r"SOUR:FUNC(:MODE)?", self.set_function),
+			(r"SOUR:(VOLT|CURR)(:LEV)?", self.set_level),
+			(r"SOUR:(VOLT|CURR):MODE", lambda argument: self.set("mode", argument)),
+			(r"SOUR:LIST:(VOLT|CURR)", self.set_list),
+			(r"TRIG:COUN", lambda argument: self.set("count", int(argument))),
+			(r"OUTP(:STAT)?", lambda argument: self.set("output", bool(int(argument)))),
+			(r"OUTP(:STAT)?\?", lambda argument: "%d" % self.output),
+			(r"SOUR:FUNC(:MODE)?\?", lambda argument: self.function),
+			(r"INIT", lambda argument: self.initiate()),
+			(r"FETC\?", lambda argument: self.fetch()),
+			(r"READ\?", lambda argument: self.initiate() or self.fetch()),
+		]
+
+	def reset(self):
+		super().reset()
+		self.function = "VOLT"
+		self.level = 0.0
+		self.mode = "FIX"
+		self.source_list = []
+		self.count = 1
+		self.output = False
+		self.readings = []
+
+	def set(self, name, value):
+		setattr(self, name, value)
+
+	def set_function(self, argument):
+		self.function = argument.upper()[:4]
+
+	def set_level(self, argument):
+		self.level = float(argument)
+
+	def set_list(self, argument):
+		self.source_list = [float(i) for i in argument.split(",")]
+
+	def measure(self, level):
+		"""Return V, I with the source at level"""
+
+		if not self.output:
+			return [0.0, 0.0]
+		if self.function == "VOLT":
+			return [level, self.noisy(level / self.load, 1e-12)]
+		return [self.noisy(level * self.load, 1e-6), level]
+
+	def initiate(self):
+		if self.mode == "LIST" and self.source_list:
+			levels = [self.source_list[i % len(self.source_list)] for i in range(self.count)]
+			self.level = levels[-1]
+		else:
+			levels = [self.level] * self.count
+		self.readings = [self.measure(level) for level in levels]
+
+	def fetch(self):
+		if not self.readings:
+			self.initiate()
+		return ",".join("%.6e" % v for reading in self.readings for v in reading)
+
+
+class SimVoltmeter(SimInstrument):
+	"""Keithley 2182A/2002 measuring a small DC voltage"""
+
+	idn = "KEITHLEY INSTRUMENTS INC.,MODEL 2182A,SIM,C02"
+	voltage = 1e-6
+
+	def __init__(self, noise=0.0):
+		super().__init__(noise)
+		self.handlers += [
+			(r"INIT", lambda argument: self.initiate()),
+			(r"FETC\?", lambda argument: self.fetch()),
+			(r"READ\?", lambda argument: self.initiate() or self.fetch()),
+			(r"SENS:VOLT:REF\?", lambda argument: "0.0"),
+			(r"TRIG:COUN", lambda argument: setattr(self, "count", int(argument))),
+			(r"TRAC:CLE", lambda argument: self.trace.clear()),
+			(r"TRAC:DATA\?", lambda argument: ",".join("%.9e" % v for v in self.trace)),
+			(r"CALC2:IMM\?", lambda argument: self.statistic()),
+		]
+
+	def reset(self):
+		super().reset()
+		self.count = 1
+		self.readings = []
+		self.trace = []
+
+	def initiate(self):
+		self.readings = [self.noisy(self.voltage, 1e-9) for i in range(self.count)]
+		if self.settings.get("TRAC:FEED:CONT", "NEV").upper().startswith("NEXT"):
+			self.trace = list(self.readings)
+			self.settings["TRAC:FEED:CONT"] = "NEV"
+
+	def statistic(self):
+		"""CALC2 on the trace buffer, MEAN or SDEV"""
+
+		if not self.trace:
+			return "9.9e37"
+		if self.settings.get("CALC2:FORM", "MEAN").upper().startswith("SDEV"):
+			return "%.9e" % np.std(self.trace, ddof=1 if len(self.trace) > 1 else 0)
+		return "%.9e" % np.mean(self.trace)
+
+	def fetch(self):
+		if not self.readings:
+			self.initiate()
+		return ",".join("%.9e" % v for v in self.readings)
+
+
+class SimCurrentSource(SimInstrument):
+	"""Keithley 6221 in WAVE mode, or running the delta modes with a 2182A on the
+	serial link across a resistive load
+	"""
+
+	idn = "KEITHLEY INSTRUMENTS INC.,MODEL 6221,SIM,A02"
+	load = 1e3  # Ohm
+	defaults = {"OUTP:STAT": "0"}
+
+	def __init__(self, noise=0.0):
+		super().__init__(noise)
+		self.handlers += [
+			(r"SOUR:DELT:NVPR\?", lambda argument: "1"),
+			(r"SOUR:LIST:CURR", lambda argument: self.set_list(argument)),
+			(r"SOUR:LIST:CURR:APP", lambda argument: self.set_list(argument, append=True)),
+			(r"SOUR:DELT:ARM", lambda argument: setattr(self, "armed", "DELT")),
+			(r"SOUR:PDEL:ARM", lambda argument: setattr(self, "armed", "PDEL")),
+			(r"SOUR:DCON:ARM", lambda argument: setattr(self, "armed", "DCON")),
+			(r"SOUR:SWE:ABOR", lambda argument: setattr(self, "armed", None)),
+			(r"INIT(:IMM)?", lambda argument: self.initiate()),
+			(r"TRAC:CLE", lambda argument: self.trace.clear()),
+			(r"TRAC:POIN:ACT\?", lambda argument: "%d" % len(self.trace)),
+			(r"TRAC:DATA\?", lambda argument: ",".join("%.6e" % v for pair in self.trace for v in pair)),
+		]
+
+	def reset(self):
+		super().reset()
+		self.source_list = []
+		self.armed = None
+		self.trace = []
+
+	def set_list(self, argument, append=False):
+		values = [float(i) for i in argument.split(",")]
+		self.source_list = self.source_list + values if append else values
+
+	def setting(self, key, default=0.0):
+		return float(self.settings.get(key, default))
+
+	def initiate(self):
+		"""Fill the trace with reading, source pairs"""
+
+		mode = self.armed
+		if mode == "DCON":
+			start, step = self.setting("SOUR:DCON:STAR"), self.setting("SOUR:DCON:STEP", 1e-6)
+			count = int(round((self.setting("SOUR:DCON:STOP") - start) / step)) + 1
+			self.trace = [(self.noisy(self.load, 1e-3), start + i * step) for i in range(count)]
+		elif mode == "PDEL":
+			self.trace = [(self.noisy(i * self.load, 1e-9), i) for i in self.source_list]
+		elif mode == "DELT":
+			high = self.setting("SOUR:DELT:HIGH", 1e-6)
+			count = int(self.setting("SOUR:DELT:COUN", 1))
+			self.trace = [(self.noisy(high * self.load, 1e-9), high) for i in range(count)]
+
+
+class SimLockIn(SimInstrument):
+	"""SR830/SR850 measuring a resistor excited by the sine output"""
+
+	idn = "Stanford_Research_Systems,SR830,s/n00000,ver1.07"
+	gain = 1e-3  # signal per volt of excitation
+	defaults = {
+		"SLVL": "0.004", "FREQ": "17.777", "HARM": "1", "SENS": "17",
+		"PHAS": "0.00", "OFLT": "8", "FMOD": "1", "SRAT": "13", "LIAS": "0",
+	}
+
+	def __init__(self, noise=0.0):
+		super().__init__(noise)
+		self.handlers += [
+			(r"SNAP\?1,2,3,4", lambda argument: self.snap()),
+			(r"OEXP\?", lambda argument: "0.00,0"),
+			(r"SPTS\?", lambda argument: "%d" % self.stored_points()),
+			(r"REST", lambda argument: self.buffer_reset()),
+			(r"STR[TD]", lambda argument: self.buffer_start()),
+			(r"PAUS", lambda argument: self.buffer_pause()),
+			(r"TRC[ABL]\?", self.trace),
+		]
+
+	def reset(self):
+		super().reset()
+		self.buffer_reset()
+
+	def signal(self):
+		x = self.noisy(float(self.settings["SLVL"]) * self.gain, 1e-9)
+		y = self.noisy(0.0, 1e-9)
+		return x, y
+
+	def snap(self):
+		x, y = self.signal()
+		return "%.6e,%.6e,%.6e,%.3f" % (x, y, math.hypot(x, y), math.degrees(math.atan2(y, x)))
+
+	def buffer_reset(self):
+		self.buffer_start_time = None
+		self.buffer_points = 0
+		self.buffer = {1: [], 2: []}
+
+	def buffer_start(self):
+		self.buffer_start_time = time.monotonic()
+
+	def buffer_pause(self):
+		self.buffer_points = self.stored_points()
+		self.buffer_start_time = None
+
+	def stored_points(self):
+		if self.buffer_start_time is None:
+			return self.buffer_points
+		rate = 0.0625 * 2**int(self.settings["SRAT"])
+		return self.buffer_points + int((time.monotonic() - self.buffer_start_time) * rate)
+
+	def trace(self, argument):
+		channel, start, count = (int(i) for i in argument.split(","))
+		stored = self.stored_points()
+		while len(self.buffer[1]) < stored:
+			x, y = self.signal()
+			self.buffer[1].append(x)
+			self.buffer[2].append(y)
+		return ",".join("%.6e" % v for v in self.buffer[channel][start:start + count])
+
+
+class SimBridge(SimInstrument):
+	"""Picowatt AVS-47 reading a thermometer"""
+
+	idn = "PICOWATT AVS-47"
+	resistance = 2000.0
+
+	def __init__(self, noise=0.0):
+		super().__init__(noise)
+		self.handlers += [
+			(r"RES\?", lambda argument: "%.4f" % self.noisy(self.resistance, 0.01)),
+			(r"RAN\?", lambda argument: "5"),
+		]
+
+
+class SimTCS(SimInstrument):
+	"""Leiden Cryogenics triple current source"""
+
+	idn = "LEIDEN CRYOGENICS TCS SIM"
+
+	def __init__(self, noise=0.0):
+		super().__init__(noise)
+		self.handlers += [
+			(r"ID\?", lambda argument: self.idn),
+			(r"STATUS\?", lambda argument: self.status()),
+			(r"SETDAC", self.set_dac),
+			(r"SETUP", self.setup),
+		]
+
+	def reset(self):
+		super().reset()
+		self.range = [1, 1, 1]
+		self.current = [0, 0, 0]
+		self.heater = [0, 0, 0]
+
+	def status(self):
+		fields = []
+		for i in range(3):
+			fields += [str(i + 1), str(self.range[i]), str(self.current[i]), str(self.heater[i])]
+		return "STATUS\t" + ",".join(fields)
+
+	def set_dac(self, argument):
+		source, _, current = (int(i) for i in argument.split(" "))
+		self.current[source - 1] = current
+		return "OK"
+
+	def setup(self, argument):
+		command_vector = [int(i) for i in argument.split(",")]
+		for i in range(3):
+			if command_vector[2 + i * 4]:
+				self.heater[i] = int(not self.heater[i])
+		return "OK"
+
+
+class SimMercuryIPS(SimInstrument):
+	"""Oxford Mercury iPS with X, Y and Z groups which ramp in real time"""
+
+	idn = "IDN:OXFORD INSTRUMENTS:MERCURY IPS:SIM:2.5"
+
+	def __init__(self, noise=0.0):
+		super().__init__(noise)
+		self.handlers += [
+			(r"READ:DEV:GRP([XYZ]):PSU:(.*)", self.read),
+			(r"SET:DEV:GRP([XYZ]):PSU:(.*)", self.set),
+		]
+
+	def reset(self):
+		super().reset()
+		self.groups = {
+			axis: {
+				"ATOB": 9.7, "CLIM": 100.0, "CURR": 0.0, "PCUR": 0.0, "CSET": 0.0,
+				"RCST": 2.19, "SWHT": "OFF", "ACTN": "HOLD", "time": time.monotonic()
+			}
+			for axis in "XYZ"
+		}
+
+	def handle_command(self, command):
+		# Mercury commands have no argument, the values are part of the colon separated path
+		command = command.upper()
+		for pattern, method in self.handlers:
+			match = re.fullmatch(pattern, command)
+			if match:
+				return method(command, *match.groups())
+		return "INVALID"
+
+	def advance(self, group):
+		"""Ramp the source current to now"""
+
+		now = time.monotonic()
+		dt = now - group["time"]
+		group["time"] = now
+		if group["ACTN"] in ("RTOS", "RTOZ"):
+			target = group["CSET"] if group["ACTN"] == "RTOS" else 0.0
+			step = group["RCST"] / 60.0 * dt
+			if abs(target - group["CURR"]) <= step:
+				group["CURR"] = target
+			else:
+				group["CURR"] += math.copysign(step, target - group["CURR"])
+		if group["SWHT"] == "ON":
+			group["PCUR"] = group["CURR"]
+
+	def read(self, command, axis, path):
+		group = self.groups[axis]
+		self.advance(group)
+		prefix = "STAT:DEV:GRP%s:PSU:" % axis
+		if path in ("ATOB", "CLIM"):
+			unit = "A/T" if path == "ATOB" else "A"
+			return "%s%s:%.4f%s" % (prefix, path, group[path], unit)
+		if path == "ACTN":
+			return "%sACTN:%s" % (prefix, group["ACTN"])
+		signal = path.split(":")[-1]
+		if signal == "SWHT":
+			return "%sSIG:SWHT:%s" % (prefix, group["SWHT"])
+		if signal == "FLD":
+			return "%sSIG:FLD:%.4fT" % (prefix, self.noisy(group["CURR"] / group["ATOB"]))
+		if signal == "RCST":
+			return "%sSIG:RCST:%.4fA/m" % (prefix, group["RCST"])
+		if signal in ("CURR", "PCUR", "CSET"):
+			return "%sSIG:%s:%.4fA" % (prefix, signal, self.noisy(group[signal]))
+		return "%s%s:INVALID" % (prefix, path)
+
+	def set(self, command, axis, path):
+		group = self.groups[axis]
+		self.advance(group)
+		setting, _, value = path.rpartition(":")
+		setting = setting.split(":")[-1]
+		if setting in ("CSET", "RCST"):
+			group[setting] = float(value)
+		elif setting in ("SWHT", "ACTN"):
+			group[setting] = value
+		else:
+			return "STAT:%s:INVALID" % command
+		return "STAT:%s:VALID" % command
+
+
+class SimGaussmeter(SimInstrument):
+	"""Lake Shore 475 whose field relaxes to the control setpoint"""
+
+	idn = "LSCI,MODEL475,SIM,1.0"
+	time_constant = 1.0  # seconds
+
+	def __init__(self, noise=0.0):
+		super().__init__(noise)
+		self.handlers += [
+			(r"RDGFIELD\?", lambda argument: "%+.4E" % self.noisy(self.field(), 0.01)),
+			(r"CSETP", self.set_point),
+			(r"CSETP\?", lambda argument: "%+.4E" % self.setpoint),
+		]
+
+	def reset(self):
+		super().reset()
+		self.setpoint = 0.0
+		self.start_field = 0.0
+		self.set_time = time.monotonic()
+
+	def field(self):
+		dt = time.monotonic() - self.set_time
+		return self.setpoint + (self.start_field - self.setpoint) * math.exp(-dt / self.time_constant)
+
+	def set_point(self, argument):
+		self.start_field = self.field()
+		self.setpoint = float(argument)
+		self.set_time = time.monotonic()
+
+
+models = {
+	"K2400": SimSourcemeter,
+	"K6430": SimSourcemeter,
+	"K2182": SimVoltmeter,
+	"K2002": SimVoltmeter,
+	"K6221": SimCurrentSource,
+	"SR830": SimLockIn,
+	"SR850": SimLockIn,
+	"AVS47": SimBridge,
+	"TCS": SimTCS,
+	"IPS": SimMercuryIPS,
+	"LS475": SimGaussmeter,
+	"SCPI": SimInstrument,
+}
+
+
+class SimResource:
+	"""Stand in for a pyvisa message based resource"""
+
+	def __init__(self, name, instrument, manager):
+		self.resource_name = name
+		self.instrument = instrument
+		self.manager = manager
+		self.output_queue = deque()
+		self.timeout = 2000
+		self.read_termination = "\n"
+		self.write_termination = "\n"
+		self.query_delay = 0.0
+
+	def write(self, message):
+		time.sleep(self.manager.command_latency(message))
+		reply = self.instrument.handle(message)
+		if reply is not None:
+			self.output_queue.append(reply)
+
+	def read(self):
+		if not self.output_queue:
+			raise SimTimeout(f"{self.resource_name}: nothing to read")
+		return self.output_queue.popleft()
+
+	def query(self, message):
+		self.write(message)
+		return self.read()
+
+	def read_bytes(self, count):
+		"""Binary streams are not simulated, return zeros after the stream time"""
+
+		time.sleep(self.manager.command_latency(""))
+		return bytes(count)
+
+	def query_binary_values(
+			self, message, datatype="f", is_big_endian=False, container=list,
+			header_fmt="ieee", expect_termination=True, data_points=None, **kwargs
+	):
+		"""The replies are generated as ASCII and converted to the values a binary
+		transfer would decode to
+		"""
+
+		reply = self.query(message)
+		values = np.array([float(i) for i in reply.strip(",").split(",") if i])
+		if datatype == "h":
+			# SR830 TRCL? pairs of mantissa and exponent, value = m * 2^(exp - 124)
+			mantissa, exponent = np.frexp(values)
+			values = np.column_stack((np.round(mantissa * 2**15), exponent + 109)).ravel()
+		return container(values)
+
+	def group_execute_trigger(self, *resources):
+		for resource in resources:
+			resource.instrument.handle("*TRG")
+
+	def close(self):
+		pass
+
+
+class SimResourceManager:
+	"""Stand in for a pyvisa ResourceManager
+
+	models maps resource names to the model names in visa_sim.models, resources
+	not in models or default_models are simulated as plain SCPI instruments
+	"""
+
+	def __init__(self, models=None, latency=0.0, noise=0.0):
+		self.models = dict(default_models)
+		self.models.update(models or {})
+		self.latency = latency
+		self.noise = noise
+		self.resources = {}
+
+	def command_latency(self, message):
+		"""The simulated time taken by a command"""
+
+		if not isinstance(self.latency, dict):
+			return self.latency
+		matches = [prefix for prefix in self.latency if message.startswith(prefix)]
+		return self.latency[max(matches, key=len)] if matches else 0.0
+
+	def open_resource(self, name, **kwargs):
+		model = models[self.models.get(name, "SCPI")]
+		resource = SimResource(name, model(self.noise), self)
+		self.resources[name] = resource
+		return resource
+
+	def list_resources(self):
+		return tuple(self.models.keys())
+
+	def close(self):
+		pass
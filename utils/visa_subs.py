@@ -11,13 +11,141 @@ last edit : January 2015
 
 Edited to support PyVisa 1.6
 
+Sessions are kept in a registry keyed by resource name, so instruments and
+measurements opened again in the same process reuse the open session and its
+cached *IDN? reply. The ResourceManager is only created when the first session is
+opened and all sessions are closed on exit.
+
+Calling use_simulation before the first session is opened, or setting the environment
+variable GCODES_VISA_BACKEND=sim, replaces the VISA library with the simulated
+instruments in utils.visa_sim.
+
 Functions written:
 	InitializeGPIB
 	InitialIzeSerial
+	UseSimulation
+	OpenSession
+	QueryIDN
+	SessionState
+	CloseSession
+	CloseSessions
+	BusLock
+	GroupExecuteTrigger
 
 """
-import visa as visa
-rm = visa.ResourceManager()
+import atexit
+import os
+import threading
+
+# The ResourceManager is created on first use so the package imports without a VISA library
+rm = None
+# Keyword arguments of the simulated ResourceManager, None to use the VISA library
+simulation = None
+
+# Open sessions, *IDN? replies and the shadow state of the instrument settings keyed by
+# resource name, shared by every Instrument
+sessions = {}
+idn_cache = {}
+session_states = {}
+sessions_lock = threading.Lock()
+
+# One lock per GPIB board to serialise transactions made from several threads
+bus_locks = {}
+
+
+def get_resource_manager():
+	""" Return the VISA ResourceManager, creating it on the first call """
+
+	global rm
+	if rm is None:
+		if simulation is None and os.environ.get("GCODES_VISA_BACKEND", "").lower() == "sim":
+			use_simulation()
+		if simulation is not None:
+			import utils.visa_sim as visa_sim
+			rm = visa_sim.SimResourceManager(**simulation)
+		else:
+			try:
+				import pyvisa as visa
+			except ImportError:
+				import visa as visa
+			rm = visa.ResourceManager()
+	return rm
+
+
+def use_simulation(models=None, latency=0.0, noise=0.0):
+	""" Use simulated instruments instead of the VISA library
+
+	models maps resource names e.g. "GPIB0::24::INSTR" to the model names in
+	visa_sim.models, latency is the time taken by each command in seconds (or a dict
+	from command prefix to seconds) and noise is the relative noise on the readings
+	"""
+
+	global simulation
+	if rm is not None:
+		raise RuntimeError("The ResourceManager is already open, select the simulation first")
+	simulation = {"models": models, "latency": latency, "noise": noise}
+
+
+def open_session(name):
+	""" Return the open session for a resource, opening it if this is the first use """
+
+	with sessions_lock:
+		if name not in sessions:
+			sessions[name] = get_resource_manager().open_resource(name)
+		return sessions[name]
+
+
+def query_idn(name, idn="*IDN?"):
+	""" Identify a resource, the reply is only queried once per session """
+
+	if name not in idn_cache:
+		idn_cache[name] = open_session(name).query(idn)
+	return idn_cache[name]
+
+
+def session_state(name):
+	""" Return the dict holding the last written and read settings of a resource """
+
+	with sessions_lock:
+		return session_states.setdefault(name, {})
+
+
+def close_session(name):
+	""" Close a session and forget it """
+
+	with sessions_lock:
+		session = sessions.pop(name, None)
+		idn_cache.pop(name, None)
+		session_states.pop(name, {}).clear()
+	if session is not None:
+		try:
+			session.close()
+		except Exception:
+			pass
+
+
+def close_sessions():
+	""" Close all the open sessions, called on exit """
+
+	for name in list(sessions.keys()):
+		close_session(name)
+
+
+atexit.register(close_sessions)
+
+
+def bus_lock(board):
+	""" Return the lock for a GPIB board """
+
+	return bus_locks.setdefault(board, threading.RLock())
+
+
+def group_execute_trigger(board, resources):
+	""" Trigger all the resources on a GPIB board at once with a group execute trigger """
+
+	interface = open_session(f"GPIB{board}::INTFC")
+	with bus_lock(board):
+		interface.group_execute_trigger(*resources)
 
 
 def initialize_gpib(address, board, query_id=True, read_termination="LF", **kwargs):
@@ -25,7 +153,7 @@ def initialize_gpib(address, board, query_id=True, read_termination="LF", **kwar
 
 	gpib_name = f"GPIB{board}::{address}::INSTR"
 	try:
-		gpib_visa = rm.open_resource(gpib_name)
+		gpib_visa = open_session(gpib_name)
 		if read_termination == "LF":
 			gpib_visa.read_termination = "\n"
 			gpib_visa.write_termination = "\n"
@@ -39,9 +167,10 @@ def initialize_gpib(address, board, query_id=True, read_termination="LF", **kwar
 			tmp = "".join(("gpib_visa.", kw, "=", kwargs[kw]))
 			exec(tmp)
 		if query_id:
-			print(gpib_visa.query("*IDN?"))
+			print(query_idn(gpib_name))
 	except Exception:
 		print("Failed opening GPIB address %d\n" % address)
+		close_session(gpib_name)
 		gpib_visa = None
 	return gpib_visa
 
@@ -50,7 +179,7 @@ def initialize_serial(name, idn="*IDN?", read_termination="LF", **kwargs):
 	""" Initialize Serial devices using PyVisa """
 
 	try:
-		serial_visa = rm.open_resource(name)
+		serial_visa = open_session(name)
 		if read_termination == "LF":
 			serial_visa.read_termination = "\n"
 		elif read_termination == "CR":
@@ -60,8 +189,9 @@ def initialize_serial(name, idn="*IDN?", read_termination="LF", **kwargs):
 		for kw in list(kwargs.keys()):
 			tmp = "".join(("serial_visa.", kw, "=", kwargs[kw]))
 			exec(tmp)
-		print(serial_visa.query(idn))
+		print(query_idn(name, idn))
 	except Exception:
 		print("Failed opening serial port %s\n" % name)
+		close_session(name)
 		serial_visa = None
 	return serial_visa